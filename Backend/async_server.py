@@ -0,0 +1,271 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+
+from Backend.connection_pool import CONNECTION_HELLO, PERSISTENT_TIMEOUT
+from Backend.protocol import FRAME_JSON, FrameDecoder, ProtocolError, decode_message, encode_message, is_framed
+from Backend.session import WRITE_BATCH, Session
+
+logger = logging.getLogger(__name__)
+
+# Server engine that serves every incoming connection from one event loop
+# instead of a thread each. The loop accepts connections and reads their
+# requests through non-blocking transports, so a burst of discovery or group
+# messages costs a small protocol object per connection rather than a thread.
+# Handlers for control messages can block (they update the app and sometimes
+# contact other peers), so they run on a small pool of worker threads. A
+# request that starts a file transfer hands its connection to the blocking
+# streaming code on a thread of its own, which keeps the zero-copy paths
+# those transfers use. A connection that speaks in frames stays open and has
+# its requests answered one after another, or becomes a session whose
+# requests are answered as they come; a bare JSON request from an older
+# peer gets its answer and the connection is closed.
+
+MAX_REQUEST_SIZE = 64 * 1024  # a bare JSON request is read until it parses, up to this size
+DEFAULT_CONTROL_WORKERS = 16  # threads running control message handlers
+STOP_TIMEOUT = 5              # seconds to wait for the loop to stop
+
+class LoopSession(Session):
+    """A session on a connection the event loop serves"""
+
+    def __init__(self, protocol, frame_type):
+        server = protocol.server
+        super().__init__(False, frame_type, server.network.app_controller.process_message, server.control_pool)
+        self.protocol = protocol
+        self.loop = server.loop
+        self.flush_scheduled = False
+
+    def ready(self):
+        # Handlers reply from worker threads; one flush on the loop writes everything waiting
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.call_soon(self.protocol.flush)
+
+    def shutdown(self):
+        self.close()
+        self.call_soon(self.protocol.transport.close)
+
+    def call_soon(self, callback):
+        try:
+            self.loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass  # the loop has stopped, and the connection with it
+
+class RequestProtocol(asyncio.Protocol):
+    """One incoming connection, from its first byte until its last request is answered"""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.address = None
+        self.data = b''
+        self.decoder = None  # set once the connection turns out to speak in frames
+        self.frame_type = FRAME_JSON  # how responses are encoded, settled by the hello
+        self.timer = None
+        self.dispatched = False
+        self.session = None
+        self.writing_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.timer = self.server.loop.call_later(self.server.timeout, self.timed_out)
+
+    def data_received(self, data):
+        if self.session:
+            self.receive(data)
+            return
+        if self.decoder is None and not self.data and is_framed(data):
+            self.decoder = FrameDecoder()
+        if self.decoder:
+            self.decoder.feed(data)
+            if not self.dispatched:
+                self.next_frame()
+            return
+        if self.dispatched:
+            return
+        # A bare request may arrive in several segments; it's complete once it parses
+        self.data += data
+        try:
+            message = json.loads(self.data.decode())
+        except RecursionError:
+            logger.error(f"Request from {self.address[0]} is nested too deeply")
+            self.transport.abort()
+            return
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            if len(self.data) > MAX_REQUEST_SIZE:
+                logger.error(f"Request from {self.address[0]} is larger than {MAX_REQUEST_SIZE} bytes")
+                self.transport.abort()
+            return
+        self.dispatch(message)
+
+    def next_frame(self):
+        """Dispatch the next request on a framed connection once it has all arrived"""
+        try:
+            frame = self.decoder.next_frame()
+            if frame is None:
+                return
+            message = decode_message(*frame)
+        except (ProtocolError, UnicodeDecodeError, json.JSONDecodeError) as e:
+            logger.error(f"Protocol error from {self.address[0]}: {e}")
+            self.transport.abort()
+            return
+
+        if message.get('type') == CONNECTION_HELLO:
+            # The peer keeps this connection for its next messages
+            self.timer.cancel()
+            ack, self.frame_type, multiplexed = self.server.network.connection_pool.accept_hello(message)
+            self.transport.write(encode_message(ack))
+            if multiplexed:
+                self.start_session(message)
+            else:
+                self.wait_for_request()
+            return
+        self.dispatch(message)
+
+    def start_session(self, hello):
+        """Serve the rest of the connection as a session; the network's pool closes it once idle"""
+        self.session = LoopSession(self, self.frame_type)
+        # Keeps a backlog of bulky pieces from building up ahead of short messages
+        self.transport.set_write_buffer_limits(high=WRITE_BATCH)
+        self.server.network.connection_pool.adopt_accepted(self.session, hello, self.address)
+        self.receive(bytes(self.decoder.buffer))
+
+    def receive(self, data):
+        try:
+            self.session.serve(self.session.receive(data))
+        except ProtocolError as e:
+            logger.error(f"Protocol error from {self.address[0]}: {e}")
+            self.transport.abort()
+
+    def flush(self):
+        """Write what the session has to send, while the transport keeps up"""
+        self.session.flush_scheduled = False
+        while not self.writing_paused and not self.transport.is_closing():
+            frames = self.session.take_frames()
+            if not frames:
+                return
+            self.transport.write(b''.join(frames))
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.session:
+            self.flush()
+
+    def dispatch(self, message):
+        self.dispatched = True
+        self.timer.cancel()
+        self.transport.pause_reading()
+        self.server.dispatch(self, message)
+
+    def wait_for_request(self):
+        self.timer = self.server.loop.call_later(PERSISTENT_TIMEOUT, self.transport.close)
+        self.next_frame()
+
+    def eof_received(self):
+        if not self.dispatched and (self.data or self.decoder and self.decoder.has_partial()):
+            logger.error(f"Request from {self.address[0]} was cut off")
+        return False
+
+    def connection_lost(self, exc):
+        self.timer.cancel()
+        if self.session:
+            self.session.close()
+
+    def timed_out(self):
+        logger.warning(f"Client {self.address[0]} timed out before sending its request")
+        self.transport.abort()
+
+    def respond(self, future):
+        """Send a control message handler's response, then close the connection or wait for the next request"""
+        if self.transport.is_closing():
+            return  # the client went away while the handler ran
+        try:
+            response = future.result()
+        except Exception as e:
+            logger.error(f"Message processing error: {e}")
+            response = None
+        if not self.decoder:
+            if response:
+                self.transport.write(json.dumps(response).encode())
+            self.transport.close()
+            return
+
+        # A framed request gets an answer, if only null, so the peer knows when it's done
+        self.transport.write(encode_message(response or None, self.frame_type))
+        self.dispatched = False
+        self.transport.resume_reading()
+        self.wait_for_request()
+
+class AsyncServer:
+    def __init__(self, network, server_socket, timeout=30, control_workers=None):
+        self.network = network
+        self.server_socket = server_socket
+        self.timeout = timeout
+        workers = control_workers or int(os.environ.get('P2P_CONTROL_WORKERS', DEFAULT_CONTROL_WORKERS))
+        self.control_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='control')
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+
+    def start(self):
+        """Run the event loop on a background thread"""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            # The socket is already listening, with the backlog the network manager chose
+            self.server = self.loop.run_until_complete(
+                self.loop.create_server(lambda: RequestProtocol(self), sock=self.server_socket)
+            )
+            self.loop.run_forever()
+        except Exception as e:
+            logger.error(f"Server error: {e}")
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        """Stop accepting connections and drop the ones still being read"""
+        stopped = threading.Event()
+
+        def shutdown():
+            if self.server:
+                self.server.close()
+            # Transports closed just before close their sockets on the next pass of the loop
+            self.loop.call_soon(self.loop.stop)
+            stopped.set()
+
+        # Waits so the listening socket is still open when the loop lets go of it
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(shutdown)
+            stopped.wait(STOP_TIMEOUT)
+        self.control_pool.shutdown(wait=False)
+
+    def dispatch(self, protocol, message):
+        """Run a request's handler off the loop"""
+        if not protocol.decoder and self.network.is_stream_message(message):
+            # The connection belongs to the transfer's thread from here on;
+            # dropping the transport closes only its own handle on the socket
+            client_socket = protocol.transport.get_extra_info('socket').dup()
+            protocol.transport.abort()
+            client_socket.setblocking(True)
+            client_socket.settimeout(self.timeout)
+            threading.Thread(target=self.serve_stream, args=(client_socket, message), daemon=True).start()
+            return
+
+        future = self.loop.run_in_executor(self.control_pool, self.network.app_controller.process_message, message)
+        future.add_done_callback(protocol.respond)
+
+    def serve_stream(self, client_socket, message):
+        try:
+            self.network.handle_stream(client_socket, message)
+        except Exception as e:
+            logger.error(f"Client handling error: {e}")
+        finally:
+            client_socket.close()
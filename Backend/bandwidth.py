@@ -0,0 +1,222 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Bandwidth scheduling for file transfers. Every bulk send and receive loop
+# draws tokens before moving data, through nested limits: the transfer's own
+# cap, its peer's cap and the global cap for its direction. Contended global
+# bandwidth is shared between transfers in proportion to their weights, and
+# a slice of each global cap is never handed to bulk data so chat and control
+# messages still get through while transfers saturate the link.
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+DEFAULT_CONTROL_RESERVE = 0.1  # share of a global cap kept free for control traffic
+BURST_TIME = 0.1               # seconds of traffic a bucket may save up
+MIN_BURST = 64 * 1024
+RATE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_rate(value):
+    """Parse a rate such as '500K', '20M' or '1G' in bytes per second; empty means unlimited"""
+    if value is None or not str(value).strip():
+        return None
+    value = str(value).strip().upper().rstrip('B/S')
+    multiplier = RATE_SUFFIXES.get(value[-1:], 1)
+    if value[-1:] in RATE_SUFFIXES:
+        value = value[:-1]
+    rate = float(value) * multiplier
+    return rate if rate > 0 else None
+
+class TokenBucket:
+    """Tokens (bytes) refilled at a fixed rate, up to a small burst"""
+
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = max(rate * BURST_TIME, MIN_BURST)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        """Change the refill rate, keeping the tokens saved so far"""
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.burst = max(rate * BURST_TIME, MIN_BURST)
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, amount):
+        """Take tokens now, going into debt if needed; returns how long to wait before using them"""
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def delay(self, amount):
+        """Seconds until amount can be taken (amounts above the burst only need a full bucket)"""
+        with self.lock:
+            self.refill()
+            missing = min(amount, self.burst) - self.tokens
+            return max(0.0, missing / self.rate)
+
+    def consume(self, amount):
+        """Take tokens that delay() said are available"""
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+
+class TransferShare:
+    """One transfer's claim on the scheduler"""
+
+    def __init__(self, scheduler, peer, direction, weight, limit):
+        self.scheduler = scheduler
+        self.peer = peer
+        self.direction = direction
+        self.weight = max(weight, 0.01)
+        self.bucket = TokenBucket(limit) if limit else None
+        self.virtual_time = 0.0
+        self.bytes = 0
+
+    def acquire(self, amount):
+        """Wait until this transfer may move amount more bytes"""
+        self.scheduler.acquire(self, amount)
+
+    def close(self):
+        self.scheduler.close_share(self)
+
+class BandwidthScheduler:
+    """Share upload and download bandwidth between transfers"""
+
+    def __init__(self, upload_limit=None, download_limit=None, peer_limit=None,
+                 transfer_limit=None, control_reserve=DEFAULT_CONTROL_RESERVE):
+        self.condition = threading.Condition()
+        self.control_reserve = min(max(control_reserve, 0.0), 0.9)
+        self.global_limits = {UPLOAD: upload_limit, DOWNLOAD: download_limit}
+        self.global_buckets = {
+            direction: self.make_global_bucket(limit) for direction, limit in self.global_limits.items()
+        }
+        self.default_peer_limit = peer_limit
+        self.default_transfer_limit = transfer_limit
+        self.peer_limits = {}    # {username: bytes per second}
+        self.peer_buckets = {}   # {(username, direction): TokenBucket}
+        self.queues = {UPLOAD: [], DOWNLOAD: []}  # heaps of (virtual finish time, sequence)
+        self.virtual_time = {UPLOAD: 0.0, DOWNLOAD: 0.0}
+        self.sequence = itertools.count()
+        self.shares = set()
+
+    @classmethod
+    def from_environment(cls):
+        """Create a scheduler configured by the P2P_*_LIMIT and P2P_CONTROL_RESERVE variables"""
+        reserve = os.environ.get('P2P_CONTROL_RESERVE')
+        return cls(
+            upload_limit=parse_rate(os.environ.get('P2P_UPLOAD_LIMIT')),
+            download_limit=parse_rate(os.environ.get('P2P_DOWNLOAD_LIMIT')),
+            peer_limit=parse_rate(os.environ.get('P2P_PEER_LIMIT')),
+            transfer_limit=parse_rate(os.environ.get('P2P_TRANSFER_LIMIT')),
+            control_reserve=float(reserve) if reserve else DEFAULT_CONTROL_RESERVE
+        )
+
+    def make_global_bucket(self, limit):
+        """Bulk data only ever gets the part of a global cap outside the control reserve"""
+        return TokenBucket(limit * (1 - self.control_reserve)) if limit else None
+
+    def set_global_limit(self, direction, limit):
+        """Change the global cap for UPLOAD or DOWNLOAD; None removes it"""
+        with self.condition:
+            self.global_limits[direction] = limit
+            bucket = self.global_buckets[direction]
+            if limit and bucket:
+                bucket.set_rate(limit * (1 - self.control_reserve))
+            else:
+                self.global_buckets[direction] = self.make_global_bucket(limit)
+            self.condition.notify_all()
+
+    def set_peer_limit(self, username, limit):
+        """Cap the traffic to and from one peer; None falls back to the default peer cap"""
+        with self.condition:
+            if limit:
+                self.peer_limits[username] = limit
+            else:
+                self.peer_limits.pop(username, None)
+            for direction in (UPLOAD, DOWNLOAD):
+                self.peer_buckets.pop((username, direction), None)
+
+    def get_peer_bucket(self, username, direction):
+        with self.condition:
+            limit = self.peer_limits.get(username, self.default_peer_limit)
+            if not limit:
+                return None
+            key = (username, direction)
+            if key not in self.peer_buckets:
+                self.peer_buckets[key] = TokenBucket(limit)
+            return self.peer_buckets[key]
+
+    def open_share(self, peer, direction, weight=1.0, limit=None):
+        """Register a transfer with a peer; larger weights get more of a contended link"""
+        share = TransferShare(self, peer, direction, weight, limit or self.default_transfer_limit)
+        with self.condition:
+            self.shares.add(share)
+        return share
+
+    def close_share(self, share):
+        with self.condition:
+            self.shares.discard(share)
+
+    def get_stats(self):
+        """Bytes moved by each open transfer"""
+        with self.condition:
+            return [
+                {'peer': share.peer, 'direction': share.direction, 'weight': share.weight, 'bytes': share.bytes}
+                for share in self.shares
+            ]
+
+    def acquire(self, share, amount):
+        """Block until a transfer may move amount bytes under all of its limits"""
+        share.bytes += amount
+        delay = share.bucket.reserve(amount) if share.bucket else 0.0
+        peer_bucket = self.get_peer_bucket(share.peer, share.direction)
+        if peer_bucket:
+            delay = max(delay, peer_bucket.reserve(amount))
+        if delay:
+            time.sleep(delay)
+
+        if self.global_buckets[share.direction]:
+            self.acquire_global(share, amount)
+
+    def acquire_global(self, share, amount):
+        """Wait for global tokens, serving transfers in weighted fair order"""
+        direction = share.direction
+        queue = self.queues[direction]
+        with self.condition:
+            # Each transfer advances its virtual clock by amount / weight, and the
+            # lowest virtual finish time goes first, so a transfer with twice the
+            # weight gets twice the bandwidth while both are waiting
+            start = max(share.virtual_time, self.virtual_time[direction])
+            entry = (start + amount / share.weight, next(self.sequence))
+            heapq.heappush(queue, entry)
+            try:
+                while True:
+                    bucket = self.global_buckets[direction]
+                    if bucket is None:
+                        break
+                    if queue[0] is entry:
+                        wait = bucket.delay(amount)
+                        if wait <= 0:
+                            bucket.consume(amount)
+                            break
+                        self.condition.wait(wait)
+                    else:
+                        self.condition.wait()
+            finally:
+                queue.remove(entry)
+                heapq.heapify(queue)
+                share.virtual_time = entry[0]
+                self.virtual_time[direction] = max(self.virtual_time[direction], start)
+                self.condition.notify_all()
@@ -0,0 +1,52 @@
+# Adaptive frame sizing for file transfers. Small frames keep slow links
+# responsive; large frames cut per-frame overhead on fast ones. The sender
+# measures throughput while it sends and hill-climbs towards the size that
+# moves data fastest, bounded by how long a single frame may take and by
+# the bandwidth-delay product of the connection.
+
+MIN_CHUNK_SIZE = 8 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 256 * 1024
+PROBE_INTERVAL = 0.25   # seconds of sending per measurement
+MAX_FRAME_TIME = 0.25   # longest a single frame should take to send
+GAIN_THRESHOLD = 0.05   # throughput changes smaller than this are noise
+
+def clamp_chunk_size(size):
+    """Round a size down to a power of two within the allowed range"""
+    size = max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, int(size)))
+    return 1 << (size.bit_length() - 1)
+
+class ChunkSizer:
+    """Tune the frame size of one transfer from measured throughput and round-trip time"""
+
+    def __init__(self, initial_size=None, rtt=None):
+        self.size = clamp_chunk_size(initial_size or DEFAULT_CHUNK_SIZE)
+        self.rtt = rtt
+        self.rate = None       # bytes per second over the last measurement
+        self.growing = True
+        self.window_bytes = 0
+        self.window_time = 0.0
+
+    def record(self, sent, elapsed):
+        """Account for one frame and re-tune once a measurement window is complete"""
+        self.window_bytes += sent
+        self.window_time += elapsed
+        if self.window_time < PROBE_INTERVAL:
+            return
+
+        rate = self.window_bytes / self.window_time
+        self.window_bytes = 0
+        self.window_time = 0.0
+
+        # Keep moving in the same direction while throughput holds up and
+        # turn around as soon as the last step made it noticeably worse
+        if self.rate is not None and rate < self.rate * (1 - GAIN_THRESHOLD):
+            self.growing = not self.growing
+        self.rate = rate
+
+        size = self.size * 2 if self.growing else self.size // 2
+        size = min(size, rate * MAX_FRAME_TIME)
+        if self.rtt:
+            # A frame smaller than one round trip's worth of data leaves the link idle
+            size = max(size, rate * self.rtt)
+        self.size = clamp_chunk_size(size)
@@ -0,0 +1,224 @@
+import json
+import struct
+
+# Compact binary encoding for control messages, used in place of JSON on
+# connections where both peers offered it in their hello. A message starts
+# with its type as a small number from MESSAGE_TYPES, and every field name
+# from FIELDS is a number too, so an ack shrinks from 37 bytes of JSON to
+# 4. Values carry a one byte tag; integers are zigzag varints, strings are
+# length prefixed, and the short status words peers answer with most often
+# fit in the tag byte itself. Anything the tables don't know about is
+# written out in full, so any JSON-compatible message can be sent.
+#
+# Both peers must hold the same tables. They may only change together with
+# the version in NAME, which is what the hello offers.
+
+NAME = 'binary/1'
+
+MESSAGE_TYPES = (
+    'ack', 'chat_ack', 'group_ack', 'directory_ack', 'status_ack', 'error_ack', 'multicast_ack',
+    'discover', 'discover_response', 'file_send_request', 'file_send_response', 'directory_share',
+    'group_content', 'multicast_offer', 'group_member_joined', 'transfer_cancel', 'chat_message',
+    'group_invite', 'group_invitation', 'group_invitation_response', 'status_update', 'ping', 'pong',
+    'error', 'connection_hello', 'connection_hello_ack',
+)
+FIELDS = (  # written as one byte each, so at most 255
+    'type', 'status', 'message', 'sender', 'timestamp', 'request_id', 'file_name', 'file_size',
+    'content_hash', 'file_count', 'batch', 'accepted', 'group', 'group_name', 'from', 'response',
+    'new_member', 'updated_members', 'directory', 'sharer', 'holder', 'files', 'path', 'session_id',
+    'receiver_id', 'repair_port', 'port', 'username', 'ip', 'codec', 'codecs', 'inviter', 'members',
+)
+ATOMS = (
+    'received', 'ready', 'error', 'accept', 'decline', 'alive', 'online', 'offline', 'have',
+    'joining', 'cancelled', 'success', 'notification_sent', 'unknown_message_type', NAME,
+)
+# Long messages, with lists of entries or many fields, where C JSON
+# outpaces this module; they stay JSON even on connections that agreed on
+# this codec. What pays is the short acks and notices that make up most
+# of the traffic.
+JSON_TYPES = frozenset((
+    'group_content', 'group_member_joined', 'group_invite', 'multicast_offer', 'file_transfer_start',
+))
+
+TYPE_IDS = {name: i for i, name in enumerate(MESSAGE_TYPES)}
+FIELD_IDS = {name: i for i, name in enumerate(FIELDS)}
+ATOM_IDS = {value: i for i, value in enumerate(ATOMS)}
+
+TAG_NULL = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3     # zigzag varint
+TAG_FLOAT = 4   # big-endian double
+TAG_STR = 5     # varint length, UTF-8
+TAG_LIST = 6    # varint count, values
+TAG_DICT = 7    # varint count, then field and value pairs
+TAG_ATOM = 16   # TAG_ATOM + i stands for ATOMS[i]
+DOUBLE = struct.Struct('>d')
+MAX_DEPTH = 32  # lists and dicts nested deeper than any message needs are refused rather than recursed into
+
+class CodecError(ValueError):
+    """Data that doesn't decode as a message"""
+
+def write_varint(out, n):
+    while n > 0x7F:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+def write_str(out, s):
+    raw = s.encode()
+    if len(raw) < 0x80:
+        out.append(len(raw))
+    else:
+        write_varint(out, len(raw))
+    out += raw
+
+def read_str(data, pos):
+    length = data[pos]
+    if length < 0x80:
+        pos += 1
+    else:
+        length, pos = read_varint(data, pos)
+    return data[pos:pos + length].decode(), pos + length
+
+def write_fields(out, fields, skip_type=False):
+    write_varint(out, len(fields) - 1 if skip_type else len(fields))
+    # Field IDs and small integers are written inline; a call costs more than the work
+    for key, value in fields.items():
+        if skip_type and key == 'type':
+            continue  # already written as the message's type ID
+        if type(key) is not str:
+            key = json.dumps(key)  # the key JSON would have written
+        field_id = FIELD_IDS.get(key)
+        if field_id is None:
+            out.append(0)
+            write_str(out, key)
+        else:
+            out.append(field_id + 1)
+        write_value(out, value)
+
+def write_value(out, value):
+    kind = type(value)
+    if kind is str:
+        atom = ATOM_IDS.get(value)
+        if atom is None:
+            out.append(TAG_STR)
+            write_str(out, value)
+        else:
+            out.append(TAG_ATOM + atom)
+    elif value is None:
+        out.append(TAG_NULL)
+    elif kind is bool:
+        out.append(TAG_TRUE if value else TAG_FALSE)
+    elif kind is int:
+        out.append(TAG_INT)
+        if 0 <= value < 0x40:
+            out.append(value << 1)
+        else:
+            write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif kind is float:
+        out.append(TAG_FLOAT)
+        out += DOUBLE.pack(value)
+    elif kind is dict:
+        out.append(TAG_DICT)
+        write_fields(out, value)
+    elif kind is list or kind is tuple:
+        out.append(TAG_LIST)
+        write_varint(out, len(value))
+        for item in value:
+            write_value(out, item)
+    elif isinstance(value, (str, int, float, dict, list, tuple)):
+        # Subclasses such as enums are sent as their plain JSON form
+        write_value(out, json.loads(json.dumps(value)))
+    else:
+        raise TypeError(f"Object of type {kind.__name__} can't be encoded")
+
+def read_fields(data, pos, fields, depth=0):
+    count, pos = read_varint(data, pos)
+    for _ in range(count):
+        field_id = data[pos]
+        if field_id:
+            key = FIELDS[field_id - 1]
+            pos += 1
+        else:
+            key, pos = read_str(data, pos + 1)
+        fields[key], pos = read_value(data, pos, depth)
+    return pos
+
+def read_value(data, pos, depth=0):
+    tag = data[pos]
+    pos += 1
+    if tag >= TAG_ATOM:
+        return ATOMS[tag - TAG_ATOM], pos
+    if tag == TAG_STR:
+        return read_str(data, pos)
+    if tag == TAG_INT:
+        n, pos = read_varint(data, pos)
+        return (n >> 1) ^ -(n & 1), pos
+    if tag == TAG_DICT or tag == TAG_LIST:
+        depth += 1
+        if depth > MAX_DEPTH:
+            raise CodecError(f"Values nested more than {MAX_DEPTH} deep")
+    if tag == TAG_DICT:
+        fields = {}
+        return fields, read_fields(data, pos, fields, depth)
+    if tag == TAG_LIST:
+        count, pos = read_varint(data, pos)
+        items = []
+        for _ in range(count):
+            item, pos = read_value(data, pos, depth)
+            items.append(item)
+        return items, pos
+    if tag == TAG_NULL:
+        return None, pos
+    if tag == TAG_TRUE:
+        return True, pos
+    if tag == TAG_FALSE:
+        return False, pos
+    if tag == TAG_FLOAT:
+        return DOUBLE.unpack_from(data, pos)[0], pos + DOUBLE.size
+    raise CodecError(f"Unknown value tag {tag}")
+
+def suits(message):
+    """Whether a message is better sent in this encoding than in JSON"""
+    return type(message) is not dict or message.get('type') not in JSON_TYPES
+
+def encode(message):
+    """Encode a message, or any JSON-compatible value"""
+    out = bytearray()
+    msg_type = message.get('type') if type(message) is dict else None
+    type_id = TYPE_IDS.get(msg_type) if type(msg_type) is str else None
+    if type_id is None:
+        # Not a message we know; a leading zero says a plain value follows
+        out.append(0)
+        write_value(out, message)
+    else:
+        write_varint(out, type_id + 1)
+        write_fields(out, message, skip_type=True)
+    return bytes(out)
+
+def decode(data):
+    try:
+        type_id, pos = read_varint(data, 0)
+        if type_id:
+            message = {'type': MESSAGE_TYPES[type_id - 1]}
+            pos = read_fields(data, pos, message)
+        else:
+            message, pos = read_value(data, pos)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise CodecError(f"Message is truncated or uses unknown table entries: {e}")
+    if pos > len(data):
+        raise CodecError("Message is truncated")
+    if pos < len(data):
+        raise CodecError(f"{len(data) - pos} bytes left over after the message")
+    return message
@@ -0,0 +1,95 @@
+import bz2
+import lzma
+import os
+import zlib
+
+# Per-transfer stream compression. The sender samples the file before the
+# transfer starts and only offers compression when it actually pays off.
+
+DEFAULT_CODEC = 'zlib'
+DEFAULT_LEVELS = {'zlib': 3, 'bz2': 9, 'lzma': 1}
+LEVEL_RANGES = {'zlib': (1, 9), 'bz2': (1, 9), 'lzma': (0, 9)}
+
+SAMPLE_BLOCK_SIZE = 64 * 1024
+SAMPLE_BLOCKS = 4
+MIN_COMPRESSIBLE_SIZE = 64 * 1024
+MAX_SAMPLE_RATIO = 0.9  # compressed/raw; anything above isn't worth the CPU
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024  # most plain bytes produced by one decompress call
+
+# Formats that are already compressed; sampling them would only waste time
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a',
+    '.mp4', '.mkv', '.mov', '.avi', '.webm',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.jar', '.apk', '.whl'
+}
+
+def get_compressor(codec, level):
+    """Create a streaming compressor for a negotiated codec"""
+    if codec == 'zlib':
+        return zlib.compressobj(level)
+    if codec == 'bz2':
+        return bz2.BZ2Compressor(level)
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+def get_decompressor(codec):
+    """Create a streaming decompressor for a negotiated codec"""
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    if codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+def decompress_chunks(decompressor, data, max_length=DECOMPRESS_CHUNK_SIZE):
+    """Decompress data in pieces of at most max_length bytes"""
+    # A few KB on the wire can expand to GBs, so never ask for all the output at once
+    if hasattr(decompressor, 'unconsumed_tail'):
+        while True:
+            piece = decompressor.decompress(data, max_length)
+            data = decompressor.unconsumed_tail
+            if piece:
+                yield piece
+            if not data and len(piece) < max_length:
+                return
+
+    piece = decompressor.decompress(data, max_length)
+    if piece:
+        yield piece
+    while not decompressor.eof and not decompressor.needs_input:
+        piece = decompressor.decompress(b'', max_length)
+        if piece:
+            yield piece
+
+def negotiate(offer):
+    """Accept a sender's compression offer, clamping the level to what we support"""
+    if not offer or offer.get('codec') not in LEVEL_RANGES:
+        return None
+    low, high = LEVEL_RANGES[offer['codec']]
+    level = offer.get('level', DEFAULT_LEVELS[offer['codec']])
+    return {'codec': offer['codec'], 'level': max(low, min(high, int(level)))}
+
+def choose_compression(file_path, file_size, codec=DEFAULT_CODEC):
+    """Sample a file and return a compression offer, or None if it won't compress"""
+    if file_size < MIN_COMPRESSIBLE_SIZE:
+        return None
+    if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return None
+
+    # Sample the first block and a few more spread through the file
+    step = max(SAMPLE_BLOCK_SIZE, file_size // SAMPLE_BLOCKS)
+    raw = compressed = 0
+    with open(file_path, 'rb') as f:
+        for offset in range(0, file_size, step)[:SAMPLE_BLOCKS]:
+            f.seek(offset)
+            block = f.read(SAMPLE_BLOCK_SIZE)
+            raw += len(block)
+            compressed += len(zlib.compress(block, 1))
+
+    if not raw or compressed / raw > MAX_SAMPLE_RATIO:
+        return None
+    return {'codec': codec, 'level': DEFAULT_LEVELS[codec]}
@@ -0,0 +1,366 @@
+import concurrent.futures
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+
+from Backend import codec, protocol
+from Backend.protocol import ConnectionClosed, ProtocolError
+from Backend.session import MUX_VERSION, Session, ThreadedSession
+
+logger = logging.getLogger(__name__)
+
+# Persistent connections for control messages. A pooled connection speaks
+# in frames and opens with a hello; a peer that acknowledges it keeps the
+# connection open and answers every further request on it in turn, so a
+# message costs a single round trip instead of a handshake, a round trip
+# and a teardown, and group fan-out no longer leaves a TIME_WAIT socket
+# behind per message. The hello also settles how messages are encoded:
+# the compact binary codec when both peers have it, JSON otherwise, and
+# whether the connection becomes a session (session.py) that carries every
+# message between the two peers at once, in both directions. A peer's
+# server adopts a session it accepts for its own messages back, so a pair
+# of peers shares a single connection, once it has checked that the port
+# the hello names really belongs to the peer that opened the session: it
+# asks whoever listens there about the token the hello carried, which only
+# the opener knows. Peers that predate sessions get
+# pooled connections that answer one request at a time; idle ones are kept
+# per peer, checked before they are reused, replaced if the peer dropped
+# them and closed after a while without use. Peers that don't understand
+# the hello get a connection per message, in bare JSON, as before.
+
+CONNECTION_HELLO = 'connection_hello'
+CONNECTION_HELLO_ACK = 'connection_hello_ack'
+MAX_IDLE_PER_PEER = 4       # unused connections kept open to each peer
+IDLE_TIMEOUT = 60           # seconds an unused connection is kept
+PERSISTENT_TIMEOUT = 120    # seconds a server keeps a quiet pooled connection; outlasts IDLE_TIMEOUT
+REAP_INTERVAL = 15          # seconds between sweeps for expired connections
+UNPOOLED_RETRY = 300        # seconds before offering a hello again to a peer that ignored one
+KEEPALIVE_IDLE = 30         # seconds of silence before TCP keepalive probes start
+DEFAULT_SESSION_WORKERS = 16  # threads answering requests that arrive on sessions
+VERIFY_TIMEOUT = 5          # seconds to wait for a peer to confirm the port its hello named
+
+class PeerConnection:
+    """A connection to one peer's server that can carry many requests"""
+
+    def __init__(self, address, timeout):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        self.decoder = protocol.FrameDecoder()
+        self.frame_type = protocol.FRAME_JSON  # until the hello settles on a codec
+        self.last_used = time.monotonic()
+
+    def request(self, message, timeout):
+        """Send a message and wait for the peer's response; ConnectionClosed if none of it arrived"""
+        self.sock.settimeout(timeout)
+        try:
+            protocol.send_message(self.sock, message, self.frame_type)
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
+            raise ConnectionClosed(str(e))
+        try:
+            return protocol.read_message(self.sock, self.decoder)
+        except (ConnectionResetError, ConnectionAbortedError) as e:
+            raise ConnectionClosed(str(e))
+        finally:
+            self.last_used = time.monotonic()
+
+    def is_alive(self):
+        """Whether the peer still has the connection open, checked without waiting"""
+        try:
+            self.sock.setblocking(False)
+            # Reads nothing while the peer has nothing to say; end of file
+            # means it closed the connection, and any data is unexpected
+            self.sock.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    def __init__(self, network):
+        self.network = network
+        self.idle = {}      # {(ip, port): [PeerConnection]}, most recently used last
+        self.unpooled = {}  # {(ip, port): when a hello went unanswered}
+        self.sessions = {}  # {(ip, port): [Session]}, the first one used for messages to the peer
+        self.connecting = {}  # {(ip, port): lock held while a session to the peer is set up}
+        self.opened = {}    # {token: Session} for sessions we opened, None while the hello is out
+        self.lock = threading.Lock()
+        self.reaper = None
+        self.running = True
+        workers = int(os.environ.get('P2P_CONTROL_WORKERS', DEFAULT_SESSION_WORKERS))
+        self.workers = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='session')
+
+    def request(self, address, message, timeout):
+        """Send a message to a peer and return its response, reusing an open connection if there is one"""
+        if time.monotonic() - self.unpooled.get(address, -UNPOOLED_RETRY) < UNPOOLED_RETRY:
+            return self.request_once(address, message, timeout)
+
+        session = self.find_session(address)
+        if session:
+            try:
+                return session.request(message, timeout)
+            except ConnectionClosed:
+                # Raised only if none of the message went out, so it can go on a new session
+                logger.debug(f"Session with {address[0]}:{address[1]} was closed, reconnecting")
+                session.shutdown()
+
+        connection = self.checkout(address)
+        if connection:
+            try:
+                response = connection.request(message, timeout)
+                self.checkin(connection)
+                return response
+            except ConnectionClosed:
+                # The peer dropped it while it sat idle; a new connection gets the message there
+                logger.debug(f"Pooled connection to {address[0]}:{address[1]} was closed, reconnecting")
+                connection.close()
+            except Exception:
+                connection.close()
+                raise
+
+        connection = self.connect(address, timeout)
+        if connection is None:
+            return self.request_once(address, message, timeout)
+        if isinstance(connection, Session):
+            return connection.request(message, timeout)
+        try:
+            response = connection.request(message, timeout)
+        except Exception:
+            connection.close()
+            raise
+        self.checkin(connection)
+        return response
+
+    def request_once(self, address, message, timeout):
+        """Send a message as bare JSON over a connection of its own, as older peers expect"""
+        sock = socket.create_connection(address, timeout)
+        try:
+            sock.sendall(json.dumps(message).encode())
+            try:
+                return protocol.read_json(sock)
+            except ConnectionClosed:
+                return None  # the peer had nothing to say
+        finally:
+            sock.close()
+
+    def connect(self, address, timeout):
+        """Open a session, or else a connection the peer keeps; None if it keeps neither"""
+        with self.lock:
+            connecting = self.connecting.setdefault(address, threading.Lock())
+        with connecting:
+            # Requests that raced here share the session the first of them opens
+            session = self.find_session(address)
+            if session:
+                return session
+            return self.offer_hello(address, timeout)
+
+    def offer_hello(self, address, timeout):
+        connection = PeerConnection(address, timeout)
+        hello = {'type': CONNECTION_HELLO, 'codecs': [codec.NAME], 'mux': MUX_VERSION}
+        token = None
+        if self.network.server_socket:
+            # Where the peer can reach us, and the token it asks about there to make sure
+            token = secrets.token_hex(16)
+            hello['port'] = self.network.server_socket.getsockname()[1]
+            hello['token'] = token
+            with self.lock:
+                self.opened[token] = None
+        try:
+            response = connection.request(hello, timeout)
+        except (ConnectionClosed, ProtocolError):
+            response = None
+        except Exception:
+            connection.close()
+            self.forget_token(token)
+            raise
+        if isinstance(response, dict) and response.get('type') == CONNECTION_HELLO_ACK:
+            if response.get('codec') == codec.NAME:
+                connection.frame_type = protocol.FRAME_BINARY
+            if response.get('mux') == MUX_VERSION:
+                session = self.start_session(connection.sock, True, connection.frame_type)
+                session.start()
+                if token:
+                    with self.lock:
+                        self.opened[token] = session
+                self.adopt(address, session)
+                return session
+            self.forget_token(token)
+            return connection
+
+        # An older peer can't parse the frame and closes the connection
+        self.forget_token(token)
+        connection.close()
+        logger.info(f"{address[0]}:{address[1]} doesn't keep connections open, using one per message")
+        self.unpooled[address] = time.monotonic()
+        return None
+
+    def start_session(self, sock, opener, frame_type):
+        return ThreadedSession(sock, opener, frame_type, self.network.app_controller.process_message,
+                               self.workers, PERSISTENT_TIMEOUT)
+
+    def forget_token(self, token):
+        if token:
+            with self.lock:
+                self.opened.pop(token, None)
+
+    def accept_hello(self, hello):
+        """A server's answer to a hello, the frame type the rest of the connection uses and whether it becomes a session"""
+        ack = {'type': CONNECTION_HELLO_ACK, 'status': 'ready'}
+        frame_type = protocol.FRAME_JSON
+        if codec.NAME in hello.get('codecs', ()):
+            ack['codec'] = codec.NAME
+            frame_type = protocol.FRAME_BINARY
+        multiplexed = hello.get('mux') == MUX_VERSION
+        if multiplexed:
+            ack['mux'] = MUX_VERSION
+        token = hello.get('verify')
+        if isinstance(token, str):
+            # A peer we offered a session checking that it was us
+            with self.lock:
+                ack['verified'] = token in self.opened
+        return ack, frame_type, multiplexed
+
+    def accept_session(self, sock, frame_type, hello, address):
+        """Turn a connection the threaded server accepted into a session; the caller runs its read loop"""
+        session = self.start_session(sock, False, frame_type)
+        session.start(read_in_thread=False)
+        self.adopt_accepted(session, hello, address)
+        return session
+
+    def adopt_accepted(self, session, hello, address):
+        """Keep a session a peer opened; it carries our messages to the peer once the port it named checks out"""
+        # Until then it is known by the connection's own address, which nothing sends to
+        self.adopt(address, session)
+        port, token = hello.get('port'), hello.get('token')
+        if isinstance(port, int) and isinstance(token, str):
+            try:
+                self.workers.submit(self.verify, session, address, (address[0], port), token)
+            except RuntimeError:
+                pass  # shutting down
+
+    def verify(self, session, address, claimed, token):
+        """Move an accepted session to the address its hello named if the peer listening there opened it"""
+        try:
+            connection = PeerConnection(claimed, VERIFY_TIMEOUT)
+            try:
+                response = connection.request({'type': CONNECTION_HELLO, 'verify': token}, VERIFY_TIMEOUT)
+            finally:
+                connection.close()
+        except (OSError, ProtocolError, ValueError) as e:
+            logger.debug(f"Could not check {claimed[0]}:{claimed[1]} for a session: {e}")
+            return
+        if not (isinstance(response, dict) and response.get('verified') is True):
+            logger.warning(f"Session from {address[0]}:{address[1]} named port {claimed[1]}, "
+                           f"which didn't open it; not using it for messages there")
+            return
+        with self.lock:
+            sessions = self.sessions.get(address, [])
+            if session not in sessions or session.closed:
+                return
+            sessions.remove(session)
+            if not sessions:
+                del self.sessions[address]
+            self.sessions.setdefault(claimed, []).append(session)
+
+    def find_session(self, address):
+        with self.lock:
+            for session in self.sessions.get(address, ()):
+                if not session.closed:
+                    return session
+            return None
+
+    def adopt(self, address, session):
+        """Keep a session for messages to a peer, and close it once it goes quiet"""
+        with self.lock:
+            if not self.running:
+                session.shutdown()
+                return
+            # Only one is used unless both peers connected at once; the
+            # other then just answers its opener until it is idle
+            self.sessions.setdefault(address, []).append(session)
+            self.start_reaper()
+
+    def checkout(self, address):
+        """Take the most recently used healthy idle connection to a peer"""
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                connections = self.idle.get(address)
+                if not connections:
+                    return None
+                connection = connections.pop()
+            if now - connection.last_used < IDLE_TIMEOUT and connection.is_alive():
+                return connection
+            connection.close()
+
+    def checkin(self, connection):
+        """Keep a connection for the next message to its peer"""
+        with self.lock:
+            connections = self.idle.setdefault(connection.address, [])
+            if not self.running or len(connections) >= MAX_IDLE_PER_PEER:
+                connection.close()
+                return
+            connections.append(connection)
+            self.start_reaper()
+
+    def start_reaper(self):
+        if self.reaper is None:
+            self.reaper = threading.Thread(target=self.reap, daemon=True)
+            self.reaper.start()
+
+    def reap(self):
+        """Close connections and sessions that have sat unused too long"""
+        while self.running:
+            time.sleep(REAP_INTERVAL)
+            now = time.monotonic()
+            expired = []
+            quiet = []
+            with self.lock:
+                for address, sessions in list(self.sessions.items()):
+                    keep = [s for s in sessions if not s.closed and not s.is_idle(IDLE_TIMEOUT)]
+                    quiet.extend(s for s in sessions if s not in keep)
+                    if keep:
+                        self.sessions[address] = keep
+                    else:
+                        del self.sessions[address]
+                for token, session in list(self.opened.items()):
+                    if session and session.closed:
+                        del self.opened[token]
+                for address, connections in list(self.idle.items()):
+                    keep = [c for c in connections if now - c.last_used < IDLE_TIMEOUT]
+                    expired.extend(c for c in connections if now - c.last_used >= IDLE_TIMEOUT)
+                    if keep:
+                        self.idle[address] = keep
+                    else:
+                        del self.idle[address]
+            for connection in expired:
+                connection.close()
+            for session in quiet:
+                session.shutdown()
+
+    def close_all(self):
+        with self.lock:
+            self.running = False
+            connections = [c for cs in self.idle.values() for c in cs]
+            self.idle.clear()
+            sessions = [s for ss in self.sessions.values() for s in ss]
+            self.sessions.clear()
+            self.opened.clear()
+        for connection in connections:
+            connection.close()
+        for session in sessions:
+            session.shutdown()
+        self.workers.shutdown(wait=False)
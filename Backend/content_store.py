@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed index of the files we hold. Received files are recorded
+# under the root of their hash tree once it has been verified, so when a
+# sender offers content we already have, the copy is made locally instead of
+# over the network: a reflink where the filesystem supports it, otherwise a
+# hard link, and a plain copy only across filesystems. Entries remember each
+# file's size and mtime, and are dropped as soon as a file is found to have
+# changed or disappeared.
+
+CONTENT_INDEX_NAME = '.content_index.json'
+FICLONE = 0x40049409  # Linux ioctl that shares a file's extents with another
+
+class ContentStore:
+    def __init__(self, app_controller):
+        self.app_controller = app_controller
+        self.entries = None  # {content_hash: [{'path', 'size', 'mtime_ns'}]}, loaded on first use
+        self.lock = threading.Lock()
+
+    def index_path(self):
+        return os.path.join(self.app_controller.file_manager.get_downloads_dir(), CONTENT_INDEX_NAME)
+
+    def load(self):
+        """Read the index from disk the first time it's needed"""
+        if self.entries is not None:
+            return
+        try:
+            with open(self.index_path(), 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable content index: {e}")
+            self.entries = {}
+
+    def save(self):
+        path = self.index_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, path)
+
+    def add(self, content_hash, path):
+        """Record that a verified file holds the given content"""
+        self.add_files([(content_hash, path)])
+
+    def add_files(self, files):
+        """Record many (content_hash, path) pairs with a single write of the index"""
+        with self.lock:
+            self.load()
+            for content_hash, path in files:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                path = os.path.abspath(path)
+                holders = [h for h in self.entries.get(content_hash, []) if h['path'] != path]
+                holders.append({'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+                self.entries[content_hash] = holders
+            try:
+                self.save()
+            except OSError as e:
+                logger.warning(f"Could not save content index: {e}")
+
+    def find(self, content_hash, file_size):
+        """Return the path of an unchanged local file with this content, or None"""
+        with self.lock:
+            self.load()
+            holders = self.entries.get(content_hash, [])
+            valid = [h for h in holders if self.unchanged(h['path'], h['size'], h['mtime_ns'])]
+            if len(valid) != len(holders):
+                if valid:
+                    self.entries[content_hash] = valid
+                else:
+                    del self.entries[content_hash]
+                try:
+                    self.save()
+                except OSError as e:
+                    logger.warning(f"Could not save content index: {e}")
+        for holder in valid:
+            if holder['size'] == file_size:
+                return holder['path']
+
+        # Files we share with groups are hashed already
+        swarm = getattr(self.app_controller, 'swarm', None)
+        if swarm:
+            with swarm.content_lock:
+                entry = swarm.local_content.get(content_hash)
+                entry = dict(entry) if entry else None
+            if entry and entry['file_size'] == file_size:
+                try:
+                    stat = os.stat(entry['path'])
+                except OSError:
+                    return None
+                if stat.st_size == file_size and stat.st_mtime == entry['mtime']:
+                    return entry['path']
+        return None
+
+    @staticmethod
+    def unchanged(path, size, mtime_ns):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_size == size and stat.st_mtime_ns == mtime_ns
+
+    @staticmethod
+    def place(source, save_path):
+        """Fill save_path with the content of source, sharing storage where possible; returns how"""
+        temp_path = f"{save_path}.link"
+        if fcntl:
+            try:
+                with open(source, 'rb') as src, open(temp_path, 'wb') as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                os.replace(temp_path, save_path)
+                return 'reflink'
+            except OSError:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        try:
+            os.link(source, temp_path)
+            os.replace(temp_path, save_path)
+            return 'hardlink'
+        except OSError:
+            # Different filesystems, or links aren't supported; this still saves the network transfer
+            pass
+        shutil.copyfile(source, temp_path)
+        os.replace(temp_path, save_path)
+        return 'copy'
@@ -0,0 +1,122 @@
+import hashlib
+import math
+import struct
+import zlib
+
+# rsync-style delta encoding. The receiver describes the copy it already has
+# as per-block weak (adler32) and strong (md5) checksums; the sender slides a
+# window over its file and replaces every block the receiver already holds
+# with a reference, so only the changed bytes travel over the network.
+
+ADLER_MOD = 65521
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+MAX_LITERAL_SIZE = 1024 * 1024
+SIGNATURE_ENTRY = struct.Struct('>I16s')  # weak checksum, strong checksum
+
+def choose_block_size(file_size):
+    """Pick a power-of-two block size near the square root of the file size"""
+    if file_size <= 0:
+        return MIN_BLOCK_SIZE
+    block_size = 1 << round(math.log2(math.sqrt(file_size)))
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+def compute_signatures(f, block_size):
+    """Compute the packed weak/strong checksums of every block of a file"""
+    signatures = bytearray()
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        signatures += SIGNATURE_ENTRY.pack(zlib.adler32(block), hashlib.md5(block).digest())
+    return bytes(signatures)
+
+def parse_signatures(data):
+    """Build a {weak: {strong: block_index}} lookup table from packed signatures"""
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE_ENTRY.iter_unpack(data)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+def generate_delta(f, table, block_size):
+    """Yield ('copy', first_block, count) and ('literal', data) operations rebuilding f"""
+    buf = bytearray()
+    pos = 0              # start of the current window in buf
+    literal_start = 0    # start of data not yet emitted
+    eof = False
+    a = b = None         # rolling adler32 state for buf[pos:pos + block_size]
+    copy_run = None      # [first_block, count] of consecutive copies
+
+    while True:
+        # Keep at least one full window (plus the next byte for rolling) buffered
+        if len(buf) - pos <= block_size and not eof:
+            del buf[:literal_start]
+            pos -= literal_start
+            literal_start = 0
+            chunk = f.read(READ_SIZE)
+            if chunk:
+                buf += chunk
+            else:
+                eof = True
+            continue
+
+        window_len = min(block_size, len(buf) - pos)
+        if window_len == 0:
+            break
+
+        if a is None or window_len < block_size:
+            weak = zlib.adler32(buf[pos:pos + window_len])
+            a, b = weak & 0xffff, weak >> 16
+        else:
+            weak = (b << 16) | a
+
+        match = None
+        candidates = table.get(weak)
+        if candidates:
+            match = candidates.get(hashlib.md5(buf[pos:pos + window_len]).digest())
+
+        if match is not None:
+            if literal_start < pos:
+                if copy_run:
+                    yield ('copy', *copy_run)
+                    copy_run = None
+                yield ('literal', bytes(buf[literal_start:pos]))
+            if copy_run and copy_run[0] + copy_run[1] == match:
+                copy_run[1] += 1
+            else:
+                if copy_run:
+                    yield ('copy', *copy_run)
+                copy_run = [match, 1]
+            pos += window_len
+            literal_start = pos
+            a = b = None
+            continue
+
+        if window_len < block_size:
+            # Only a short tail is left and it matched nothing
+            break
+
+        # Slide the window one byte, updating the checksum in place
+        if pos + block_size >= len(buf):
+            if eof:
+                break
+            continue
+        out_byte = buf[pos]
+        in_byte = buf[pos + block_size]
+        a = (a - out_byte + in_byte) % ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        pos += 1
+
+        # Don't let unmatched data pile up in memory
+        if pos - literal_start >= MAX_LITERAL_SIZE:
+            if copy_run:
+                yield ('copy', *copy_run)
+                copy_run = None
+            yield ('literal', bytes(buf[literal_start:pos]))
+            literal_start = pos
+
+    if copy_run:
+        yield ('copy', *copy_run)
+    if literal_start < len(buf):
+        yield ('literal', bytes(buf[literal_start:]))
@@ -0,0 +1,74 @@
+import errno
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Allocation and page cache hints for files being received. Space for the
+# whole file is reserved before the first byte arrives so large files end
+# up in few extents, and data that is safely on disk is dropped from the
+# page cache so a multi-GB receive doesn't push everything else out of it.
+# Senders that use sendfile ask for the next frame to be read ahead while
+# the current one goes out. All of this is best effort: where the calls
+# don't exist (Windows, macOS) or the filesystem doesn't support them,
+# files are read and written as before.
+
+PREALLOCATE_MIN_SIZE = 1024 * 1024  # smaller files don't fragment noticeably
+
+def preallocate(f, size):
+    """Reserve disk space for a file of size bytes; returns False if nothing was reserved"""
+    if size < PREALLOCATE_MIN_SIZE or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+        return True
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise OSError(e.errno, f"Not enough disk space for {size} bytes") from e
+        # Some filesystems can't preallocate; the file just grows as it's written
+        logger.debug(f"Could not preallocate {size} bytes: {e}")
+        return False
+
+def advise_sequential(f):
+    """Tell the kernel a file will be accessed front to back"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+def release_cache(f, offset=0, length=0):
+    """Drop file data that is already on disk from the page cache (length 0 means to the end)"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+def commit(f):
+    """Flush a file all the way to disk"""
+    f.flush()
+    os.fsync(f.fileno())
+
+def sync_directory(path):
+    """Make a rename into a directory durable"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def prefetch(f, offset, length):
+    """Start reading part of a file into the page cache in the background"""
+    if length > 0 and hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
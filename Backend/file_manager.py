@@ -5,32 +5,200 @@ from datetime import datetime
 import logging
 import socket
 import json
+import struct
+import threading
+import time
+import uuid
+import zlib
+from Backend import bandwidth
+from Backend import compression
+from Backend.chunk_sizer import ChunkSizer
+from Backend import delta
+from Backend import disk_io
+from Backend import integrity
+from Backend import protocol
+from Backend.frame_reader import FrameReader
+from Backend.read_pipeline import AdaptiveReader
+from Backend import transfer_events
+from Backend.transfer_events import MonitoredShare, TransferCancelled, TransferMonitor
+from Backend.utils import get_group_download_dir
 
 logger = logging.getLogger(__name__)
 
+# Transfer modes negotiated in the file_transfer_start header
+TRANSFER_MODE_FRAMED = 'framed'      # 4-byte length prefix, 8 KB chunks
+TRANSFER_MODE_SENDFILE = 'sendfile'  # 8-byte length prefix, large zero-copy frames
+
+FRAMED_CHUNK_SIZE = 8192  # used when the frame size isn't being tuned
+FRAMED_HEADER = struct.Struct('>I')
+SENDFILE_FRAME_SIZE = 16 * 1024 * 1024
+LARGE_FRAME_HEADER = struct.Struct('>Q')
+RECEIVE_BUFFER_SIZE = 1024 * 1024
+
+# Resumable transfers: partial files and their journals live next to the downloads
+PARTIAL_DIR_NAME = '.partial'
+CHECKPOINT_INTERVAL = 32 * 1024 * 1024
+MAX_TRANSFER_ATTEMPTS = 6
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+# Striped transfers: large files are split into segments sent over parallel connections
+STRIPE_MIN_FILE_SIZE = 64 * 1024 * 1024
+STRIPE_SEGMENT_SIZE = 32 * 1024 * 1024
+STRIPE_HEADER = struct.Struct('>QQ')  # segment offset, segment length
+STRIPE_SEND_SIZE = 4 * 1024 * 1024
+INITIAL_STRIPES = 2
+MAX_STRIPES = 8
+STRIPE_PROBE_INTERVAL = 1.0
+STRIPE_GROWTH_THRESHOLD = 1.1
+STRIPE_IDLE_TIMEOUT = 60
+
+# Delta transfers: the sender only ships data the receiver's existing copy lacks
+DELTA_OP = struct.Struct('>BQQ')  # op, then a length or first block and block count
+DELTA_OP_END = 0
+DELTA_OP_LITERAL = 1
+DELTA_OP_COPY = 2
+DELTA_OP_SIGNATURES = 3
+DELTA_OP_HASH = 4  # chunk index, followed by the chunk digest
+
+# Integrity checks: chunks that fail verification are re-sent, a few times at most
+MAX_REPAIR_ROUNDS = 3
+
+# Compressed transfers read the file in userspace, so use moderately large chunks
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+
+# Batched sessions send a manifest, then every file as a header, its data and its hash
+BATCH_FILE_HEADER = struct.Struct('>IQ')  # file index, file size
+BATCH_END_INDEX = 0xFFFFFFFF
+BATCH_COALESCE_SIZE = 256 * 1024  # files smaller than this are read and sent together
+BATCH_SEND_BUFFER = 1024 * 1024
+PROGRESS_INTERVAL = 0.25  # seconds between progress reports
+
+# Session entries that only make sense inside FileManager
+INTERNAL_SESSION_KEYS = (
+    'file', 'on_complete', 'lock', 'decompressor', 'bandwidth_share',
+    'hasher', 'leaves', 'expected_leaves', 'leaves_saved', 'monitor'
+)
+
 class FileManager:
     def __init__(self, app_controller):
         self.app_controller = app_controller
         self.pending_file_requests = {}  # {request_id: file_info}
-        self.current_file_transfer = None
+        self.transfer_sessions = {}  # {request_id: session} for incoming transfers
+        self.batch_progress = {}  # {request_id: progress} kept so a retried batch skips finished files
+        self.transfer_monitors = {}  # {request_id: TransferMonitor} for transfers in either direction
+        self.cancelled_requests = set()  # refused if the sender retries them
+        self.sessions_lock = threading.Lock()
+    
+    def new_request_id(self, file_name):
+        """Generate a unique request ID"""
+        # The uuid keeps IDs distinct for the same file requested twice within one clock tick
+        return hashlib.md5(
+            f"{self.app_controller.current_user.username}_{file_name}_{datetime.now().isoformat()}_{uuid.uuid4()}".encode()
+        ).hexdigest()
+    
+    def monitor_transfer(self, request_id, file_name=None, total=0, direction=None, peer=None):
+        """Get the progress monitor of a transfer, creating it if the transfer hasn't started yet"""
+        with self.sessions_lock:
+            monitor = self.transfer_monitors.get(request_id)
+            if monitor is None:
+                monitor = self.transfer_monitors[request_id] = TransferMonitor(
+                    request_id, file_name, total, direction, peer
+                )
+            elif direction:
+                # A listener may have subscribed before the details were known
+                monitor.file_name, monitor.total, monitor.direction, monitor.peer = file_name, total, direction, peer
+            if request_id in self.cancelled_requests:
+                monitor.token.cancel()
+        return monitor
+    
+    def watch_transfer(self, request_id, on_progress):
+        """Call on_progress(event) with bytes done, total, rate, average rate and ETA as a transfer moves"""
+        monitor = self.monitor_transfer(request_id)
+        monitor.subscribe(on_progress)
+        return monitor.token
+    
+    def cancel_transfer(self, request_id, notify=True):
+        """Stop a transfer in either direction; its send or receive loop gives up within one frame"""
+        peer = self.get_transfer_peer(request_id)
+        with self.sessions_lock:
+            self.cancelled_requests.add(request_id)
+            monitor = self.transfer_monitors.pop(request_id, None)
+        if monitor:
+            # Loops still holding the monitor see the token; the final event goes out now,
+            # even if the transfer was between attempts or not started yet
+            monitor.token.cancel()
+            monitor.finish(transfer_events.CANCELLED)
+        logger.info(f"Cancelling transfer {request_id}")
         
+        # Tell the other side, so it stops now rather than when it next talks to us
+        if notify and peer in self.app_controller.users:
+            threading.Thread(target=self.send_transfer_cancel, args=(peer, request_id), daemon=True).start()
+    
+    def get_transfer_peer(self, request_id):
+        """Username of the other side of a transfer"""
+        monitor = self.transfer_monitors.get(request_id)
+        if monitor and monitor.peer:
+            return monitor.peer
+        file_info = self.pending_file_requests.get(request_id)
+        if file_info:
+            return file_info.get('peer') or file_info.get('sender')
+        session = self.transfer_sessions.get(request_id)
+        return session['sender'] if session else None
+    
+    def send_transfer_cancel(self, peer, request_id):
+        try:
+            self.app_controller.network.send_message(self.app_controller.users[peer], {
+                'type': 'transfer_cancel',
+                'request_id': request_id,
+                'sender': self.app_controller.current_user.username,
+                'timestamp': datetime.now().isoformat()
+            })
+        except Exception as e:
+            logger.warning(f"Could not tell {peer} about the cancelled transfer: {e}")
+    
+    def handle_transfer_cancel(self, message):
+        """Stop a transfer the peer on the other end cancelled"""
+        request_id = message.get('request_id')
+        if self.get_transfer_peer(request_id) != message.get('sender'):
+            return {'status': 'error', 'message': 'No such transfer'}
+        self.cancel_transfer(request_id, notify=False)
+        return {'status': 'cancelled'}
+    
+    def finish_monitor(self, request_id, state, error=None):
+        """Send a transfer's final event; failed receives stay watched in case the sender retries"""
+        with self.sessions_lock:
+            monitor = self.transfer_monitors.get(request_id)
+            if monitor and not (state == transfer_events.FAILED and monitor.direction == transfer_events.RECEIVE):
+                del self.transfer_monitors[request_id]
+        if monitor:
+            monitor.finish(state, error)
+    
     def create_file_request(self, file_path, peer):
         """Create a file transfer request"""
         file_name = os.path.basename(file_path)
         file_size = os.path.getsize(file_path)
-        
-        # Generate unique request ID
-        request_id = hashlib.md5(
-            f"{self.app_controller.current_user.username}_{file_name}_{datetime.now().isoformat()}".encode()
-        ).hexdigest()
+        request_id = self.new_request_id(file_name)
+        # Receivers that already hold this content copy it locally instead.
+        # Hashing a large file takes a while, so only a cached hash goes out
+        # with the request; otherwise the file is hashed while the receiver
+        # decides, and the hash goes with file_transfer_start
+        cached = self.app_controller.hash_cache.lookup(os.stat(file_path))
+        content_hash = cached[0] if cached else None
         
         # Store file info for later transfer
-        self.pending_file_requests[request_id] = {
+        file_info = {
             'file_path': file_path,
             'file_name': file_name,
             'file_size': file_size,
+            'file_mtime': os.path.getmtime(file_path),
+            'content_hash': content_hash,
             'peer': peer.username
         }
+        if not cached:
+            file_info['hashed'] = threading.Event()
+            threading.Thread(target=self.hash_pending_file, args=(file_info,), daemon=True).start()
+        self.pending_file_requests[request_id] = file_info
         
         return {
             'type': 'file_send_request',
@@ -38,55 +206,532 @@ class FileManager:
             'sender': self.app_controller.current_user.username,
             'file_name': file_name,
             'file_size': file_size,
+            'content_hash': content_hash,
             'timestamp': datetime.now().isoformat()
         }
     
+    def hash_pending_file(self, file_info):
+        """Work out the content hash of a file waiting for the receiver to accept it"""
+        try:
+            file_info['content_hash'], _ = self.app_controller.hash_cache.hash_file(file_info['file_path'])
+        except Exception as e:
+            logger.warning(f"Could not hash {file_info['file_name']}, sending it without a content hash: {e}")
+        finally:
+            file_info['hashed'].set()
+    
+    def create_batch_request(self, file_paths, peer, base_dir):
+        """Create one request for many files, sent together over a single connection"""
+        folder_name = os.path.basename(os.path.normpath(base_dir)) or 'files'
+        files = self.describe_batch_files(file_paths, base_dir)
+        total_size = sum(entry['size'] for entry in files)
+        request_id = self.new_request_id(folder_name)
+        
+        self.pending_file_requests[request_id] = {
+            'batch': True,
+            'files': files,
+            'file_name': folder_name,
+            'file_size': total_size,
+            'file_count': len(files),
+            'peer': peer.username
+        }
+        
+        return {
+            'type': 'file_send_request',
+            'request_id': request_id,
+            'sender': self.app_controller.current_user.username,
+            'file_name': folder_name,
+            'file_size': total_size,
+            'file_count': len(files),
+            'batch': True,
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    def create_directory_request(self, directory, peer):
+        """Create a batch request for every file under a directory"""
+        file_paths = self.list_directory_files(directory)
+        if not file_paths:
+            raise Exception("Directory has no files to send")
+        return self.create_batch_request(file_paths, peer, directory)
+    
+    @staticmethod
+    def list_directory_files(directory):
+        """All files under a directory, in a stable order"""
+        file_paths = []
+        for dir_path, dir_names, file_names in os.walk(directory):
+            dir_names.sort()
+            file_paths.extend(os.path.join(dir_path, file_name) for file_name in sorted(file_names))
+        return file_paths
+    
+    @staticmethod
+    def describe_batch_files(file_paths, base_dir):
+        """Batch entries for files, named relative to base_dir"""
+        return [
+            {
+                'path': path,
+                'name': os.path.relpath(path, base_dir).replace(os.sep, '/'),
+                'size': os.path.getsize(path)
+            }
+            for path in file_paths
+        ]
+    
+    @staticmethod
+    def get_downloads_dir():
+        """Get the directory received files are saved to"""
+        return os.path.join(os.path.expanduser("~"), "Downloads", "P2P_Files")
+    
+    @staticmethod
+    def get_transfer_key(message):
+        """Identify a file across retries and new requests for the same content"""
+        return hashlib.md5(
+            f"{message['sender']}_{message['file_name']}_{message['file_size']}_{message.get('source_mtime')}".encode()
+        ).hexdigest()
+    
     def handle_file_transfer_start(self, message):
         """Handle the start of a file transfer"""
+        request_id = message.get('request_id')
         sender = message['sender']
         file_name = message['file_name']
         file_size = message['file_size']
+        transfer_key = self.get_transfer_key(message)
+        
+        if request_id in self.cancelled_requests:
+            return {'status': 'cancelled', 'message': 'Transfer was cancelled'}
+        
+        if message.get('content_hash'):
+            existing = self.receive_from_store(message)
+            if existing:
+                return existing
         
         try:
-            # Create downloads directory if it doesn't exist
-            downloads_dir = os.path.join(os.path.expanduser("~"), "Downloads", "P2P_Files")
-            os.makedirs(downloads_dir, exist_ok=True)
+            with self.sessions_lock:
+                # A retry can arrive before the dead connection of the previous
+                # attempt has timed out; tell the sender to back off
+                if request_id in self.transfer_sessions or any(
+                    s and s['transfer_key'] == transfer_key for s in self.transfer_sessions.values()
+                ):
+                    return {'status': 'busy', 'message': 'Transfer already in progress'}
+                # Reserve the slot so a duplicate start can't race us
+                self.transfer_sessions[request_id] = None
             
-            # Generate unique filename to avoid conflicts
-            base_name, ext = os.path.splitext(file_name)
-            counter = 1
-            save_path = os.path.join(downloads_dir, file_name)
+            # Data goes to a .part file and is only moved into the downloads
+            # directory once complete, so an interrupted transfer can resume
+            downloads_dir = self.get_downloads_dir()
+            partial_dir = os.path.join(downloads_dir, PARTIAL_DIR_NAME)
+            os.makedirs(partial_dir, exist_ok=True)
+            part_path = os.path.join(partial_dir, f"{transfer_key}.part")
+            journal_path = os.path.join(partial_dir, f"{transfer_key}.journal")
+            leaves_path = os.path.join(partial_dir, f"{transfer_key}.leaves")
             
-            while os.path.exists(save_path):
-                save_path = os.path.join(downloads_dir, f"{base_name}_{counter}{ext}")
-                counter += 1
+            checkpoint = None
+            if message.get('resume_supported') and not message.get('restart'):
+                checkpoint = self.load_checkpoint(journal_path, part_path)
+            
+            # Large files from capable senders arrive over several connections.
+            # A sequential checkpoint is resumed sequentially and vice versa.
+            transfer_mode = self.select_transfer_mode(message)
             
-            # Store file info for chunked receiving
-            self.current_file_transfer = {
-                'file_path': save_path,
+            # An earlier copy of the same file is the basis for a delta transfer,
+            # which beats sending everything even over many stripes
+            basis_path = self.find_delta_basis(downloads_dir, file_name)
+            use_delta = bool(
+                transfer_mode == TRANSFER_MODE_SENDFILE
+                and message.get('delta_supported')
+                and not checkpoint
+                and basis_path
+            )
+            # The sender only offers compression after sampling the file, so
+            # compressible data is sent compressed rather than striped
+            compression_choice = None
+            if transfer_mode == TRANSFER_MODE_SENDFILE and not use_delta and not (
+                checkpoint and checkpoint.get('striped')
+            ):
+                compression_choice = compression.negotiate(message.get('compression'))
+            striped = bool(
+                transfer_mode == TRANSFER_MODE_SENDFILE
+                and message.get('stripe_supported')
+                and not use_delta
+                and not compression_choice
+                and (not checkpoint or checkpoint.get('striped'))
+            )
+            if checkpoint and checkpoint.get('striped') and not striped:
+                checkpoint = None
+            
+            offset, crc = 0, 0
+            segments_done = set()
+            if checkpoint and striped:
+                f = open(part_path, 'r+b')
+                segments_done = self.ranges_to_segments(checkpoint['segments'])
+                logger.info(f"Resuming striped {file_name} from {sender} "
+                            f"with {len(segments_done)} segments already received")
+            elif checkpoint:
+                f = open(part_path, 'r+b')
+                f.seek(checkpoint['offset'])
+                f.truncate()
+                offset, crc = checkpoint['offset'], checkpoint['crc32']
+                logger.info(f"Resuming {file_name} from {sender} at byte {offset}")
+            else:
+                f = open(part_path, 'wb')
+            
+            # Reserve the whole file before writing so it isn't fragmented; the
+            # data only moves to its final name once it is complete and synced
+            preallocated = disk_io.preallocate(f, file_size)
+            if striped:
+                # Size the file up front so every stripe can write anywhere in it
+                if not preallocated:
+                    f.truncate(file_size)
+                offset = sum(
+                    min(STRIPE_SEGMENT_SIZE, file_size - index * STRIPE_SEGMENT_SIZE)
+                    for index in segments_done
+                )
+            else:
+                disk_io.advise_sequential(f)
+
+            # Chunks are hashed as they're written and checked against the
+            # sender's hashes; on resume our hashes of the data we already
+            # have come from the leaves file instead of a re-read
+            integrity_choice = None
+            if transfer_mode == TRANSFER_MODE_SENDFILE:
+                integrity_choice = integrity.negotiate(message.get('integrity'))
+            leaves = {}
+            hasher = None
+            if integrity_choice:
+                if not checkpoint:
+                    self.remove_file(leaves_path)
+                elif striped:
+                    per_segment = STRIPE_SEGMENT_SIZE // integrity.MERKLE_CHUNK_SIZE
+                    leaves = self.load_leaves(leaves_path, (
+                        index * per_segment + chunk
+                        for index in segments_done for chunk in range(per_segment)
+                    ))
+                else:
+                    leaves = self.load_leaves(leaves_path, range(offset // integrity.MERKLE_CHUNK_SIZE))
+                
+                if not striped:
+                    # Stripes hash their own segments; a sequential transfer
+                    # continues hashing the chunk it was interrupted in
+                    chunk_start = offset - offset % integrity.MERKLE_CHUNK_SIZE
+                    hasher = integrity.ChunkHasher(chunk_start)
+                    if chunk_start < offset:
+                        f.seek(chunk_start)
+                        hasher.update(f.read(offset - chunk_start))
+            
+            monitor = self.monitor_transfer(request_id, file_name, file_size, transfer_events.RECEIVE, sender)
+            monitor.start(offset)
+            
+            # Per-transfer state used by receive_file_chunks
+            session = {
+                'request_id': request_id,
+                'transfer_key': transfer_key,
+                'file_path': part_path,
+                'part_path': part_path,
+                'journal_path': journal_path,
+                'leaves_path': leaves_path,
+                'downloads_dir': downloads_dir,
                 'file_name': file_name,
                 'file_size': file_size,
                 'sender': sender,
-                'bytes_received': 0
+                'bytes_received': offset,
+                'resume_offset': 0 if striped else offset,
+                'checkpoint_offset': offset,
+                'crc32': crc,
+                'transfer_mode': transfer_mode,
+                'striped': striped,
+                'segments_done': segments_done,
+                'delta_basis': basis_path if use_delta else None,
+                'delta_block_size': delta.choose_block_size(os.path.getsize(basis_path)) if use_delta else None,
+                'compression': compression_choice,
+                'decompressor': compression.get_decompressor(compression_choice['codec']) if compression_choice else None,
+                'wire_bytes': 0,
+                'cpu_time': 0.0,
+                'integrity': integrity_choice,
+                'hasher': hasher,
+                'leaves': leaves,
+                'leaves_saved': set(leaves),
+                'expected_leaves': {},
+                'merkle_root': None,
+                'last_activity': time.time(),
+                'monitor': monitor,
+                'bandwidth_share': MonitoredShare(
+                    self.app_controller.network.bandwidth.open_share(sender, bandwidth.DOWNLOAD), monitor
+                ),
+                'lock': threading.Lock(),
+                'file': f,
+                'on_complete': self.app_controller.on_file_received
             }
+            with self.sessions_lock:
+                self.transfer_sessions[request_id] = session
             
-            return {'status': 'ready', 'message': 'Ready to receive file'}
-            
+            return {
+                'status': 'ready',
+                'message': 'Ready to receive file',
+                'transfer_mode': transfer_mode,
+                'resume_offset': session['resume_offset'],
+                'resume_crc': crc,
+                'striped': striped,
+                'stripe_segment_size': STRIPE_SEGMENT_SIZE,
+                'resume_segments': self.segments_to_ranges(segments_done),
+                'delta': use_delta,
+                'delta_block_size': session['delta_block_size'],
+                'compression': compression_choice,
+                'integrity': integrity_choice
+            }
+        
         except Exception as e:
+            with self.sessions_lock:
+                self.transfer_sessions.pop(request_id, None)
             logger.error(f"Error preparing for file transfer: {e}")
             return {'status': 'error', 'message': str(e)}
     
+    def receive_from_store(self, message):
+        """Complete a transfer from a local file with the same content, if we have one"""
+        content_store = self.app_controller.content_store
+        source = content_store.find(message['content_hash'], message['file_size'])
+        if not source:
+            return None
+        
+        try:
+            downloads_dir = self.get_downloads_dir()
+            save_path = os.path.join(downloads_dir, message['file_name'])
+            method = 'existing'
+            if not os.path.exists(save_path) or not os.path.samefile(source, save_path):
+                # Only a file under another name needs a new entry in the downloads directory
+                save_path = self.claim_save_path(downloads_dir, message['file_name'])
+                try:
+                    method = content_store.place(source, save_path)
+                except Exception:
+                    self.remove_file(save_path)
+                    raise
+                disk_io.sync_directory(downloads_dir)
+                content_store.add(message['content_hash'], save_path)
+        except Exception as e:
+            logger.warning(f"Could not reuse local copy of {message['file_name']}, receiving it instead: {e}")
+            return None
+        
+        logger.info(f"Already had {message['file_name']} from {message['sender']}, saved to {save_path} ({method})")
+        self.app_controller.on_file_received({
+            'request_id': message.get('request_id'),
+            'file_name': message['file_name'],
+            'file_size': message['file_size'],
+            'file_path': save_path,
+            'sender': message['sender'],
+            'content_hash': message['content_hash'],
+            'deduplicated': method
+        })
+        self.finish_monitor(message.get('request_id'), transfer_events.COMPLETE)
+        return {'status': 'complete', 'message': 'File already present', 'method': method}
+    
+    def get_transfer_session(self, request_id):
+        """Get the state of an incoming transfer"""
+        with self.sessions_lock:
+            return self.transfer_sessions.get(request_id)
+    
+    @staticmethod
+    def find_delta_basis(downloads_dir, file_name):
+        """The earlier copy of a file in the downloads directory, or None"""
+        # The name comes from the peer; only a plain name inside the
+        # downloads directory may be read back to it as block signatures
+        name = os.path.basename(file_name)
+        if not name:
+            return None
+        basis_path = os.path.join(downloads_dir, name)
+        real_dir = os.path.realpath(downloads_dir)
+        if os.path.commonpath([real_dir, os.path.realpath(basis_path)]) != real_dir:
+            return None
+        if not os.path.isfile(basis_path) or os.path.getsize(basis_path) == 0:
+            return None
+        return basis_path
+    
+    @staticmethod
+    def select_transfer_mode(message):
+        """Pick the best transfer mode offered by the sender"""
+        offered = message.get('transfer_modes', [])
+        if TRANSFER_MODE_SENDFILE in offered:
+            return TRANSFER_MODE_SENDFILE
+        return TRANSFER_MODE_FRAMED
+    
+    @staticmethod
+    def load_checkpoint(journal_path, part_path):
+        """Load a resume checkpoint if it still matches the partial file"""
+        try:
+            with open(journal_path, 'r') as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('striped'):
+                if checkpoint['segment_size'] != STRIPE_SEGMENT_SIZE:
+                    return None
+            elif checkpoint['offset'] > os.path.getsize(part_path):
+                return None
+            return checkpoint
+        except (OSError, ValueError, KeyError):
+            return None
+    
+    def save_checkpoint(self, session):
+        """Flush received data to disk and record how far we got"""
+        with session['lock']:
+            f = session['file']
+            disk_io.commit(f)
+            # What is on disk won't be read again, so don't let it crowd the page cache
+            if session['striped']:
+                disk_io.release_cache(f)
+            else:
+                disk_io.release_cache(f, session['checkpoint_offset'], session['bytes_received'] - session['checkpoint_offset'])
+            if session['integrity']:
+                self.save_leaves(session)
+            
+            if session['striped']:
+                # Stripes land out of order, so record which segments are complete
+                checkpoint = {
+                    'striped': True,
+                    'segment_size': STRIPE_SEGMENT_SIZE,
+                    'segments': self.segments_to_ranges(session['segments_done'])
+                }
+            else:
+                checkpoint = {
+                    'offset': session['bytes_received'],
+                    'crc32': session['crc32']
+                }
+            checkpoint.update({
+                'file_name': session['file_name'],
+                'file_size': session['file_size'],
+                'sender': session['sender'],
+                'updated_at': datetime.now().isoformat()
+            })
+            
+            # Write then rename so a crash never leaves a torn journal
+            tmp_path = session['journal_path'] + '.tmp'
+            with open(tmp_path, 'w') as journal:
+                json.dump(checkpoint, journal)
+            os.replace(tmp_path, session['journal_path'])
+            session['checkpoint_offset'] = session['bytes_received']
+    
+    @staticmethod
+    def load_leaves(leaves_path, indices):
+        """Load the saved hashes of chunks we already have"""
+        try:
+            with open(leaves_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return {}
+        
+        leaves = {}
+        missing = bytes(integrity.DIGEST_SIZE)
+        for index in indices:
+            digest = data[index * integrity.DIGEST_SIZE:(index + 1) * integrity.DIGEST_SIZE]
+            if len(digest) == integrity.DIGEST_SIZE and digest != missing:
+                leaves[index] = digest
+        return leaves
+    
+    @staticmethod
+    def save_leaves(session):
+        """Write chunk hashes computed since the last checkpoint into their slots in the leaves file"""
+        unsaved = sorted(index for index in session['leaves'] if index not in session['leaves_saved'])
+        if not unsaved:
+            return
+        
+        mode = 'r+b' if os.path.exists(session['leaves_path']) else 'wb'
+        with open(session['leaves_path'], mode) as f:
+            for index in unsaved:
+                f.seek(index * integrity.DIGEST_SIZE)
+                f.write(session['leaves'][index])
+        session['leaves_saved'].update(unsaved)
+    
+    @staticmethod
+    def remove_file(path):
+        """Delete a file if it exists"""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    
+    @staticmethod
+    def segments_to_ranges(segments):
+        """Compress a set of segment indices into [start, end) ranges"""
+        ranges = []
+        for index in sorted(segments):
+            if ranges and ranges[-1][1] == index:
+                ranges[-1][1] = index + 1
+            else:
+                ranges.append([index, index + 1])
+        return ranges
+    
+    @staticmethod
+    def ranges_to_segments(ranges):
+        """Expand [start, end) ranges back into a set of segment indices"""
+        return {index for start, end in ranges for index in range(start, end)}
+    
     def start_file_transfer(self, request_id, receiver):
-        """Start sending a file to the receiver"""
+        """Start sending a file to the receiver, resuming after dropped connections"""
         if request_id not in self.pending_file_requests:
             logger.error(f"File request {request_id} not found")
             return False
-            
+        
         file_info = self.pending_file_requests[request_id]
+        monitor = self.monitor_transfer(
+            request_id, file_info['file_name'], file_info['file_size'], transfer_events.SEND, file_info['peer']
+        )
+        if monitor.token.cancelled:
+            del self.pending_file_requests[request_id]
+            self.finish_monitor(request_id, transfer_events.CANCELLED)
+            return False
+        if file_info.get('batch'):
+            return self.retry_transfer(request_id, file_info, lambda: self.send_batch_once(request_id, file_info))
+        if 'hashed' in file_info:
+            file_info['hashed'].wait()
+        
+        try:
+            f = open(file_info['file_path'], 'rb')
+            file_info['compression_offer'] = compression.choose_compression(
+                file_info['file_path'], file_info['file_size']
+            )
+        except OSError as e:
+            logger.error(f"Error sending file: {e}")
+            self.finish_monitor(request_id, transfer_events.FAILED, e)
+            return False
+        
+        with f:
+            return self.retry_transfer(request_id, file_info, lambda: self.send_file_once(request_id, file_info, f))
+    
+    def retry_transfer(self, request_id, file_info, send_once):
+        """Call send_once until it succeeds, fails for good or runs out of attempts"""
+        for attempt in range(MAX_TRANSFER_ATTEMPTS):
+            try:
+                if send_once():
+                    # File transfer successful
+                    del self.pending_file_requests[request_id]
+                    self.finish_monitor(request_id, transfer_events.COMPLETE)
+                    return True
+                self.finish_monitor(request_id, transfer_events.FAILED)
+                return False
+            
+            except TransferCancelled as e:
+                logger.info(f"Transfer of {file_info['file_name']} cancelled")
+                self.pending_file_requests.pop(request_id, None)
+                self.finish_monitor(request_id, transfer_events.CANCELLED, e)
+                return False
+            
+            except OSError as e:
+                # Connection problems (timeouts, resets, busy receiver) are retried;
+                # the receiver tells us where to pick up again
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+                logger.warning(f"Transfer of {file_info['file_name']} interrupted ({e}), "
+                               f"retrying in {delay}s ({attempt + 1}/{MAX_TRANSFER_ATTEMPTS})")
+                time.sleep(delay)
+            
+            except Exception as e:
+                logger.error(f"Error sending file: {e}")
+                self.finish_monitor(request_id, transfer_events.FAILED, e)
+                return False
+        
+        logger.error(f"Giving up on {file_info['file_name']} after {MAX_TRANSFER_ATTEMPTS} attempts")
+        self.finish_monitor(request_id, transfer_events.FAILED, "Too many failed attempts")
+        return False
+    
+    def send_file_once(self, request_id, file_info, f, restart=False):
+        """Make one attempt at sending a file, continuing from the receiver's checkpoint"""
+        peer = self.app_controller.users[file_info['peer']]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        share = None
         
         try:
-            peer = self.app_controller.users[file_info['peer']]
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.settimeout(30)
             sock.connect((peer.ip, peer.port))
             
@@ -97,100 +742,1356 @@ class FileManager:
                 'sender': self.app_controller.current_user.username,
                 'file_name': file_info['file_name'],
                 'file_size': file_info['file_size'],
+                'source_mtime': file_info.get('file_mtime'),
+                'content_hash': file_info.get('content_hash'),
+                'transfer_modes': [TRANSFER_MODE_SENDFILE, TRANSFER_MODE_FRAMED],
+                'resume_supported': True,
+                'restart': restart,
+                'stripe_supported': file_info['file_size'] >= STRIPE_MIN_FILE_SIZE,
+                'delta_supported': True,
+                'compression': file_info.get('compression_offer'),
+                'integrity': {'algorithm': integrity.ALGORITHM, 'chunk_size': integrity.MERKLE_CHUNK_SIZE},
                 'timestamp': datetime.now().isoformat()
             }
             
-            sock.send(json.dumps(header).encode())
+            handshake_start = time.time()
+            sock.sendall(json.dumps(header).encode())
             
             # Wait for ready signal
-            response = sock.recv(1024)
-            if response:
-                response_data = json.loads(response.decode())
-                if response_data.get('status') != 'ready':
-                    raise Exception(f"Receiver not ready: {response_data.get('message', 'Unknown error')}")
-            
-            # Send file data in chunks
-            chunk_size = 8192
+            transfer_mode = TRANSFER_MODE_FRAMED
+            offset = 0
+            response_data = self.read_reply(sock, "Receiver closed the connection")
+            
+            # The handshake round trip bounds how small frames may get; the
+            # frame size starts where the last transfer to this peer ended
+            sizer = ChunkSizer(
+                self.app_controller.network.get_peer_chunk_size(peer.username),
+                rtt=time.time() - handshake_start
+            )
+            monitor = self.monitor_transfer(
+                request_id, file_info['file_name'], file_info['file_size'], transfer_events.SEND, peer.username
+            )
+            share = MonitoredShare(self.app_controller.network.bandwidth.open_share(
+                peer.username, bandwidth.UPLOAD,
+                weight=file_info.get('bandwidth_weight', 1.0), limit=file_info.get('bandwidth_limit')
+            ), monitor)
+            
+            if response_data.get('status') == 'cancelled':
+                raise TransferCancelled("Receiver cancelled the transfer")
+            if response_data.get('status') == 'complete':
+                logger.info(f"{peer.username} already had {file_info['file_name']}, nothing to send")
+                return True
+            if response_data.get('status') == 'busy':
+                raise ConnectionError("Receiver is still finishing a previous attempt")
+            if response_data.get('status') != 'ready':
+                raise Exception(f"Receiver not ready: {response_data.get('message', 'Unknown error')}")
+            # Older peers don't answer with a mode and only understand 8 KB frames
+            transfer_mode = response_data.get('transfer_mode', TRANSFER_MODE_FRAMED)
+            offset = response_data.get('resume_offset', 0)
+            
+            # Receivers that verify chunk hashes get them for the whole file
+            hasher = integrity.ChunkHasher() if response_data.get('integrity') else None
+            
+            # Make sure the receiver's partial data really is a prefix of this file.
+            # With chunk hashes the receiver finds and re-requests any mismatch itself.
+            if offset and not hasher and not self.verify_resume_point(f, offset, response_data.get('resume_crc')):
+                if restart:
+                    raise Exception("Receiver could not restart the transfer")
+                logger.warning(f"Partial copy of {file_info['file_name']} doesn't match, restarting")
+                sock.close()
+                return self.send_file_once(request_id, file_info, f, restart=True)
+            
+            if offset:
+                logger.info(f"Resuming {file_info['file_name']} at byte {offset}")
+            monitor.start(offset)
+            
+            if response_data.get('delta'):
+                self.send_file_delta(sock, f, file_info, response_data['delta_block_size'], hasher, share)
+            elif response_data.get('striped'):
+                segment_size = response_data['stripe_segment_size']
+                segments_done = self.ranges_to_segments(response_data.get('resume_segments', []))
+                monitor.start(sum(
+                    min(segment_size, file_info['file_size'] - index * segment_size) for index in segments_done
+                ))
+                if hasher:
+                    # Segments the receiver already has aren't sent again, but their hashes are
+                    for index in sorted(segments_done):
+                        start = index * segment_size
+                        end = min(start + segment_size, file_info['file_size'])
+                        segment_hasher = integrity.ChunkHasher(start, hasher.leaves)
+                        completed = self.hash_file_range(f, start, end, segment_hasher)
+                        sock.sendall(self.pack_hash_frames(completed + segment_hasher.finish()))
+                self.send_file_striped(
+                    peer, request_id, file_info, segment_size, segments_done,
+                    hasher.leaves if hasher else None, share
+                )
+                # All stripes are confirmed; tell the control connection we're done
+                sock.sendall(LARGE_FRAME_HEADER.pack(0))
+            elif response_data.get('compression'):
+                if hasher:
+                    self.send_prefix_hashes(sock, f, offset, hasher)
+                self.send_file_compressed(sock, f, file_info, offset, response_data['compression'], hasher, share)
+            elif transfer_mode == TRANSFER_MODE_SENDFILE:
+                if hasher:
+                    self.send_prefix_hashes(sock, f, offset, hasher)
+                self.send_file_sendfile(sock, f, file_info['file_size'], offset, hasher, sizer, share)
+            else:
+                f.seek(offset)
+                self.send_file_framed(sock, f, sizer, share)
+            
+            if hasher:
+                self.send_integrity_trailer(sock, file_info, hasher.leaves)
+            
+            # Wait for final confirmation, re-sending any chunks that failed verification
+            while True:
+                response_data = self.read_reply(sock, "No confirmation from receiver")
+                if response_data.get('status') != 'repair':
+                    break
+                self.send_repairs(sock, f, file_info, response_data['chunks'], share)
+            
+            if response_data.get('status') == 'received':
+                if sizer.rate is not None:
+                    self.app_controller.network.remember_peer_chunk_size(peer, sizer.size)
+                    logger.info(f"Frame size for {peer.username} settled at {self.format_file_size(sizer.size)} "
+                                f"({self.format_file_size(sizer.rate)}/s)")
+                return True
+            
+            # The receiver kept a checkpoint, so a retry continues where it stopped
+            raise ConnectionError(response_data.get('message', 'Receiver reported an error'))
+        finally:
+            if share:
+                share.close()
+            sock.close()
+    
+    def send_batch_once(self, request_id, file_info):
+        """Make one attempt at sending a batch, skipping the files the receiver already has"""
+        peer = self.app_controller.users[file_info['peer']]
+        files = file_info['files']
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        share = None
+        
+        try:
+            sock.settimeout(30)
+            sock.connect((peer.ip, peer.port))
+            
+            header = {
+                'type': 'file_batch_start',
+                'request_id': request_id,
+                'sender': self.app_controller.current_user.username,
+                'file_name': file_info['file_name'],
+                'file_size': file_info['file_size'],
+                'file_count': len(files),
+                'timestamp': datetime.now().isoformat()
+            }
+            sock.sendall(json.dumps(header).encode())
+            
+            response_data = self.read_reply(sock, "Receiver closed the connection")
+            if response_data.get('status') == 'cancelled':
+                raise TransferCancelled("Receiver cancelled the transfer")
+            if response_data.get('status') == 'busy':
+                raise ConnectionError("Receiver is still finishing a previous attempt")
+            if response_data.get('status') != 'ready':
+                raise Exception(f"Receiver not ready: {response_data.get('message', 'Unknown error')}")
+            
+            monitor = self.monitor_transfer(
+                request_id, file_info['file_name'], file_info['file_size'], transfer_events.SEND, peer.username
+            )
+            share = MonitoredShare(self.app_controller.network.bandwidth.open_share(
+                peer.username, bandwidth.UPLOAD,
+                weight=file_info.get('bandwidth_weight', 1.0), limit=file_info.get('bandwidth_limit')
+            ), monitor)
+            return self.stream_batch(sock, files, response_data.get('completed', []), share, file_info['file_name'])
+        finally:
+            if share:
+                share.close()
+            sock.close()
+    
+    def stream_batch(self, sock, files, completed, share, batch_name):
+        """Send a manifest and the files the receiver doesn't have, until it confirms them all"""
+        # The manifest goes first so the receiver can check every path up front
+        manifest = json.dumps([[entry['name'], entry['size']] for entry in files]).encode()
+        sock.sendall(LARGE_FRAME_HEADER.pack(len(manifest)) + manifest)
+        
+        completed = self.ranges_to_segments(completed)
+        if completed:
+            logger.info(f"Resuming {batch_name} with {len(completed)} of {len(files)} files already sent")
+        share.monitor.start(sum(files[index]['size'] for index in completed if index < len(files)))
+        self.send_batch_files(sock, files, [index for index in range(len(files)) if index not in completed], share)
+        
+        # Wait for final confirmation, re-sending any files that failed verification
+        while True:
+            response_data = self.read_reply(sock, "No confirmation from receiver")
+            if response_data.get('status') != 'repair':
+                break
+            corrupt = sorted(self.ranges_to_segments(response_data['files']))
+            logger.warning(f"Re-sending {len(corrupt)} corrupt files of {batch_name}")
+            self.send_batch_files(sock, files, corrupt, share)
+        
+        if response_data.get('status') == 'received':
+            return True
+        
+        # The receiver remembers finished files, so a retry only sends the rest
+        raise ConnectionError(response_data.get('message', 'Receiver reported an error'))
+
+    def send_batch_files(self, sock, files, indices, share):
+        """Stream files back to back, each framed by its index and size and followed by its hash"""
+        pending = bytearray()
+        
+        def flush():
+            if pending:
+                share.acquire(len(pending))
+                sock.sendall(pending)
+                pending.clear()
+        
+        for index in indices:
+            entry = files[index]
+            size = entry['size']
+            hasher = integrity.ChunkHasher()
+            with open(entry['path'], 'rb') as f:
+                if size < BATCH_COALESCE_SIZE:
+                    # Small files cost a few system calls each, so pack many into one send
+                    data = f.read(size)
+                    if len(data) != size:
+                        raise Exception(f"{entry['name']} changed while it was being sent")
+                    hasher.update(data)
+                    pending += BATCH_FILE_HEADER.pack(index, size)
+                    pending += data
+                    pending += self.file_root(hasher, size)
+                    share.advance(size)
+                    if len(pending) >= BATCH_SEND_BUFFER:
+                        flush()
+                    continue
+                
+                flush()
+                sock.sendall(BATCH_FILE_HEADER.pack(index, size))
+                for start in range(0, size, SENDFILE_FRAME_SIZE):
+                    length = min(SENDFILE_FRAME_SIZE, size - start)
+                    share.acquire(length)
+                    if sock.sendfile(f, start, length) != length:
+                        raise Exception(f"{entry['name']} changed while it was being sent")
+                    share.advance(length)
+                    self.hash_file_range(f, start, start + length, hasher)
+                sock.sendall(self.file_root(hasher, size))
+        
+        flush()
+        sock.sendall(BATCH_FILE_HEADER.pack(BATCH_END_INDEX, 0))
+    
+    @staticmethod
+    def file_root(hasher, file_size):
+        """Root of the hash tree of a file that was fed through hasher"""
+        hasher.finish()
+        return integrity.merkle_root([hasher.leaves[index] for index in range(integrity.chunk_count(file_size))])
+    
+    def send_file_compressed(self, sock, f, file_info, offset, compression_choice, hasher=None, share=None):
+        """Send file data through a stream compressor as large frames"""
+        compressor = compression.get_compressor(compression_choice['codec'], compression_choice['level'])
+        raw_bytes = wire_bytes = 0
+        cpu_time = 0.0
+        
+        # Slow reads are moved to another thread so they overlap compressing
+        # and sending; the empty chunk at the end flushes the compressor
+        reader = AdaptiveReader(f, offset, buffer_size=COMPRESSION_CHUNK_SIZE)
+        try:
+            while True:
+                chunk = reader.read(COMPRESSION_CHUNK_SIZE)
+                
+                cpu_start = time.thread_time()
+                if chunk:
+                    data = compressor.compress(chunk)
+                    raw_bytes += len(chunk)
+                else:
+                    data = compressor.flush()
+                cpu_time += time.thread_time() - cpu_start
+                
+                # Compressors buffer internally; never send an empty (end) frame early
+                if data:
+                    if share:
+                        share.acquire(len(data))
+                    sock.sendall(LARGE_FRAME_HEADER.pack(len(data)))
+                    sock.sendall(data)
+                    wire_bytes += len(data)
+                if share and chunk:
+                    share.advance(len(chunk))
+                if hasher:
+                    # The data is already in memory, so hash it here rather than on a second read
+                    completed = hasher.update(chunk) if chunk else hasher.finish()
+                    if completed:
+                        sock.sendall(self.pack_hash_frames(completed))
+                if not chunk:
+                    break
+        finally:
+            reader.close()
+        
+        # Send end signal (0-length frame)
+        sock.sendall(LARGE_FRAME_HEADER.pack(0))
+        
+        file_info['compression_stats'] = {
+            'codec': compression_choice['codec'],
+            'level': compression_choice['level'],
+            'raw_bytes': raw_bytes,
+            'wire_bytes': wire_bytes,
+            'ratio': wire_bytes / raw_bytes if raw_bytes else 1.0,
+            'cpu_time': cpu_time
+        }
+        logger.info(f"Sent {file_info['file_name']} with {compression_choice['codec']} "
+                    f"level {compression_choice['level']}: "
+                    f"{self.format_file_size(raw_bytes)} -> {self.format_file_size(wire_bytes)} "
+                    f"(ratio {file_info['compression_stats']['ratio']:.2f}, {cpu_time:.2f}s CPU)")
+    
+    def send_file_delta(self, sock, f, file_info, block_size, hasher=None, share=None):
+        """Send only the parts of a file missing from the receiver's existing copy"""
+        # Ask for the block signatures of the receiver's copy
+        sock.sendall(DELTA_OP.pack(DELTA_OP_SIGNATURES, 0, 0))
+        signature_size, = LARGE_FRAME_HEADER.unpack(self.recv_exact(sock, LARGE_FRAME_HEADER.size))
+        table = delta.parse_signatures(self.recv_exact(sock, signature_size))
+        
+        f.seek(0)
+        # The delta encoder reads the whole file anyway, so hash it on the way through
+        reader = integrity.HashingReader(f, hasher) if hasher else f
+        literal_bytes = 0
+        copied_blocks = 0
+        for op in delta.generate_delta(reader, table, block_size):
+            if op[0] == 'copy':
+                if share:
+                    # Copies cost no bandwidth, but a cancel should still stop them
+                    share.check()
+                    share.advance(op[2] * block_size)
+                sock.sendall(DELTA_OP.pack(DELTA_OP_COPY, op[1], op[2]))
+                copied_blocks += op[2]
+            else:
+                if share:
+                    share.acquire(len(op[1]))
+                    share.advance(len(op[1]))
+                sock.sendall(DELTA_OP.pack(DELTA_OP_LITERAL, len(op[1]), 0))
+                sock.sendall(op[1])
+                literal_bytes += len(op[1])
+            if hasher:
+                self.send_delta_hashes(sock, reader.take_completed())
+        if hasher:
+            self.send_delta_hashes(sock, reader.take_completed() + hasher.finish())
+        sock.sendall(DELTA_OP.pack(DELTA_OP_END, 0, 0))
+        
+        logger.info(f"Delta transfer of {file_info['file_name']}: sent "
+                    f"{self.format_file_size(literal_bytes + signature_size)} instead of "
+                    f"{self.format_file_size(file_info['file_size'])} "
+                    f"({copied_blocks} blocks reused)")
+    
+    def send_file_striped(self, peer, request_id, file_info, segment_size, segments_done, leaves=None, share=None):
+        """Send a file over parallel connections, adding streams while throughput keeps improving"""
+        file_size = file_info['file_size']
+        segments = [
+            (index * segment_size, min(segment_size, file_size - index * segment_size))
+            for index in range((file_size + segment_size - 1) // segment_size)
+            if index not in segments_done
+        ]
+        segments.reverse()  # pop() hands out the start of the file first
+        state = {'lock': threading.Lock(), 'bytes_sent': 0, 'stream_bytes': {}, 'errors': []}
+        
+        def next_segment():
+            with state['lock']:
+                if segments and not state['errors']:
+                    return segments.pop()
+                return None
+        
+        def stripe_worker(stream_id):
+            try:
+                self.send_stripe(peer, request_id, file_info, next_segment, state, stream_id, leaves, share)
+            except Exception as e:
+                with state['lock']:
+                    state['errors'].append(e)
+        
+        workers = []
+        
+        def add_stream():
+            worker = threading.Thread(target=stripe_worker, args=(len(workers),), daemon=True)
+            workers.append(worker)
+            worker.start()
+        
+        for _ in range(min(INITIAL_STRIPES, len(segments))):
+            add_stream()
+        
+        # Measure throughput every probe interval and add a stream as long as
+        # the last one raised it noticeably; stop growing once it plateaus
+        start_time = last_time = time.time()
+        last_bytes = 0
+        best_rate = 0
+        growing = True
+        while any(worker.is_alive() for worker in workers):
+            deadline = time.time() + STRIPE_PROBE_INTERVAL
+            for worker in workers:
+                worker.join(max(0, deadline - time.time()))
+            
+            now = time.time()
+            with state['lock']:
+                bytes_sent = state['bytes_sent']
+                remaining = len(segments)
+            rate = (bytes_sent - last_bytes) / max(now - last_time, 1e-6)
+            last_bytes, last_time = bytes_sent, now
+            
+            if growing and remaining and len(workers) < MAX_STRIPES:
+                if rate > best_rate * STRIPE_GROWTH_THRESHOLD:
+                    best_rate = rate
+                    add_stream()
+                else:
+                    growing = False
+        
+        elapsed = max(time.time() - start_time, 1e-6)
+        per_stream = ", ".join(
+            f"{self.format_file_size(sent / elapsed)}/s" for sent in state['stream_bytes'].values()
+        )
+        logger.info(f"Striped {file_info['file_name']} over {len(workers)} streams "
+                    f"({self.format_file_size(state['bytes_sent'] / elapsed)}/s total; {per_stream})")
+        
+        if state['errors']:
+            for error in state['errors']:
+                if isinstance(error, TransferCancelled):
+                    raise error
+            raise ConnectionError(f"Striped transfer failed: {state['errors'][0]}")
+    
+    def send_stripe(self, peer, request_id, file_info, next_segment, state, stream_id, leaves=None, share=None):
+        """Send segments over one stripe connection until none are left"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(30)
+            sock.connect((peer.ip, peer.port))
+            
+            header = {
+                'type': 'file_stripe',
+                'request_id': request_id,
+                'sender': self.app_controller.current_user.username
+            }
+            sock.sendall(json.dumps(header).encode())
+            
+            response_data = self.read_reply(sock, "Receiver closed the stripe connection")
+            if response_data.get('status') != 'ready':
+                raise Exception(f"Stripe rejected: {response_data.get('message', 'Unknown error')}")
+            
+            state['stream_bytes'][stream_id] = 0
             with open(file_info['file_path'], 'rb') as f:
                 while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
+                    segment = next_segment()
+                    if segment is None:
                         break
                     
-                    # Send chunk size first, then chunk data
-                    sock.send(len(chunk).to_bytes(4, byteorder='big'))
-                    sock.send(chunk)
+                    offset, length = segment
+                    sock.sendall(STRIPE_HEADER.pack(offset, length))
+                    
+                    # Send in pieces so throughput is measured smoothly
+                    hasher = integrity.ChunkHasher(offset, leaves) if leaves is not None else None
+                    completed = []
+                    end = offset + length
+                    while offset < end:
+                        count = min(STRIPE_SEND_SIZE, end - offset)
+                        if share:
+                            share.acquire(count)
+                        disk_io.prefetch(f, offset + count, min(STRIPE_SEND_SIZE, end - offset - count))
+                        if sock.sendfile(f, offset, count) != count:
+                            raise Exception("File was truncated during transfer")
+                        if share:
+                            share.advance(count)
+                        if hasher:
+                            completed += self.hash_file_range(f, offset, offset + count, hasher)
+                        offset += count
+                        with state['lock']:
+                            state['bytes_sent'] += count
+                            state['stream_bytes'][stream_id] += count
+                    
+                    if hasher:
+                        # Hashes follow their segment, flagged in the offset field
+                        sock.sendall(b''.join(
+                            STRIPE_HEADER.pack(integrity.HASH_FRAME_FLAG | index, integrity.DIGEST_SIZE) + digest
+                            for index, digest in completed + hasher.finish()
+                        ))
+            
+            # Send end signal and wait until the receiver has written everything
+            sock.sendall(STRIPE_HEADER.pack(0, 0))
+            response_data = self.read_reply(sock, "Stripe was not confirmed by the receiver")
+            if response_data.get('status') != 'received':
+                raise ConnectionError("Stripe was not confirmed by the receiver")
+        finally:
+            sock.close()
+    
+    @staticmethod
+    def verify_resume_point(f, offset, expected_crc):
+        """Check the rolling checksum of the first offset bytes of the file"""
+        f.seek(0)
+        crc = 0
+        remaining = offset
+        while remaining:
+            data = f.read(min(remaining, RECEIVE_BUFFER_SIZE))
+            if not data:
+                return False
+            crc = zlib.crc32(data, crc)
+            remaining -= len(data)
+        return crc == expected_crc
+    
+    @staticmethod
+    def hash_file_range(f, start, end, hasher):
+        """Hash part of a file that was just sent, reading it back from the page cache"""
+        completed = []
+        buf = bytearray(integrity.MERKLE_CHUNK_SIZE)
+        f.seek(start)
+        remaining = end - start
+        while remaining:
+            read = f.readinto(memoryview(buf)[:min(remaining, len(buf))])
+            if not read:
+                raise Exception("File was truncated during transfer")
+            completed += hasher.update(memoryview(buf)[:read])
+            remaining -= read
+        return completed
+    
+    @staticmethod
+    def pack_hash_frames(completed):
+        """Pack chunk hashes as flagged large frames"""
+        return b''.join(
+            LARGE_FRAME_HEADER.pack(integrity.HASH_FRAME_FLAG | integrity.HASH_RECORD.size)
+            + integrity.HASH_RECORD.pack(index, digest)
+            for index, digest in completed
+        )
+    
+    @staticmethod
+    def send_delta_hashes(sock, completed):
+        """Send chunk hashes between delta operations"""
+        if completed:
+            sock.sendall(b''.join(
+                DELTA_OP.pack(DELTA_OP_HASH, index, 0) + digest for index, digest in completed
+            ))
+    
+    def send_prefix_hashes(self, sock, f, offset, hasher):
+        """Hash the part of the file the receiver already has, streaming the hashes as we go"""
+        for start in range(0, offset, SENDFILE_FRAME_SIZE):
+            completed = self.hash_file_range(f, start, min(start + SENDFILE_FRAME_SIZE, offset), hasher)
+            if completed:
+                sock.sendall(self.pack_hash_frames(completed))
+    
+    @staticmethod
+    def send_integrity_trailer(sock, file_info, leaves):
+        """Send the root of the file's hash tree after the data"""
+        leaf_count = integrity.chunk_count(file_info['file_size'])
+        root = integrity.merkle_root([leaves[index] for index in range(leaf_count)]).hex()
+        trailer = json.dumps({'merkle_root': root, 'leaf_count': leaf_count}).encode()
+        sock.sendall(LARGE_FRAME_HEADER.pack(len(trailer)) + trailer)
+        file_info['merkle_root'] = root
+    
+    def send_repairs(self, sock, f, file_info, ranges, share=None):
+        """Re-send the chunks the receiver found corrupt"""
+        file_size = file_info['file_size']
+        leaf_count = integrity.chunk_count(file_size)
+        repaired = 0
+        for start, end in ranges:
+            for index in range(start, min(end, leaf_count)):
+                offset, length = integrity.chunk_range(index, file_size)
+                if share:
+                    share.acquire(length)
+                sock.sendall(STRIPE_HEADER.pack(offset, length))
+                if sock.sendfile(f, offset, length) != length:
+                    raise Exception("File was truncated during transfer")
+                repaired += 1
+        sock.sendall(STRIPE_HEADER.pack(0, 0))
+        logger.warning(f"Re-sent {repaired} corrupt chunks of {file_info['file_name']}")
+    
+    def send_file_framed(self, sock, f, sizer=None, share=None):
+        """Send file data as chunks with a 4-byte length prefix"""
+        # Disk reads move to their own thread if they hold up the frames going out
+        reader = AdaptiveReader(f, f.tell())
+        try:
+            while True:
+                chunk = reader.read(sizer.size if sizer else FRAMED_CHUNK_SIZE)
+                if not chunk:
+                    break
                 
-                # Send end signal (0 bytes)
-                sock.send((0).to_bytes(4, byteorder='big'))
-            
-            # Wait for final confirmation
-            response = sock.recv(1024)
-            if response:
-                response_data = json.loads(response.decode())
-                if response_data.get('status') == 'received':
-                    # File transfer successful
-                    del self.pending_file_requests[request_id]
-                    return True
+                # Send chunk size first, then chunk data. Waiting for bandwidth
+                # counts towards the send time so throttled transfers use small frames.
+                send_start = time.perf_counter()
+                if share:
+                    share.acquire(len(chunk))
+                sock.sendall(FRAMED_HEADER.pack(len(chunk)))
+                sock.sendall(chunk)
+                if share:
+                    share.advance(len(chunk))
+                if sizer:
+                    sizer.record(len(chunk), time.perf_counter() - send_start)
+        finally:
+            reader.close()
+        
+        # Send end signal (0 bytes)
+        sock.sendall(FRAMED_HEADER.pack(0))
+    
+    def send_file_sendfile(self, sock, f, file_size, offset=0, hasher=None, sizer=None, share=None):
+        """Send file data as large frames straight from the page cache"""
+        while offset < file_size:
+            frame_size = min(sizer.size if sizer else SENDFILE_FRAME_SIZE, file_size - offset)
+            send_start = time.perf_counter()
+            if share:
+                share.acquire(frame_size)
+            sock.sendall(LARGE_FRAME_HEADER.pack(frame_size))
             
+            # Have the kernel read the next frame from disk while this one is sent.
+            # socket.sendfile uses os.sendfile where available and falls back to send().
+            disk_io.prefetch(f, offset + frame_size, min(frame_size, file_size - offset - frame_size))
+            sent = sock.sendfile(f, offset, frame_size)
+            if sent != frame_size:
+                raise Exception("File was truncated during transfer")
+            if share:
+                share.advance(frame_size)
+            if sizer:
+                sizer.record(frame_size, time.perf_counter() - send_start)
+            if hasher:
+                completed = self.hash_file_range(f, offset, offset + frame_size, hasher)
+                if completed:
+                    sock.sendall(self.pack_hash_frames(completed))
+            offset += frame_size
+        
+        if hasher:
+            sock.sendall(self.pack_hash_frames(hasher.finish()))
+        
+        # Send end signal (0-length frame)
+        sock.sendall(LARGE_FRAME_HEADER.pack(0))
+    
+    @staticmethod
+    def recv_exact(sock, size):
+        """Read exactly size bytes from a socket"""
+        data = bytearray(size)
+        view = memoryview(data)
+        while view:
+            received = sock.recv_into(view)
+            if not received:
+                raise Exception("Connection lost during file transfer")
+            view = view[received:]
+        return data
+    
+    @staticmethod
+    def read_reply(sock, closed_message):
+        """Read the peer's JSON reply on a transfer connection, however many segments it arrives in"""
+        try:
+            return protocol.read_json(sock)
+        except protocol.ConnectionClosed:
+            raise ConnectionError(closed_message)
+    
+    def receive_file_chunks(self, client_socket, request_id):
+        """Receive file data in chunks"""
+        session = self.get_transfer_session(request_id)
+        if session is None:
+            logger.error(f"No transfer session for request {request_id}")
             return False
-                
+        
+        try:
+            f = session['file']
+            reader = FrameReader(client_socket, RECEIVE_BUFFER_SIZE, session['bandwidth_share'].acquire)
+            if session['delta_basis']:
+                self.receive_delta(reader, session)
+            elif session['striped']:
+                self.wait_for_stripes(reader, session)
+            elif session['transfer_mode'] == TRANSFER_MODE_SENDFILE:
+                self.receive_large_frames(reader, session)
+            else:
+                self.receive_framed_chunks(reader, session)
+            
+            if session['hasher']:
+                self.record_leaves(session, session['hasher'].finish())
+            
+            if session['bytes_received'] != session['file_size']:
+                raise Exception(f"Transfer incomplete: got {session['bytes_received']} "
+                                f"of {session['file_size']} bytes")
+            
+            if session['integrity']:
+                self.verify_integrity(reader, session)
+            
+            disk_io.commit(f)
+            disk_io.release_cache(f)
+            f.close()
+            self.finalize_received_file(session)
+            if session['merkle_root']:
+                self.app_controller.content_store.add(session['merkle_root'], session['file_path'])
+            
+            # Send final confirmation
+            response = {'status': 'received', 'message': 'File received successfully'}
+            client_socket.sendall(json.dumps(response).encode())
+            
+            # Notify whoever is waiting on this transfer
+            self.finish_monitor(request_id, transfer_events.COMPLETE)
+            file_info = {k: v for k, v in session.items() if k not in INTERNAL_SESSION_KEYS}
+            session['on_complete'](file_info)
+            
+            return True
+        
         except Exception as e:
-            logger.error(f"Error sending file: {e}")
+            # Keep what we have so the sender's retry can continue from here
+            try:
+                if not session['file'].closed:
+                    self.save_checkpoint(session)
+            except Exception as checkpoint_error:
+                logger.error(f"Could not save resume checkpoint: {checkpoint_error}")
+            
+            # A cancelled transfer may fail on a dropped connection before it sees its token
+            cancelled = isinstance(e, TransferCancelled) or session['monitor'].token.cancelled
+            self.finish_monitor(request_id, transfer_events.CANCELLED if cancelled else transfer_events.FAILED, e)
+            error_response = {'status': 'cancelled' if cancelled else 'error', 'message': str(e)}
+            try:
+                client_socket.sendall(json.dumps(error_response).encode())
+            except:
+                pass
+            logger.error(f"Error receiving file: {e}")
             return False
+        finally:
+            # Clean up
+            session['file'].close()
+            session['bandwidth_share'].close()
+            with self.sessions_lock:
+                self.transfer_sessions.pop(request_id, None)
     
-    def receive_file_chunks(self, client_socket):
-        """Receive file data in chunks"""
+    def receive_delta(self, reader, session):
+        """Rebuild a file from the existing copy plus the literal data the sender streams"""
+        block_size = session['delta_block_size']
+        
+        op, _, _ = reader.read_struct(DELTA_OP)
+        if op != DELTA_OP_SIGNATURES:
+            raise Exception("Sender did not request delta signatures")
+        
+        with open(session['delta_basis'], 'rb') as basis:
+            signatures = delta.compute_signatures(basis, block_size)
+            reader.sock.sendall(LARGE_FRAME_HEADER.pack(len(signatures)) + signatures)
+            basis_size = basis.tell()
+            block_count = len(signatures) // delta.SIGNATURE_ENTRY.size
+            
+            copy_buffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+            while True:
+                op, first, count = reader.read_struct(DELTA_OP)
+                if op == DELTA_OP_END:
+                    break
+                
+                if op == DELTA_OP_LITERAL:
+                    for data in reader.read_chunks(first):
+                        self.write_received_data(session, data)
+                
+                elif op == DELTA_OP_COPY:
+                    # Only blocks we sent signatures for can be copied
+                    if count == 0 or first + count > block_count:
+                        raise Exception(f"Delta copy of blocks {first}-{first + count} is outside the "
+                                        f"{block_count} blocks of the existing copy")
+                    basis.seek(first * block_size)
+                    # Only the file's last block may be short
+                    remaining = min(count * block_size, basis_size - first * block_size)
+                    while remaining:
+                        read = basis.readinto(copy_buffer[:min(remaining, len(copy_buffer))])
+                        if not read:
+                            raise Exception("Existing copy shrank during the delta transfer")
+                        self.write_received_data(session, copy_buffer[:read])
+                        remaining -= read
+                
+                elif op == DELTA_OP_HASH:
+                    self.record_expected_leaf(session, first, reader.read_exact(integrity.DIGEST_SIZE))
+                
+                else:
+                    raise Exception(f"Unknown delta operation {op}")
+    
+    def wait_for_stripes(self, reader, session):
+        """Hold the control connection open while stripe connections deliver the data"""
+        while True:
+            try:
+                frame_size, = reader.read_struct(LARGE_FRAME_HEADER)
+            except socket.timeout:
+                # Quiet control connections are expected as long as stripes make progress
+                session['monitor'].token.check()
+                if time.time() - session['last_activity'] > STRIPE_IDLE_TIMEOUT:
+                    raise Exception("Striped transfer stalled")
+                continue
+            
+            if frame_size == 0:
+                break
+            if not frame_size & integrity.HASH_FRAME_FLAG:
+                raise Exception("Unexpected data on striped control connection")
+            
+            # Hashes of segments received by an earlier attempt
+            self.receive_hash_frame(reader, session, frame_size)
+            session['last_activity'] = time.time()
+    
+    def receive_file_stripe(self, client_socket, message):
+        """Receive segments of a striped transfer on one of its parallel connections"""
+        session = self.get_transfer_session(message.get('request_id'))
+        if not session or not session['striped']:
+            client_socket.sendall(json.dumps(
+                {'status': 'error', 'message': 'No striped transfer in progress'}
+            ).encode())
+            return False
+        
         try:
-            file_info = self.current_file_transfer
+            client_socket.sendall(json.dumps({'status': 'ready'}).encode())
             
-            with open(file_info['file_path'], 'wb') as f:
+            # Each stripe writes through its own handle so stripes never share a file position
+            reader = FrameReader(client_socket, RECEIVE_BUFFER_SIZE, session['bandwidth_share'].acquire)
+            with open(session['part_path'], 'r+b', buffering=0) as f:
                 while True:
-                    # Read chunk size
-                    chunk_size_data = client_socket.recv(4)
-                    if not chunk_size_data:
-                        break
-                        
-                    chunk_size = int.from_bytes(chunk_size_data, byteorder='big')
-                    
-                    # If chunk size is 0, we're done
-                    if chunk_size == 0:
+                    offset, length = reader.read_struct(STRIPE_HEADER)
+                    if length == 0:
                         break
+                    if offset & integrity.HASH_FRAME_FLAG:
+                        self.record_expected_leaf(
+                            session, offset & ~integrity.HASH_FRAME_FLAG, reader.read_exact(length)
+                        )
+                        continue
+                    if offset % STRIPE_SEGMENT_SIZE or offset + length > session['file_size']:
+                        raise Exception(f"Invalid stripe segment at {offset}")
                     
-                    # Read chunk data
-                    chunk_data = b''
-                    while len(chunk_data) < chunk_size:
-                        remaining = chunk_size - len(chunk_data)
-                        data = client_socket.recv(remaining)
-                        if not data:
-                            raise Exception("Connection lost during file transfer")
-                        chunk_data += data
+                    hasher = integrity.ChunkHasher(offset) if session['integrity'] else None
+                    position = offset
+                    for data in reader.read_chunks(length):
+                        self.write_at(f, data, position)
+                        if hasher:
+                            self.record_leaves(session, hasher.update(data))
+                        session['bandwidth_share'].advance(len(data))
+                        position += len(data)
+                        session['last_activity'] = time.time()
                     
-                    # Write chunk to file
-                    f.write(chunk_data)
-                    file_info['bytes_received'] += len(chunk_data)
+                    if hasher:
+                        self.record_leaves(session, hasher.finish())
+                    self.complete_segment(session, offset, length)
             
-            # Send final confirmation
-            response = {'status': 'received', 'message': 'File received successfully'}
-            client_socket.send(json.dumps(response).encode())
+            client_socket.sendall(json.dumps({'status': 'received'}).encode())
+            return True
+        
+        except Exception as e:
+            logger.error(f"Error receiving file stripe: {e}")
+            try:
+                client_socket.sendall(json.dumps({'status': 'error', 'message': str(e)}).encode())
+            except:
+                pass
+            return False
+    
+    def receive_file_batch(self, client_socket, message):
+        """Receive a batch of files sent over one connection"""
+        request_id = message.get('request_id')
+        sender = message['sender']
+        
+        with self.sessions_lock:
+            if request_id in self.cancelled_requests:
+                client_socket.sendall(json.dumps({'status': 'cancelled', 'message': 'Transfer was cancelled'}).encode())
+                return False
+            if request_id in self.transfer_sessions:
+                client_socket.sendall(json.dumps({'status': 'busy', 'message': 'Transfer already in progress'}).encode())
+                return False
+            self.transfer_sessions[request_id] = None
+            progress = self.batch_progress.pop(request_id, None)
+        
+        share = None
+        try:
+            if progress is None:
+                downloads_dir = self.get_downloads_dir()
+                os.makedirs(downloads_dir, exist_ok=True)
+                progress = self.new_batch_progress(
+                    self.claim_save_dir(downloads_dir, os.path.basename(message['file_name']) or 'files')
+                )
             
-            # Notify the application controller
-            self.app_controller.on_file_received(file_info)
+            client_socket.sendall(json.dumps({
+                'status': 'ready',
+                'message': 'Ready to receive files',
+                'completed': self.segments_to_ranges(progress['done'])
+            }).encode())
             
-            return True
+            monitor = self.monitor_transfer(
+                request_id, message['file_name'], message.get('file_size', 0), transfer_events.RECEIVE, sender
+            )
+            monitor.start(progress['bytes'])
+            share = MonitoredShare(self.app_controller.network.bandwidth.open_share(sender, bandwidth.DOWNLOAD), monitor)
+            reader = FrameReader(client_socket, RECEIVE_BUFFER_SIZE, share.acquire)
+            progress['share'] = share
+            self.receive_batch(client_socket, reader, progress, message['file_count'])
+            logger.info(f"Received {message['file_count']} files from {sender} into {progress['dest_dir']}")
+            self.finish_monitor(request_id, transfer_events.COMPLETE)
             
+            self.app_controller.on_file_received({
+                'request_id': request_id,
+                'file_name': message['file_name'],
+                'file_path': progress['dest_dir'],
+                'file_size': progress['total_size'],
+                'file_count': message['file_count'],
+                'sender': sender
+            })
+            return True
+        
         except Exception as e:
-            error_response = {'status': 'error', 'message': str(e)}
+            # Keep track of finished files so the sender's retry only sends the rest
+            if progress is not None:
+                with self.sessions_lock:
+                    self.batch_progress[request_id] = progress
+            cancelled = isinstance(e, TransferCancelled) or request_id in self.cancelled_requests
+            self.finish_monitor(request_id, transfer_events.CANCELLED if cancelled else transfer_events.FAILED, e)
             try:
-                client_socket.send(json.dumps(error_response).encode())
+                client_socket.sendall(json.dumps({'status': 'cancelled' if cancelled else 'error', 'message': str(e)}).encode())
             except:
                 pass
-            logger.error(f"Error receiving file: {e}")
+            logger.error(f"Error receiving files: {e}")
             return False
         finally:
-            # Clean up
-            self.current_file_transfer = None
+            if share:
+                share.close()
+            with self.sessions_lock:
+                self.transfer_sessions.pop(request_id, None)
+    
+    def serve_directory_fetch(self, client_socket, message):
+        """Stream a file or directory we shared with a group to a member who asked for it"""
+        group_name = message.get('group_name')
+        requester = message.get('requester')
+        path = message.get('path', '')
+        group = self.app_controller.group_manager.groups.get(group_name)
+        
+        try:
+            if not group or requester not in group['members']:
+                raise Exception("Not a member of this group")
+            
+            # Only paths inside a directory we shared with this group may be fetched
+            real_path = os.path.realpath(path)
+            shared_dirs = [
+                os.path.realpath(directory)
+                for directory in group['shared_dirs'].get(self.app_controller.current_user.username, [])
+            ]
+            if not any(real_path == directory or real_path.startswith(directory + os.sep) for directory in shared_dirs):
+                raise Exception("Path is not shared with this group")
+            
+            if os.path.isdir(real_path):
+                kind = 'directory'
+                files = self.describe_batch_files(self.list_directory_files(real_path), real_path)
+            elif os.path.isfile(real_path):
+                kind = 'file'
+                files = self.describe_batch_files([real_path], os.path.dirname(real_path))
+            else:
+                raise Exception("Path no longer exists")
+            
+            status = {
+                'status': 'ready',
+                'kind': kind,
+                'name': os.path.basename(real_path),
+                'file_count': len(files),
+                'total_size': sum(entry['size'] for entry in files)
+            }
+        except Exception as e:
+            status = {'status': 'error', 'message': str(e)}
+        
+        # Framed, because the manifest follows it immediately
+        reply = json.dumps(status).encode()
+        client_socket.sendall(LARGE_FRAME_HEADER.pack(len(reply)) + reply)
+        if status['status'] != 'ready':
+            logger.warning(f"Refused to send {path} to {requester}: {status['message']}")
+            return False
+        
+        share = MonitoredShare(
+            self.app_controller.network.bandwidth.open_share(requester, bandwidth.UPLOAD),
+            TransferMonitor(None, status['name'], sum(entry['size'] for entry in files), transfer_events.SEND)
+        )
+        try:
+            return self.stream_batch(client_socket, files, message.get('completed', []), share, status['name'])
+        except Exception as e:
+            logger.error(f"Error sending {path} to {requester}: {e}")
+            return False
+        finally:
+            share.close()
+    
+    def fetch_directory(self, sharer, group_name, path, on_progress=None):
+        """Download a file or directory a member shared with a group, returning where it was saved"""
+        peer = self.app_controller.users[sharer]
+        state = {}  # what the first attempt set up, reused by retries
+        
+        for attempt in range(MAX_TRANSFER_ATTEMPTS):
+            try:
+                return self.fetch_directory_once(peer, group_name, path, state, on_progress)
+            except OSError as e:
+                # Files that already arrived aren't fetched again
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+                logger.warning(f"Download of {path} from {sharer} interrupted ({e}), "
+                               f"retrying in {delay}s ({attempt + 1}/{MAX_TRANSFER_ATTEMPTS})")
+                time.sleep(delay)
+        
+        raise Exception(f"Giving up on {path} after {MAX_TRANSFER_ATTEMPTS} attempts")
+    
+    def fetch_directory_once(self, peer, group_name, path, state, on_progress):
+        """Make one attempt at fetching a shared file or directory"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        share = None
+        
+        try:
+            sock.settimeout(30)
+            sock.connect((peer.ip, peer.port))
+            
+            progress = state.get('progress')
+            request = {
+                'type': 'directory_fetch',
+                'group_name': group_name,
+                'path': path,
+                'requester': self.app_controller.current_user.username,
+                'completed': self.segments_to_ranges(progress['done']) if progress else [],
+                'timestamp': datetime.now().isoformat()
+            }
+            sock.sendall(json.dumps(request).encode())
+            
+            share = self.app_controller.network.bandwidth.open_share(peer.username, bandwidth.DOWNLOAD)
+            reader = FrameReader(sock, RECEIVE_BUFFER_SIZE, share.acquire)
+            (status_size,) = reader.read_struct(LARGE_FRAME_HEADER)
+            status = json.loads(reader.read_exact(status_size).decode())
+            if status.get('status') != 'ready':
+                raise Exception(f"{peer.username} can't send {path}: {status.get('message', 'Unknown error')}")
+            
+            if progress is None:
+                # The subtree is unpacked straight into the group downloads directory
+                downloads_dir = get_group_download_dir()
+                os.makedirs(downloads_dir, exist_ok=True)
+                name = os.path.basename(status['name']) or 'files'
+                if status['kind'] == 'file':
+                    save_path = self.claim_save_path(downloads_dir, name)
+                    progress = self.new_batch_progress(downloads_dir, [save_path], on_progress)
+                else:
+                    save_path = self.claim_save_dir(downloads_dir, name)
+                    progress = self.new_batch_progress(save_path, on_progress=on_progress)
+                state['progress'] = progress
+                state['save_path'] = save_path
+            
+            self.receive_batch(sock, reader, progress, status['file_count'])
+            logger.info(f"Downloaded {status['file_count']} files from {peer.username} into {state['save_path']}")
+            return state['save_path']
+        finally:
+            if share:
+                share.close()
+            sock.close()
+    
+    @staticmethod
+    def new_batch_progress(dest_dir, paths=None, on_progress=None):
+        """State of a batch being received, kept across retries"""
+        return {
+            'dest_dir': dest_dir,
+            'paths': paths,              # fixed destinations, instead of paths under dest_dir
+            'done': set(),               # indices of files written and verified
+            'roots': {},                 # {index: content hash} of verified files
+            'dirs': set(),               # directories already created
+            'total_size': 0,
+            'bytes': 0,                  # bytes written so far, including repairs
+            'started': time.time(),
+            'reported': 0.0,
+            'on_progress': on_progress,  # on_progress(files_done, file_count, bytes, total_size, rate)
+            'share': None                # the current attempt's share, which counts progress
+        }
+    
+    def receive_batch(self, sock, reader, progress, file_count):
+        """Read a batch manifest and its files, asking again for any that fail verification"""
+        (manifest_size,) = reader.read_struct(LARGE_FRAME_HEADER)
+        manifest = json.loads(reader.read_exact(manifest_size).decode())
+        if len(manifest) != file_count:
+            raise Exception("Manifest doesn't match the request")
+        paths = progress['paths'] or [self.batch_file_path(progress['dest_dir'], name) for name, _ in manifest]
+        sizes = [size for _, size in manifest]
+        progress['file_count'] = file_count
+        progress['total_size'] = sum(sizes)
+        
+        for repair_round in range(MAX_REPAIR_ROUNDS + 1):
+            corrupt = self.receive_batch_files(reader, progress, paths, sizes)
+            if not corrupt:
+                break
+            if repair_round == MAX_REPAIR_ROUNDS:
+                raise Exception(f"{len(corrupt)} files still corrupt after {MAX_REPAIR_ROUNDS} repairs")
+            logger.warning(f"{len(corrupt)} files failed verification, asking for them again")
+            sock.sendall(json.dumps({'status': 'repair', 'files': self.segments_to_ranges(corrupt)}).encode())
+        
+        if len(progress['done']) != file_count:
+            raise Exception(f"Batch incomplete: got {len(progress['done'])} of {file_count} files")
+        self.app_controller.content_store.add_files(
+            (progress['roots'][index], paths[index]) for index in progress['done'] if index in progress['roots']
+        )
+        
+        sock.sendall(json.dumps({'status': 'received', 'message': 'Files received successfully'}).encode())
+        self.report_batch_progress(progress, force=True)
+    
+    @staticmethod
+    def report_batch_progress(progress, force=False):
+        """Tell the progress callback how far a batch has got, a few times a second"""
+        now = time.time()
+        if not progress['on_progress'] or (not force and now - progress['reported'] < PROGRESS_INTERVAL):
+            return
+        progress['reported'] = now
+        rate = progress['bytes'] / max(now - progress['started'], 1e-6)
+        progress['on_progress'](len(progress['done']), progress['file_count'], progress['bytes'], progress['total_size'], rate)
+    
+    def receive_batch_files(self, reader, progress, paths, sizes):
+        """Write files from a batch stream until its end marker, returning the corrupt ones"""
+        corrupt = set()
+        while True:
+            index, size = reader.read_struct(BATCH_FILE_HEADER)
+            if index == BATCH_END_INDEX:
+                return corrupt
+            if index >= len(paths) or size != sizes[index]:
+                raise Exception(f"Unexpected file {index} in batch")
+            
+            directory = os.path.dirname(paths[index])
+            if directory not in progress['dirs']:
+                os.makedirs(directory, exist_ok=True)
+                progress['dirs'].add(directory)
             
+            hasher = integrity.ChunkHasher()
+            with open(paths[index], 'wb') as f:
+                disk_io.preallocate(f, size)
+                for chunk in reader.read_chunks(size):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    progress['bytes'] += len(chunk)
+                    if progress.get('share'):
+                        progress['share'].advance(len(chunk))
+                    if progress['on_progress']:
+                        self.report_batch_progress(progress)
+            
+            root = self.file_root(hasher, size)
+            if reader.read_exact(integrity.DIGEST_SIZE) == root:
+                progress['done'].add(index)
+                progress['roots'][index] = root.hex()
+                corrupt.discard(index)
+            else:
+                logger.warning(f"{paths[index]} failed verification")
+                progress['done'].discard(index)
+                corrupt.add(index)
+    
+    @staticmethod
+    def batch_file_path(dest_dir, name):
+        """Resolve a path from a batch manifest, refusing anything outside the batch directory"""
+        parts = name.split('/')
+        if any(part in ('', '.', '..') or os.sep in part or (os.altsep and os.altsep in part) for part in parts):
+            raise Exception(f"Unsafe path in batch: {name}")
+        dest_dir = os.path.normpath(dest_dir)
+        path = os.path.normpath(os.path.join(dest_dir, *parts))
+        if not path.startswith(dest_dir + os.sep):
+            raise Exception(f"Unsafe path in batch: {name}")
+        return path
+    
+    @staticmethod
+    def claim_save_dir(downloads_dir, dir_name):
+        """Create a new, uniquely named directory in the downloads directory"""
+        counter = 1
+        save_dir = os.path.join(downloads_dir, dir_name)
+        while True:
+            try:
+                os.makedirs(save_dir)
+                return save_dir
+            except FileExistsError:
+                save_dir = os.path.join(downloads_dir, f"{dir_name}_{counter}")
+                counter += 1
+    
+    @staticmethod
+    def write_at(f, data, position):
+        """Write data at an absolute position in the file"""
+        if hasattr(os, 'pwrite'):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(f.fileno(), view, position)
+                view = view[written:]
+                position += written
+        else:
+            # No pwrite on Windows; the handle is private to this stripe so seeking is safe
+            f.seek(position)
+            f.write(data)
+    
+    def complete_segment(self, session, offset, length):
+        """Record a fully written stripe segment and checkpoint periodically"""
+        with session['lock']:
+            session['segments_done'].add(offset // STRIPE_SEGMENT_SIZE)
+            session['bytes_received'] += length
+            checkpoint_due = session['bytes_received'] - session['checkpoint_offset'] >= CHECKPOINT_INTERVAL
+        
+        if checkpoint_due and not session['file'].closed:
+            self.save_checkpoint(session)
+    
+    @staticmethod
+    def claim_save_path(downloads_dir, file_name):
+        """Reserve a unique file name in the downloads directory"""
+        # Opening with 'xb' claims the name atomically, so parallel transfers
+        # of the same file name never end up writing into one path
+        base_name, ext = os.path.splitext(file_name)
+        counter = 1
+        save_path = os.path.join(downloads_dir, file_name)
+        
+        while True:
+            try:
+                open(save_path, 'xb').close()
+                return save_path
+            except FileExistsError:
+                save_path = os.path.join(downloads_dir, f"{base_name}_{counter}{ext}")
+                counter += 1
+    
+    def finalize_received_file(self, session):
+        """Move a completed .part file to a unique name in the downloads directory"""
+        save_path = self.claim_save_path(session['downloads_dir'], session['file_name'])
+        os.replace(session['part_path'], save_path)
+        disk_io.sync_directory(session['downloads_dir'])
+        session['file_path'] = save_path
+        
+        self.remove_file(session['journal_path'])
+        self.remove_file(session['leaves_path'])
+    
+    def record_leaves(self, session, completed):
+        """Store the hashes of chunks we wrote and check them against the sender's"""
+        with session['lock']:
+            for index, digest in completed:
+                session['leaves'][index] = digest
+                session['leaves_saved'].discard(index)
+                self.check_leaf(session, index)
+    
+    def record_expected_leaf(self, session, index, digest):
+        """Store a chunk hash sent by the sender and check it against ours"""
+        with session['lock']:
+            session['expected_leaves'][index] = digest
+            self.check_leaf(session, index)
+    
+    @staticmethod
+    def check_leaf(session, index):
+        """Report a chunk whose hash differs from the sender's; it is re-requested once the data is in"""
+        ours = session['leaves'].get(index)
+        theirs = session['expected_leaves'].get(index)
+        if ours is not None and theirs is not None and ours != theirs:
+            logger.warning(f"Chunk {index} of {session['file_name']} failed verification")
+    
+    def receive_hash_frame(self, reader, session, frame_size):
+        """Read a chunk hash sent among the data frames"""
+        if frame_size & ~integrity.HASH_FRAME_FLAG != integrity.HASH_RECORD.size:
+            raise Exception("Malformed chunk hash frame")
+        index, digest = reader.read_struct(integrity.HASH_RECORD)
+        self.record_expected_leaf(session, index, digest)
+    
+    def verify_integrity(self, reader, session):
+        """Check every chunk against the sender's hashes, re-requesting bad ones, then check the root"""
+        frame_size, = reader.read_struct(LARGE_FRAME_HEADER)
+        trailer = json.loads(reader.read_exact(frame_size).decode())
+        leaf_count = integrity.chunk_count(session['file_size'])
+        if trailer.get('leaf_count') != leaf_count:
+            raise Exception("Sender's hash tree doesn't cover the file")
+        
+        for repair_round in range(MAX_REPAIR_ROUNDS + 1):
+            with session['lock']:
+                bad_chunks = [
+                    index for index in range(leaf_count)
+                    if session['leaves'].get(index) is None
+                    or session['leaves'][index] != session['expected_leaves'].get(index)
+                ]
+            if not bad_chunks:
+                break
+            if repair_round == MAX_REPAIR_ROUNDS:
+                raise Exception(f"{len(bad_chunks)} chunks still corrupt after {MAX_REPAIR_ROUNDS} repairs")
+            
+            logger.warning(f"Re-requesting {len(bad_chunks)} corrupt chunks of {session['file_name']}")
+            request = {'status': 'repair', 'chunks': self.segments_to_ranges(bad_chunks)}
+            reader.sock.sendall(json.dumps(request).encode())
+            self.receive_repairs(reader, session)
+        
+        root = integrity.merkle_root([session['leaves'][index] for index in range(leaf_count)]).hex()
+        if root != trailer.get('merkle_root'):
+            raise Exception("File hash doesn't match the sender's")
+        session['merkle_root'] = root
+    
+    def receive_repairs(self, reader, session):
+        """Overwrite re-sent chunks in place and hash them again"""
+        f = session['file']
+        f.flush()
+        while True:
+            offset, length = reader.read_struct(STRIPE_HEADER)
+            if length == 0:
+                break
+            if offset % integrity.MERKLE_CHUNK_SIZE or length > integrity.MERKLE_CHUNK_SIZE \
+                    or offset + length > session['file_size']:
+                raise Exception(f"Invalid repair chunk at {offset}")
+            
+            hasher = integrity.ChunkHasher(offset)
+            completed = []
+            position = offset
+            for data in reader.read_chunks(length):
+                self.write_at(f, data, position)
+                completed += hasher.update(data)
+                position += len(data)
+            self.record_leaves(session, completed + hasher.finish())
+    
+    def write_received_data(self, session, data):
+        """Append received data to the partial file and checkpoint periodically"""
+        session['file'].write(data)
+        session['crc32'] = zlib.crc32(data, session['crc32'])
+        session['bytes_received'] += len(data)
+        session['bandwidth_share'].advance(len(data))
+        if session['hasher']:
+            completed = session['hasher'].update(data)
+            if completed:
+                self.record_leaves(session, completed)
+        
+        if session['bytes_received'] - session['checkpoint_offset'] >= CHECKPOINT_INTERVAL:
+            self.save_checkpoint(session)
+    
+    def receive_framed_chunks(self, reader, session):
+        """Receive 4-byte length prefixed chunks until the end signal"""
+        while True:
+            # Many 8 KB chunks arrive per receive, so their headers are parsed from the buffer
+            chunk_size, = reader.read_struct(FRAMED_HEADER)
+            
+            # If chunk size is 0, we're done
+            if chunk_size == 0:
+                break
+            
+            # Write chunk to file straight from the receive buffer
+            for data in reader.read_chunks(chunk_size):
+                self.write_received_data(session, data)
+    
+    def receive_large_frames(self, reader, session):
+        """Receive 8-byte length prefixed frames, streaming each one to disk"""
+        while True:
+            frame_size, = reader.read_struct(LARGE_FRAME_HEADER)
+            
+            # A 0-length frame marks the end of the file
+            if frame_size == 0:
+                break
+            if frame_size & integrity.HASH_FRAME_FLAG:
+                self.receive_hash_frame(reader, session, frame_size)
+                continue
+            
+            # Frames can be many MB, so never hold a whole frame in memory
+            for data in reader.read_chunks(frame_size):
+                if session['decompressor']:
+                    self.write_compressed_data(session, data)
+                else:
+                    self.write_received_data(session, data)
+        
+        if session['decompressor']:
+            self.finish_decompression(session)
+    
+    def write_compressed_data(self, session, data):
+        """Decompress received data and append it to the partial file"""
+        session['wire_bytes'] += len(data)
+        pieces = compression.decompress_chunks(session['decompressor'], data)
+        while True:
+            cpu_start = time.thread_time()
+            plain = next(pieces, None)
+            session['cpu_time'] += time.thread_time() - cpu_start
+            if plain is None:
+                break
+            self.check_decompressed_size(session, plain)
+            self.write_received_data(session, plain)
+    
+    @staticmethod
+    def check_decompressed_size(session, plain):
+        """Stop a compressed transfer that expands past the announced file size"""
+        if session['bytes_received'] + len(plain) > session['file_size']:
+            raise Exception(f"Compressed data expands past the {session['file_size']} bytes announced")
+    
+    def finish_decompression(self, session):
+        """Drain the decompressor and report how well the transfer compressed"""
+        decompressor = session['decompressor']
+        if hasattr(decompressor, 'flush'):
+            tail = decompressor.flush()
+            if tail:
+                self.check_decompressed_size(session, tail)
+                self.write_received_data(session, tail)
+        
+        raw_bytes = session['bytes_received'] - session['resume_offset']
+        session['compression_stats'] = {
+            'codec': session['compression']['codec'],
+            'level': session['compression']['level'],
+            'raw_bytes': raw_bytes,
+            'wire_bytes': session['wire_bytes'],
+            'ratio': session['wire_bytes'] / raw_bytes if raw_bytes else 1.0,
+            'cpu_time': session['cpu_time']
+        }
+        logger.info(f"Received {session['file_name']} compressed with {session['compression']['codec']}: "
+                    f"{self.format_file_size(session['wire_bytes'])} -> {self.format_file_size(raw_bytes)} "
+                    f"(ratio {session['compression_stats']['ratio']:.2f}, {session['cpu_time']:.2f}s CPU)")
+    
     @staticmethod
     def format_file_size(size_bytes):
         """Format file size in human readable format"""
@@ -201,4 +2102,4 @@ class FileManager:
         while size_bytes >= 1024 and i < len(size_names) - 1:
             size_bytes /= 1024.0
             i += 1
-        return f"{size_bytes:.1f} {size_names[i]}"
\ No newline at end of file
+        return f"{size_bytes:.1f} {size_names[i]}"
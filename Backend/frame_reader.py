@@ -0,0 +1,78 @@
+# Buffered socket reader for the transfer protocols. Everything is received
+# with recv_into into one preallocated buffer, so small headers that arrive
+# together are parsed without extra system calls and payload data is handed
+# out as views instead of freshly allocated bytes. An optional throttle is
+# told how much was received after every read, so it can slow the reader
+# (and, through TCP flow control, the sender) down.
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+class FrameReader:
+    """Read headers and payloads from a socket through a reusable buffer"""
+
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE, throttle=None):
+        self.sock = sock
+        self.throttle = throttle
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unread byte
+        self.end = 0    # end of received data
+
+    def fill(self, minimum):
+        """Receive until at least minimum bytes are buffered"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.start < minimum:
+            # Move the unread tail to the front so the rest of the header fits
+            size = self.end - self.start
+            self.view[:size] = self.view[self.start:self.end]
+            self.start, self.end = 0, size
+
+        while self.end - self.start < minimum:
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                raise Exception("Connection lost during file transfer")
+            self.end += received
+            if self.throttle:
+                self.throttle(received)
+
+    def read_struct(self, header):
+        """Read and unpack one fixed-size header"""
+        if self.end - self.start < header.size:
+            self.fill(header.size)
+        values = header.unpack_from(self.buffer, self.start)
+        self.start += header.size
+        return values
+
+    def read_chunks(self, size):
+        """Yield views over the next size bytes; each view is only valid until the next one"""
+        remaining = size
+        while remaining:
+            if self.start == self.end:
+                # Fill the whole buffer; whatever follows this payload stays buffered
+                self.start = 0
+                self.end = self.sock.recv_into(self.view)
+                if not self.end:
+                    raise Exception("Connection lost during file transfer")
+                if self.throttle:
+                    self.throttle(self.end)
+            count = min(remaining, self.end - self.start)
+            yield self.view[self.start:self.start + count]
+            self.start += count
+            remaining -= count
+
+    def read_exact(self, size):
+        """Read a whole payload as bytes"""
+        if size <= len(self.buffer):
+            if self.end - self.start < size:
+                self.fill(size)
+            data = bytes(self.view[self.start:self.start + size])
+            self.start += size
+            return data
+
+        data = bytearray(size)
+        position = 0
+        for chunk in self.read_chunks(size):
+            data[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        return bytes(data)
@@ -0,0 +1,182 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+from Backend import integrity
+from Backend.bandwidth import parse_rate
+from Backend.utils import get_data_dir
+
+logger = logging.getLogger(__name__)
+
+# Persistent cache of file hashes. Results are keyed by device, inode, size
+# and mtime, so a file is only read again once it has changed, and sharing
+# a large tree a second time costs a stat per file. Files missing from the
+# cache are hashed on a pool of worker processes, which together read no
+# faster than the configured rate so hashing doesn't starve transfers of
+# disk bandwidth.
+
+HASH_CACHE_NAME = 'hash_cache.db'
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_READ_LIMIT = '256M'  # bytes per second across all workers
+COMMIT_INTERVAL = 1000       # new entries written per transaction
+MAX_PENDING_PER_WORKER = 4   # files queued ahead of each worker
+
+class HashCache:
+    def __init__(self, path, workers=DEFAULT_WORKERS, read_limit=None):
+        self.path = path
+        self.workers = max(1, workers)
+        self.read_limit = read_limit
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = self.open_database(path)
+        except (OSError, sqlite3.DatabaseError) as e:
+            # Hashes are still cached for this session, just not kept
+            logger.warning(f"Can't open hash cache {path}, not keeping hashes across restarts: {e}")
+            self.db = self.open_database(':memory:')
+
+    @classmethod
+    def from_environment(cls):
+        """Create a cache configured by P2P_HASH_CACHE, P2P_HASH_WORKERS and P2P_HASH_READ_LIMIT"""
+        return cls(
+            os.environ.get('P2P_HASH_CACHE') or os.path.join(get_data_dir(), HASH_CACHE_NAME),
+            workers=int(os.environ.get('P2P_HASH_WORKERS', DEFAULT_WORKERS)),
+            read_limit=parse_rate(os.environ.get('P2P_HASH_READ_LIMIT', DEFAULT_READ_LIMIT))
+        )
+
+    @staticmethod
+    def open_database(path):
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+            'content_hash TEXT, leaves BLOB, PRIMARY KEY (dev, ino))'
+        )
+        db.commit()
+        return db
+
+    def lookup(self, stat):
+        """Return (content_hash, leaves) for an unchanged file, or None"""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT content_hash, leaves FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        if row is None:
+            return None
+        content_hash, data = row
+        return content_hash, [data[i:i + integrity.DIGEST_SIZE] for i in range(0, len(data), integrity.DIGEST_SIZE)]
+
+    def store(self, stat, content_hash, leaves, commit=True):
+        """Remember a file's hashes; it replaces whatever was cached for the same inode"""
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, content_hash, b''.join(leaves))
+            )
+            self.uncommitted += 1
+            if commit or self.uncommitted >= COMMIT_INTERVAL:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def hash_file(self, path):
+        """Return (content_hash, leaves) of a file, reading it only if it changed since it was last hashed"""
+        stat = os.stat(path)
+        cached = self.lookup(stat)
+        if cached:
+            return cached
+        leaves = integrity.hash_file(path, self.read_limit)
+        content_hash = integrity.content_hash(leaves)
+        self.store_if_unchanged(path, stat, content_hash, leaves)
+        return content_hash, leaves
+
+    def hash_files(self, paths):
+        """Yield (path, content_hash, leaves) for many files, hashing the uncached ones in parallel"""
+        misses = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                logger.warning(f"Can't hash {path}: {e}")
+                continue
+            cached = self.lookup(stat)
+            if cached:
+                yield (path,) + cached
+            else:
+                misses.append((path, stat))
+
+        if not misses:
+            return
+        workers = min(self.workers, len(misses))
+        if workers == 1:
+            # Starting a worker process costs more than it saves
+            for path, stat in misses:
+                try:
+                    leaves = integrity.hash_file(path, self.read_limit)
+                except OSError as e:
+                    logger.warning(f"Can't hash {path}: {e}")
+                    continue
+                content_hash = integrity.content_hash(leaves)
+                self.store_if_unchanged(path, stat, content_hash, leaves, commit=False)
+                yield path, content_hash, leaves
+            self.commit()
+            return
+
+        # Each worker gets an equal slice of the read rate. Spawned workers
+        # don't inherit the GUI's threads and sockets the way forked ones would.
+        read_rate = self.read_limit / workers if self.read_limit else None
+        logger.info(f"Hashing {len(misses)} files on {workers} processes")
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn')
+        ) as pool:
+            queued = iter(misses)
+            pending = {}
+            try:
+                while True:
+                    # Only a few files are queued at a time, however large the tree
+                    while len(pending) < workers * MAX_PENDING_PER_WORKER:
+                        entry = next(queued, None)
+                        if entry is None:
+                            break
+                        pending[pool.submit(integrity.hash_file, entry[0], read_rate)] = entry
+                    if not pending:
+                        break
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        path, stat = pending.pop(future)
+                        try:
+                            leaves = future.result()
+                        except OSError as e:
+                            logger.warning(f"Can't hash {path}: {e}")
+                            continue
+                        content_hash = integrity.content_hash(leaves)
+                        self.store_if_unchanged(path, stat, content_hash, leaves, commit=False)
+                        yield path, content_hash, leaves
+            finally:
+                for future in pending:
+                    future.cancel()
+                self.commit()
+
+    def store_if_unchanged(self, path, stat, content_hash, leaves, commit=True):
+        """Cache a result unless the file was modified while it was being read"""
+        try:
+            after = os.stat(path)
+        except OSError:
+            return
+        if (after.st_size, after.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            self.store(stat, content_hash, leaves, commit)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
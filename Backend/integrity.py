@@ -0,0 +1,138 @@
+import hashlib
+import struct
+import time
+
+# Streaming integrity checks. Files are split into fixed-size chunks whose
+# hashes form the leaves of a Merkle tree; both sides hash data as it passes
+# through the transfer, so no extra read of the file is needed, and a chunk
+# that fails verification can be sent again on its own.
+
+ALGORITHM = 'sha256-merkle'
+MERKLE_CHUNK_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+HASH_RECORD = struct.Struct('>Q32s')  # chunk index, chunk digest
+HASH_FRAME_FLAG = 1 << 63             # marks hash records among length-prefixed frames
+EMPTY_ROOT = hashlib.sha256(b'').digest()
+
+def hash_leaf(data):
+    """Hash one chunk of file data"""
+    h = hashlib.sha256(b'\x00')
+    h.update(data)
+    return h.digest()
+
+def hash_node(left, right):
+    """Hash two child digests into their parent"""
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+def merkle_root(leaves):
+    """Compute the root of a list of leaf digests, carrying odd nodes up a level"""
+    if not leaves:
+        return EMPTY_ROOT
+    level = list(leaves)
+    while len(level) > 1:
+        parents = [hash_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+def chunk_count(file_size, chunk_size=MERKLE_CHUNK_SIZE):
+    """Number of leaves covering a file"""
+    return (file_size + chunk_size - 1) // chunk_size
+
+def chunk_range(index, file_size, chunk_size=MERKLE_CHUNK_SIZE):
+    """Byte offset and length of a chunk"""
+    start = index * chunk_size
+    return start, min(chunk_size, file_size - start)
+
+def content_hash(leaves):
+    """Identify file content by the root of its hash tree, as hex"""
+    return merkle_root(leaves).hex()
+
+def hash_file(path, read_rate=None):
+    """Read a whole file, no faster than read_rate bytes per second, and return its leaf digests in order"""
+    hasher = ChunkHasher()
+    started = time.monotonic()
+    read = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(MERKLE_CHUNK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+            read += len(data)
+            if read_rate:
+                ahead = read / read_rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+    hasher.finish()
+    return [hasher.leaves[index] for index in range(len(hasher.leaves))]
+
+def negotiate(offer):
+    """Accept a sender's integrity offer if we hash the same way"""
+    if not offer or offer.get('algorithm') != ALGORITHM or offer.get('chunk_size') != MERKLE_CHUNK_SIZE:
+        return None
+    return {'algorithm': ALGORITHM, 'chunk_size': MERKLE_CHUNK_SIZE}
+
+class ChunkHasher:
+    """Hash a byte stream chunk by chunk, collecting leaf digests by chunk index"""
+
+    def __init__(self, position=0, leaves=None, chunk_size=MERKLE_CHUNK_SIZE):
+        if position % chunk_size:
+            raise ValueError("Hashing must start on a chunk boundary")
+        self.chunk_size = chunk_size
+        self.index = position // chunk_size
+        self.leaves = {} if leaves is None else leaves
+        self.hash = None
+        self.filled = 0
+
+    def update(self, data):
+        """Feed data, returning (index, digest) for every chunk it completes"""
+        completed = []
+        view = memoryview(data)
+        while view:
+            if self.hash is None:
+                self.hash = hashlib.sha256(b'\x00')
+            take = min(len(view), self.chunk_size - self.filled)
+            self.hash.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.chunk_size:
+                completed.append(self.complete())
+        return completed
+
+    def finish(self):
+        """Complete a trailing partial chunk, if any"""
+        if self.hash is None:
+            return []
+        return [self.complete()]
+
+    def complete(self):
+        digest = self.hash.digest()
+        completed = (self.index, digest)
+        self.leaves[self.index] = digest
+        self.index += 1
+        self.hash = None
+        self.filled = 0
+        return completed
+
+class HashingReader:
+    """File wrapper that hashes everything read through it"""
+
+    def __init__(self, f, hasher):
+        self.f = f
+        self.hasher = hasher
+        self.completed = []
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if data:
+            self.completed.extend(self.hasher.update(data))
+        else:
+            self.completed.extend(self.hasher.finish())
+        return data
+
+    def take_completed(self):
+        """Return chunks completed since the last call"""
+        completed, self.completed = self.completed, []
+        return completed
@@ -0,0 +1,506 @@
+import logging
+import os
+import random
+import secrets
+import select
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+from Backend import bandwidth
+from Backend import disk_io
+from Backend import integrity
+from Backend.bandwidth import parse_rate
+from Backend.swarm import PARTIAL_DIR_NAME
+from Backend.utils import get_group_download_dir
+
+logger = logging.getLogger(__name__)
+
+# One-to-many distribution of a file to a whole group over UDP multicast.
+# The sharer offers the file to every member over the normal control channel,
+# then sends it once as sequence-numbered datagrams. After each pass it polls
+# the receivers, which answer with the ranges they are missing (NACKs) or say
+# they are done. Ranges several receivers missed are repaired over multicast
+# again, ranges only one receiver missed are sent to it directly. Receivers
+# check every chunk against the file's hash tree, which they fetch from the
+# sharer before the data starts, and a receiver that loses touch with the
+# sharer falls back to a swarm download.
+
+DATAGRAM = struct.Struct('>IBQ')  # session, kind, sequence number (or receiver id)
+NACK_RANGE = struct.Struct('>QI')  # first datagram, datagram count
+KIND_DATA = 0
+KIND_POLL = 1   # sharer asks for NACKs; the sequence number is the datagram count
+KIND_NACK = 2
+KIND_DONE = 3
+KIND_END = 4    # sharer is finished with the session
+
+DEFAULT_GROUP = '239.255.42.99'
+DEFAULT_PORT = 45999
+DEFAULT_RATE = '40M'        # UDP has no congestion control, so the sharer paces itself
+DEFAULT_TTL = 1             # stay on the local network
+# Payloads divide the hash tree's chunks evenly, so a chunk that fails
+# verification maps to whole datagrams
+DATAGRAM_PAYLOAD = 1024
+DATAGRAMS_PER_CHUNK = integrity.MERKLE_CHUNK_SIZE // DATAGRAM_PAYLOAD
+SEND_BURST = 64 * DATAGRAM_PAYLOAD  # bytes paced at once
+SOCKET_BUFFER = 4 * 1024 * 1024
+MAX_NACK_RANGES = 100       # ranges per NACK, keeping it within one datagram
+MULTICAST_REPAIR_MIN = 2    # receivers missing a range before it's repaired over multicast
+MAX_ROUND_TIME = 0.2        # seconds the sharer waits for answers to a poll at most
+MIN_ROUND_TIME = 0.01
+ROUND_TIME_FACTOR = 3       # round time as a multiple of the slowest recent answer
+MAX_SILENT_TIME = 5.0       # seconds without an answer before a receiver is given up on
+END_REPEATS = 3
+IDLE_TIMEOUT = 10.0         # seconds a receiver waits without hearing from the sharer
+LINGER_TIME = 2.0           # seconds a finished receiver keeps answering polls
+
+def plan_repairs(nacks):
+    """Split NACKed ranges into ones several receivers need and ones only a single receiver needs"""
+    events = []
+    for receiver_id, ranges in nacks.items():
+        for first, count in ranges:
+            events.append((first, 1, receiver_id))
+            events.append((first + count, -1, receiver_id))
+    events.sort(key=lambda event: event[0])
+
+    shared, single = [], []
+    active = {}  # {receiver_id: ranges open at this point}
+    position = None
+    for point, change, receiver_id in events:
+        if active and point > position:
+            if len(active) >= MULTICAST_REPAIR_MIN:
+                shared.append((position, point - position))
+            else:
+                single.append((next(iter(active)), position, point - position))
+        position = point
+        active[receiver_id] = active.get(receiver_id, 0) + change
+        if not active[receiver_id]:
+            del active[receiver_id]
+    return shared, single
+
+def missing_ranges(have, limit):
+    """The first runs of datagrams not received yet, as (first, count)"""
+    ranges = []
+    position = have.find(0)
+    while position != -1 and len(ranges) < limit:
+        end = have.find(1, position)
+        if end == -1:
+            end = len(have)
+        ranges.append((position, end - position))
+        position = have.find(0, end)
+    return ranges
+
+class MulticastSender:
+    """One distribution of a file to the members that accepted it"""
+
+    def __init__(self, manager, group_name, path, file_size):
+        self.manager = manager
+        self.group_name = group_name
+        self.path = path
+        self.file_size = file_size
+        self.session_id = secrets.randbits(32)
+        self.receivers = {}  # {receiver_id: username} of the members that joined
+        self.addresses = {}  # {receiver_id: (ip, port)} learned from their NACKs
+        self.round_time = MAX_ROUND_TIME
+        self.datagram_count = -(-file_size // DATAGRAM_PAYLOAD)
+        self.sock = manager.open_send_socket()
+        self.destination = (manager.group, manager.port)
+
+    def run(self, share):
+        """Send the file, then repair until every receiver is done or gone; returns the receivers that finished"""
+        pending = set(self.receivers)
+        heard = dict.fromkeys(pending, time.monotonic())
+        done = []
+        with open(self.path, 'rb') as f:
+            self.send_range(f, share, 0, self.datagram_count, self.destination)
+            while pending:
+                nacks, answered = self.poll(pending)
+                now = time.monotonic()
+                for receiver_id in answered:
+                    heard[receiver_id] = now
+                    if receiver_id not in nacks:
+                        pending.discard(receiver_id)
+                        done.append(self.receivers[receiver_id])
+                for receiver_id in pending - answered:
+                    if now - heard[receiver_id] > MAX_SILENT_TIME:
+                        logger.warning(f"{self.receivers[receiver_id]} stopped answering the multicast of {self.path}")
+                        pending.discard(receiver_id)
+
+                shared, single = plan_repairs(nacks)
+                for first, count in shared:
+                    self.send_range(f, share, first, count, self.destination)
+                for receiver_id, first, count in single:
+                    self.send_range(f, share, first, count, self.addresses[receiver_id])
+
+        for _ in range(END_REPEATS):
+            self.sock.sendto(DATAGRAM.pack(self.session_id, KIND_END, 0), self.destination)
+        self.sock.close()
+        return done
+
+    def send_range(self, f, share, first, count, address):
+        """Send a run of datagrams, pacing them through the bandwidth share"""
+        header = DATAGRAM.pack
+        offset = first * DATAGRAM_PAYLOAD
+        end = min((first + count) * DATAGRAM_PAYLOAD, self.file_size)
+        f.seek(offset)
+        sequence = first
+        while offset < end:
+            data = f.read(min(SEND_BURST, end - offset))
+            if not data:
+                raise Exception(f"{self.path} was truncated while it was being sent")
+            share.acquire(len(data))
+            view = memoryview(data)
+            for position in range(0, len(data), DATAGRAM_PAYLOAD):
+                self.sock.sendto(header(self.session_id, KIND_DATA, sequence) + view[position:position + DATAGRAM_PAYLOAD], address)
+                sequence += 1
+            offset += len(data)
+
+    def poll(self, pending):
+        """Ask the receivers what they're missing; returns ({receiver_id: ranges}, receivers that answered)"""
+        self.sock.sendto(DATAGRAM.pack(self.session_id, KIND_POLL, self.datagram_count), self.destination)
+        nacks = {}
+        answered = set()
+        polled = time.monotonic()
+        deadline = polled + self.round_time
+        slowest = 0.0
+        while answered != pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.sock.settimeout(remaining)
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except socket.timeout:
+                break
+            if len(data) < DATAGRAM.size:
+                continue
+            session_id, kind, receiver_id = DATAGRAM.unpack_from(data)
+            if session_id != self.session_id or receiver_id not in pending:
+                continue
+            self.addresses[receiver_id] = address
+            answered.add(receiver_id)
+            slowest = time.monotonic() - polled
+            if kind == KIND_NACK:
+                nacks[receiver_id] = [
+                    NACK_RANGE.unpack_from(data, position)
+                    for position in range(DATAGRAM.size, len(data) - NACK_RANGE.size + 1, NACK_RANGE.size)
+                ]
+            else:
+                nacks.pop(receiver_id, None)
+        if answered:
+            # A lost poll or answer costs a round, so rounds are only as long as answers need
+            self.round_time = min(MAX_ROUND_TIME, max(MIN_ROUND_TIME, ROUND_TIME_FACTOR * slowest))
+        return nacks, answered
+
+class MulticastReceiver:
+    """Our side of a multicast session another member is sending to the group"""
+
+    def __init__(self, manager, message, leaves, part_path):
+        self.manager = manager
+        self.app_controller = manager.app_controller
+        self.session_id = message['session_id']
+        self.receiver_id = message['receiver_id']
+        self.group_name = message['group_name']
+        self.sender = message['sender']
+        self.content_hash = message['content_hash']
+        self.file_name = message['file_name']
+        self.file_size = message['file_size']
+        self.sender_address = (self.app_controller.users[self.sender].ip, message['repair_port'])
+        self.leaves = leaves
+        self.part_path = part_path
+
+        self.datagram_count = -(-self.file_size // DATAGRAM_PAYLOAD)
+        self.have = bytearray(self.datagram_count)
+        self.chunk_missing = [
+            integrity.chunk_range(index, self.file_size)[1] // DATAGRAM_PAYLOAD
+            for index in range(len(leaves))
+        ]
+        # The last datagram of a file may be short
+        if self.file_size % DATAGRAM_PAYLOAD:
+            self.chunk_missing[-1] += 1
+        self.missing = self.datagram_count
+        self.loss = manager.loss
+
+        self.group_socket = manager.open_receive_socket(message['group'], message['port'])
+        self.repair_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.repair_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        self.repair_socket.bind(('', 0))
+        for sock in (self.group_socket, self.repair_socket):
+            sock.setblocking(False)
+        self.f = open(part_path, 'w+b', buffering=0)
+        if not disk_io.preallocate(self.f, self.file_size):
+            self.f.truncate(self.file_size)
+
+    @property
+    def repair_port(self):
+        return self.repair_socket.getsockname()[1]
+
+    def run(self):
+        """Receive until the file is complete and verified, then hand it to the swarm"""
+        buf = bytearray(DATAGRAM.size + 65536)
+        view = memoryview(buf)
+        heard = time.monotonic()
+        finished = None
+        try:
+            while True:
+                now = time.monotonic()
+                if finished is not None and now - finished > LINGER_TIME:
+                    return
+                if finished is None and now - heard > IDLE_TIMEOUT:
+                    raise ConnectionError(f"Lost touch with {self.sender}")
+                readable, _, _ = select.select([self.group_socket, self.repair_socket], [], [], 0.5)
+                polled = ended = False
+                for sock in readable:
+                    while True:
+                        try:
+                            length = sock.recv_into(buf)
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        if length < DATAGRAM.size or (self.loss and random.random() < self.loss):
+                            continue
+                        session_id, kind, sequence = DATAGRAM.unpack_from(buf)
+                        if session_id != self.session_id:
+                            continue
+                        heard = time.monotonic()
+                        if kind == KIND_DATA:
+                            if sequence < self.datagram_count and not self.have[sequence]:
+                                self.receive_datagram(sequence, view[DATAGRAM.size:length])
+                        elif kind == KIND_POLL:
+                            polled = True
+                        elif kind == KIND_END:
+                            ended = True
+
+                # Polls are answered once everything queued before them has been taken in
+                if finished is None and not self.missing:
+                    self.complete()
+                    polled = True
+                if polled:
+                    self.answer_poll()
+                if finished is None and not self.missing:
+                    # The sharer can stop polling us before we announce the file to the group
+                    self.publish()
+                    finished = time.monotonic()
+                if ended:
+                    if finished is None:
+                        raise ConnectionError(f"{self.sender} ended the multicast before we had the whole file")
+                    return
+        finally:
+            self.close()
+
+    def receive_datagram(self, sequence, payload):
+        """Write a datagram's data and verify its chunk once the chunk is complete"""
+        offset = sequence * DATAGRAM_PAYLOAD
+        if len(payload) != min(DATAGRAM_PAYLOAD, self.file_size - offset):
+            return
+        self.app_controller.file_manager.write_at(self.f, payload, offset)
+        self.have[sequence] = 1
+        self.missing -= 1
+        index = sequence // DATAGRAMS_PER_CHUNK
+        self.chunk_missing[index] -= 1
+        if self.chunk_missing[index]:
+            return
+
+        chunk_offset, chunk_length = integrity.chunk_range(index, self.file_size)
+        self.f.seek(chunk_offset)
+        if integrity.hash_leaf(self.f.read(chunk_length)) != self.leaves[index]:
+            logger.warning(f"Chunk {index} of {self.file_name} failed verification, asking for it again")
+            first = index * DATAGRAMS_PER_CHUNK
+            count = -(-chunk_length // DATAGRAM_PAYLOAD)
+            self.have[first:first + count] = bytes(count)
+            self.missing += count
+            self.chunk_missing[index] = count
+
+    def answer_poll(self):
+        """Tell the sharer which datagrams we still need, or that we're done"""
+        if self.missing:
+            ranges = missing_ranges(self.have, MAX_NACK_RANGES)
+            message = DATAGRAM.pack(self.session_id, KIND_NACK, self.receiver_id) + b''.join(
+                NACK_RANGE.pack(first, count) for first, count in ranges
+            )
+        else:
+            message = DATAGRAM.pack(self.session_id, KIND_DONE, self.receiver_id)
+        try:
+            self.repair_socket.sendto(message, self.sender_address)
+        except OSError as e:
+            logger.warning(f"Could not answer {self.sender}'s poll: {e}")
+
+    def complete(self):
+        """Get the verified file onto disk"""
+        disk_io.commit(self.f)
+        disk_io.release_cache(self.f)
+        self.f.close()
+
+    def publish(self):
+        """Move the file into the group downloads and offer it to the group"""
+        save_path = self.app_controller.swarm.add_download(
+            self.group_name, self.content_hash, self.file_name, self.file_size, self.leaves, self.part_path
+        )
+        logger.info(f"Received {self.file_name} from {self.sender} over group multicast")
+        self.app_controller.add_temp_message(f"Received {self.file_name} from {self.sender} in group {self.group_name}")
+        return save_path
+
+    def close(self):
+        self.group_socket.close()
+        self.repair_socket.close()
+        if not self.f.closed:
+            self.f.close()
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+
+class MulticastManager:
+    def __init__(self, app_controller, group=DEFAULT_GROUP, port=DEFAULT_PORT, interface=None,
+                 rate=None, ttl=DEFAULT_TTL, loss=0.0):
+        self.app_controller = app_controller
+        self.group = group
+        self.port = port
+        self.interface = interface  # local address to multicast on; None lets the system choose
+        self.rate = rate
+        self.ttl = ttl
+        self.loss = loss            # share of datagrams dropped on arrival, for testing repairs
+        self.sessions = {}          # {session_id: MulticastReceiver}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, app_controller):
+        """Create a manager configured by the P2P_MULTICAST_* variables"""
+        return cls(
+            app_controller,
+            group=os.environ.get('P2P_MULTICAST_GROUP', DEFAULT_GROUP),
+            port=int(os.environ.get('P2P_MULTICAST_PORT', DEFAULT_PORT)),
+            interface=os.environ.get('P2P_MULTICAST_INTERFACE') or None,
+            rate=parse_rate(os.environ.get('P2P_MULTICAST_RATE', DEFAULT_RATE)),
+            ttl=int(os.environ.get('P2P_MULTICAST_TTL', DEFAULT_TTL)),
+            loss=float(os.environ.get('P2P_MULTICAST_LOSS', 0))
+        )
+
+    def open_send_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+        # Other members on this machine receive the group's traffic too
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if self.interface:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        sock.bind(('', 0))
+        return sock
+
+    def open_receive_socket(self, group, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Every session, and every member on this machine, listens on the same port
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        try:
+            sock.bind(('', port))
+            membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(self.interface or '0.0.0.0'))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def distribute(self, group_name, path, members=None):
+        """Send a file to group members over multicast; returns the members that received it"""
+        swarm = self.app_controller.swarm
+        me = self.app_controller.current_user.username
+        members = members or self.app_controller.group_manager.get_group_members(group_name)
+        stat = os.stat(path)
+        content_hash, leaves = self.app_controller.hash_cache.hash_file(path)
+        # Receivers fetch the hash tree from us, and fall back to swarm downloading from us
+        swarm.index_file(path, stat, group_name, content_hash, leaves)
+        file_entry = {
+            'content_hash': content_hash,
+            'file_name': os.path.basename(path),
+            'file_size': stat.st_size,
+            'path': path
+        }
+        swarm.record_holder(group_name, me, [file_entry])
+
+        sender = MulticastSender(self, group_name, path, stat.st_size)
+        repair_port = sender.sock.getsockname()[1]
+        for receiver_id, member in enumerate(members):
+            if member == me or member not in self.app_controller.users:
+                continue
+            try:
+                response = self.app_controller.network.send_message(self.app_controller.users[member], {
+                    'type': 'multicast_offer',
+                    'group_name': group_name,
+                    'sender': me,
+                    'session_id': sender.session_id,
+                    'receiver_id': receiver_id,
+                    'repair_port': repair_port,
+                    'group': self.group,
+                    'port': self.port,
+                    **file_entry,
+                    'timestamp': datetime.now().isoformat()
+                })
+            except Exception as e:
+                logger.warning(f"Could not offer {file_entry['file_name']} to {member}: {e}")
+                continue
+            status = response.get('status') if response else None
+            if status == 'joining':
+                sender.receivers[receiver_id] = member
+            elif status != 'have':
+                logger.warning(f"{member} won't take {file_entry['file_name']} over multicast: "
+                               f"{response.get('message', 'Unknown error') if response else 'no response'}")
+
+        if not sender.receivers:
+            sender.sock.close()
+            return []
+
+        logger.info(f"Multicasting {file_entry['file_name']} to {len(sender.receivers)} members of {group_name}")
+        share = self.app_controller.network.bandwidth.open_share(f"group:{group_name}", bandwidth.UPLOAD, limit=self.rate)
+        start_time = time.time()
+        try:
+            done = sender.run(share)
+        finally:
+            share.close()
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(f"Multicast {file_entry['file_name']} to {len(done)}/{len(sender.receivers)} members "
+                    f"at {self.app_controller.file_manager.format_file_size(stat.st_size / elapsed)}/s")
+        return done
+
+    def handle_offer(self, message):
+        """Join a multicast session a member offers us, unless we already hold the file"""
+        group_name = message.get('group_name')
+        sender = message.get('sender')
+        if sender not in self.app_controller.group_manager.get_group_members(group_name) or sender not in self.app_controller.users:
+            return {'type': 'multicast_ack', 'status': 'error', 'message': 'Not a member of this group'}
+
+        file_entry = {key: message[key] for key in ('content_hash', 'file_name', 'file_size', 'path')}
+        swarm = self.app_controller.swarm
+        swarm.record_holder(group_name, sender, [file_entry])
+        if self.app_controller.content_store.find(message['content_hash'], message['file_size']):
+            return {'type': 'multicast_ack', 'status': 'have'}
+
+        try:
+            # The hash tree comes first, so every chunk can be checked as it completes
+            leaves = swarm.fetch_leaves(group_name, message['content_hash'], [sender], message['file_size'])
+            partial_dir = os.path.join(get_group_download_dir(), PARTIAL_DIR_NAME)
+            os.makedirs(partial_dir, exist_ok=True)
+            part_path = os.path.join(partial_dir, f"{message['content_hash']}.{message['session_id']}.{message['receiver_id']}.multicast")
+            receiver = MulticastReceiver(self, message, leaves, part_path)
+        except Exception as e:
+            logger.error(f"Can't join the multicast of {message['file_name']} from {sender}: {e}")
+            return {'type': 'multicast_ack', 'status': 'error', 'message': str(e)}
+
+        with self.lock:
+            self.sessions[receiver.session_id] = receiver
+        threading.Thread(target=self.receive, args=(receiver,), daemon=True).start()
+        return {'type': 'multicast_ack', 'status': 'joining', 'repair_port': receiver.repair_port}
+
+    def receive(self, receiver):
+        try:
+            receiver.run()
+        except Exception as e:
+            logger.warning(f"Multicast of {receiver.file_name} from {receiver.sender} failed ({e}), "
+                           f"downloading it from the swarm instead")
+            try:
+                self.app_controller.swarm.download(receiver.group_name, receiver.content_hash)
+            except Exception as e:
+                logger.error(f"Could not download {receiver.file_name}: {e}")
+        finally:
+            with self.lock:
+                self.sessions.pop(receiver.session_id, None)
@@ -2,16 +2,34 @@ import socket
 import threading
 import json
 import logging
+import os
 from datetime import datetime 
 import time
+from Backend.async_server import AsyncServer
+from Backend.bandwidth import BandwidthScheduler
+from Backend import protocol
+from Backend.connection_pool import ConnectionPool, CONNECTION_HELLO, PERSISTENT_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
+SERVER_BACKLOG = 1024  # connections the kernel queues for us while we're busy
+CLIENT_TIMEOUT = 30    # seconds a client gets to send its request
+# Requests after which the connection carries file data; these are handled by
+# blocking code that streams between the socket and the disk without copies
+STREAM_MESSAGES = ('file_transfer_start', 'file_stripe', 'file_batch_start', 'directory_fetch', 'swarm_fetch')
+ENGINE_ASYNCIO = 'asyncio'    # one event loop accepts and reads every connection
+ENGINE_THREADED = 'threaded'  # a thread per connection
+
 class NetworkManager:
     def __init__(self, app_controller):
         self.app_controller = app_controller
         self.server_socket = None
         self.is_server_running = False
+        self.async_server = None
+        self.server_engine = os.environ.get('P2P_SERVER_ENGINE', ENGINE_ASYNCIO)
+        if self.server_engine not in (ENGINE_ASYNCIO, ENGINE_THREADED):
+            logger.warning(f"Unknown server engine {self.server_engine}, using {ENGINE_ASYNCIO}")
+            self.server_engine = ENGINE_ASYNCIO
         self.discovery_socket = None
         self.discovery_listener_running = False
         self.all_ports = list(range(12345, 12370))
@@ -20,6 +38,12 @@ class NetworkManager:
         self.local_ip = self.get_local_ip()
         logger.info(f"Using local network IP: {self.local_ip}")
         
+        # Shared by every transfer so they can't starve each other or control traffic
+        self.bandwidth = BandwidthScheduler.from_environment()
+        
+        # Open connections to peers, reused for their next messages
+        self.connection_pool = ConnectionPool(self)
+
         # Initialize known peers
         self.known_peers = {}
         self.discovered_peers_cache = []
@@ -155,12 +179,9 @@ class NetworkManager:
                 
                 # Bind to all interfaces directly - better for localhost communication
                 self.server_socket.bind(('0.0.0.0', current_port))
-                self.server_socket.listen(5)
+                self.server_socket.listen(SERVER_BACKLOG)
                 self.is_server_running = True
-                
-                # Start server thread
-                server_thread = threading.Thread(target=self.server_listener, daemon=True)
-                server_thread.start()
+                self.start_server_engine()
                 
                 logger.info(f"Server started on all interfaces, port {current_port}")
                 return current_port
@@ -177,11 +198,9 @@ class NetworkManager:
             logger.warning("Trying one last attempt with fallback binding...")
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.bind(('0.0.0.0', 12345))
-            self.server_socket.listen(5)
+            self.server_socket.listen(SERVER_BACKLOG)
             self.is_server_running = True
-            
-            server_thread = threading.Thread(target=self.server_listener, daemon=True)
-            server_thread.start()
+            self.start_server_engine()
             
             logger.info("Server started on fallback port 12345")
             return 12345
@@ -189,6 +208,16 @@ class NetworkManager:
             logger.error(f"Final fallback server start failed: {e}")
             return None
     
+    def start_server_engine(self):
+        """Serve connections to the listening socket with the configured engine"""
+        if self.server_engine == ENGINE_THREADED:
+            server_thread = threading.Thread(target=self.server_listener, daemon=True)
+            server_thread.start()
+        else:
+            self.async_server = AsyncServer(self, self.server_socket, CLIENT_TIMEOUT)
+            self.async_server.start()
+        logger.info(f"Serving connections with the {self.server_engine} engine")
+    
     def server_listener(self):
         """Listen for incoming connections"""
         while self.is_server_running:
@@ -207,28 +236,28 @@ class NetworkManager:
     def handle_client(self, client_socket, address):
         """Handle client connection and process messages"""
         try:
-            client_socket.settimeout(30)
+            client_socket.settimeout(CLIENT_TIMEOUT)
             data = client_socket.recv(8192)
             if not data:
                 return
             
+            if protocol.is_framed(data):
+                self.serve_connection(client_socket, data, address)
+                return
+            
             try:
-                message = json.loads(data.decode())
-                msg_type = message.get('type')
+                # Older peers send a single bare JSON request
+                message = protocol.read_json(client_socket, data)
                 
-                if msg_type == 'file_transfer_start':
-                    response = self.app_controller.handle_file_transfer_start(message)
-                    client_socket.send(json.dumps(response).encode())
-                    
-                    if response.get('status') == 'ready':
-                        self.app_controller.receive_file_chunks(client_socket)
+                if self.is_stream_message(message):
+                    self.handle_stream(client_socket, message)
                 else:
                     response = self.app_controller.process_message(message)
                     if response:
-                        client_socket.send(json.dumps(response).encode())
+                        client_socket.sendall(json.dumps(response).encode())
                         
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON decode error: {e}")
+            except protocol.ProtocolError as e:
+                logger.error(f"Protocol error: {e}")
             except Exception as e:
                 logger.error(f"Message processing error: {e}")
                 
@@ -242,6 +271,56 @@ class NetworkManager:
             except:
                 pass
     
+    def serve_connection(self, client_socket, data, address):
+        """Answer framed requests on a connection until the peer closes it"""
+        decoder = protocol.FrameDecoder()
+        decoder.feed(data)
+        frame_type = protocol.FRAME_JSON
+        while True:
+            try:
+                message = protocol.read_message(client_socket, decoder)
+            except (protocol.ConnectionClosed, socket.timeout):
+                return
+            if message.get('type') == CONNECTION_HELLO:
+                # The peer keeps this connection for its next messages, in the codec the hello settles on
+                ack, next_frame_type, multiplexed = self.connection_pool.accept_hello(message)
+                protocol.send_message(client_socket, ack)
+                frame_type = next_frame_type
+                if multiplexed:
+                    # From here on the connection is a session, read by this thread until it closes
+                    session = self.connection_pool.accept_session(client_socket, frame_type, message, address)
+                    session.read_loop(bytes(decoder.buffer))
+                    return
+            else:
+                response = self.app_controller.process_message(message)
+                # Every request gets an answer, if only null, so the peer knows when it's done
+                protocol.send_message(client_socket, response or None, frame_type)
+            client_socket.settimeout(PERSISTENT_TIMEOUT)
+    
+    @staticmethod
+    def is_stream_message(message):
+        """Whether file data follows this request on its connection"""
+        return message.get('type') in STREAM_MESSAGES
+    
+    def handle_stream(self, client_socket, message):
+        """Hand a blocking connection that carries file data to the handler for its request"""
+        msg_type = message.get('type')
+        
+        if msg_type == 'file_transfer_start':
+            response = self.app_controller.handle_file_transfer_start(message)
+            client_socket.sendall(json.dumps(response).encode())
+            
+            if response.get('status') == 'ready':
+                self.app_controller.receive_file_chunks(client_socket, message.get('request_id'))
+        elif msg_type == 'file_stripe':
+            self.app_controller.receive_file_stripe(client_socket, message)
+        elif msg_type == 'file_batch_start':
+            self.app_controller.receive_file_batch(client_socket, message)
+        elif msg_type == 'directory_fetch':
+            self.app_controller.serve_directory_fetch(client_socket, message)
+        elif msg_type == 'swarm_fetch':
+            self.app_controller.serve_swarm_fetch(client_socket, message)
+    
     def start_discovery_listener(self, current_user):
         """Start a persistent discovery listener on a dedicated port"""
         if self.discovery_listener_running:
@@ -513,12 +592,30 @@ class NetworkManager:
                         logger.info(f"Keeping {key}'s existing IP {existing_ip} instead of localhost")
                         continue
                 
+                previous = self.known_peers.get(key, {})
                 self.known_peers[key] = {
                     'ip': peer['ip'],
                     'port': peer['port'],
                     'discovery_port': peer.get('discovery_port', peer['port'] + 100),
                     'last_seen': time.time()
                 }
+                # Keep what earlier transfers learned about this peer's link
+                if 'chunk_size' in previous:
+                    self.known_peers[key]['chunk_size'] = previous['chunk_size']
+
+    def get_peer_chunk_size(self, username):
+        """Get the frame size the last transfer to a peer settled on"""
+        return self.known_peers.get(username, {}).get('chunk_size')
+
+    def remember_peer_chunk_size(self, peer, chunk_size):
+        """Remember the frame size that worked best for a peer"""
+        entry = self.known_peers.setdefault(peer.username, {
+            'ip': peer.ip,
+            'port': peer.port,
+            'discovery_port': peer.port + 100,
+            'last_seen': time.time()
+        })
+        entry['chunk_size'] = chunk_size
 
     def fix_peer_ip_manually(self, username, correct_ip):
         """Manually fix a peer's IP address"""
@@ -808,22 +905,8 @@ class NetworkManager:
             connect_ip = peer.ip
             logger.info(f"Connecting to {peer.username} at {connect_ip}:{peer.port}")
             
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(timeout)
-            
-            # Try to connect
-            sock.connect((connect_ip, peer.port))
-            
-            # Send the message
-            sock.send(json.dumps(message_data).encode())
-            
-            # Wait for response
-            response = sock.recv(8192)
-            sock.close()
-            
-            if response:
-                return json.loads(response.decode())
-            return None
+            # Goes over an open connection to the peer when there is one
+            return self.connection_pool.request((connect_ip, peer.port), message_data, timeout)
             
         except socket.timeout:
             logger.error(f"Connection to {peer.username} timed out at {connect_ip}:{peer.port}")
@@ -866,6 +949,12 @@ class NetworkManager:
         self.is_server_running = False
         self.discovery_listener_running = False
         
+        # Sessions the event loop serves are closed while it still runs
+        self.connection_pool.close_all()
+        
+        if self.async_server:
+            self.async_server.stop()
+
         if self.server_socket:
             try:
                 self.server_socket.close()
@@ -0,0 +1,133 @@
+import json
+import struct
+
+from Backend import codec
+
+# Wire format for control messages. Each message travels in a frame: an
+# 8 byte header (magic, protocol version, payload type, payload length)
+# followed by the payload, so a message of any size up to the limit arrives
+# whole however the network splits it, and one connection can carry any
+# number of messages back to back. Frames start with the magic, and bare
+# JSON requests from older peers start with a brace, so a server tells the
+# two apart from the first byte of a connection. The bare JSON form is
+# still spoken to peers that don't understand frames. A payload is JSON or,
+# on connections whose peers agreed on it in their hello, the compact
+# encoding in codec.py; each frame says which, so a connection can mix them.
+# Connections that carry many concurrent messages wrap them in the stream
+# frames of session.py.
+
+MAGIC = b'P2'
+VERSION = 1
+HEADER = struct.Struct('>2sBBI')  # magic, version, payload type, payload length
+FRAME_JSON = 1                    # payload is a UTF-8 JSON document
+FRAME_BINARY = 2                  # payload is in the compact binary encoding
+FRAME_STREAM = 3                  # payload is a piece of a message on a multiplexed stream
+FRAME_WINDOW = 4                  # payload gives a multiplexed stream more room to send
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # largest payload accepted, for catalogs and member lists
+MAX_JSON_SIZE = 64 * 1024          # largest bare JSON message accepted from older peers
+RECEIVE_SIZE = 64 * 1024
+
+class ProtocolError(Exception):
+    """The peer sent something that isn't a valid frame"""
+
+class ConnectionClosed(ConnectionError):
+    """The connection closed between messages"""
+
+def is_framed(data):
+    """Whether a connection whose first bytes are data speaks in frames"""
+    return data[:1] == MAGIC[:1]
+
+def encode_frame(frame_type, payload):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes is larger than {MAX_FRAME_SIZE}")
+    return HEADER.pack(MAGIC, VERSION, frame_type, len(payload)) + payload
+
+def encode_payload(message, frame_type=FRAME_JSON):
+    """Encode a message as the payload of a frame; returns the payload type it ended up in"""
+    if frame_type == FRAME_BINARY and codec.suits(message):
+        return FRAME_BINARY, codec.encode(message)
+    return FRAME_JSON, json.dumps(message).encode()
+
+def encode_message(message, frame_type=FRAME_JSON):
+    """Frame a message for sending"""
+    return encode_frame(*encode_payload(message, frame_type))
+
+def decode_message(frame_type, payload):
+    """Turn a frame's payload back into a message"""
+    if frame_type == FRAME_BINARY:
+        try:
+            return codec.decode(payload)
+        except codec.CodecError as e:
+            raise ProtocolError(str(e))
+    if frame_type == FRAME_JSON:
+        try:
+            return json.loads(payload.decode())
+        except RecursionError:
+            raise ProtocolError("JSON message is nested too deeply")
+    raise ProtocolError(f"Unknown frame type {frame_type}")
+
+class FrameDecoder:
+    """Splits a byte stream back into frames however it was segmented"""
+
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_frame(self):
+        """The next whole frame as (type, payload), or None until more data arrives"""
+        if len(self.buffer) < HEADER.size:
+            return None
+        magic, version, frame_type, length = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ProtocolError("Stream is out of step: frame doesn't start with the magic")
+        if version != VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        if length > self.max_size:
+            raise ProtocolError(f"Frame of {length} bytes is larger than {self.max_size}")
+        end = HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        payload = bytes(self.buffer[HEADER.size:end])
+        del self.buffer[:end]
+        return frame_type, payload
+
+    def has_partial(self):
+        """Whether part of a frame is waiting for the rest"""
+        return bool(self.buffer)
+
+def read_message(sock, decoder):
+    """Block until the next whole message arrives on a framed connection"""
+    while True:
+        frame = decoder.next_frame()
+        if frame:
+            return decode_message(*frame)
+        data = sock.recv(RECEIVE_SIZE)
+        if not data:
+            if decoder.has_partial():
+                raise ConnectionError("Connection closed part way through a frame")
+            raise ConnectionClosed("Connection closed")
+        decoder.feed(data)
+
+def send_message(sock, message, frame_type=FRAME_JSON):
+    sock.sendall(encode_message(message, frame_type))
+
+def read_json(sock, data=b'', max_size=MAX_JSON_SIZE):
+    """Read one bare JSON message, as older peers send them, however many segments it arrives in"""
+    while True:
+        if data:
+            try:
+                return json.loads(data.decode())
+            except RecursionError:
+                raise ProtocolError("JSON message is nested too deeply")
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                if len(data) > max_size:
+                    raise ProtocolError(f"Message is larger than {max_size} bytes")
+        received = sock.recv(8192)
+        if not received:
+            if data:
+                raise ConnectionError("Connection closed part way through a message")
+            raise ConnectionClosed("Connection closed")
+        data += received
@@ -0,0 +1,148 @@
+import os
+import queue
+import threading
+import time
+
+# Pipelined file reading for senders that copy data through userspace. A
+# background thread reads ahead into a small ring of reusable buffers while
+# the sending thread drains them, so a slow disk and a slow network overlap
+# instead of taking turns. The ring is bounded: once every buffer is full
+# the reader waits for the sender to hand one back. The thread and the
+# hand-offs cost more than they save when reads come from the page cache,
+# so senders go through AdaptiveReader, which reads inline and only starts
+# reading ahead once reads are seen to take longer than sending.
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_DEPTH = 4  # buffers in the ring; memory use is depth * buffer_size
+STALL_WINDOW = 4   # inline reads timed against the consumer before deciding again
+STALL_RATIO = 2.0  # read ahead once reads take this many times longer than consuming
+
+class PipelinedReader:
+    """Read a file range ahead of its consumer into a bounded ring of buffers"""
+
+    def __init__(self, f, offset=0, end=None, buffer_size=DEFAULT_BUFFER_SIZE, depth=DEFAULT_DEPTH):
+        self.f = f
+        self.offset = offset
+        self.end = end
+        self.free = queue.Queue()
+        self.filled = queue.Queue()
+        for _ in range(depth):
+            self.free.put(bytearray(buffer_size))
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.read_loop, name="file-reader", daemon=True)
+        self.thread.start()
+
+    def read_loop(self):
+        position = self.offset
+        fd = self.f.fileno()
+        if not hasattr(os, 'preadv'):
+            # Without positional reads the file handle is ours until we're done
+            self.f.seek(position)
+        try:
+            while self.end is None or position < self.end:
+                buf = self.free.get()
+                if buf is None or self.stopped:
+                    return
+                size = len(buf) if self.end is None else min(len(buf), self.end - position)
+                view = memoryview(buf)[:size]
+                if hasattr(os, 'preadv'):
+                    read = os.preadv(fd, [view], position)
+                else:
+                    read = self.f.readinto(view)
+                if not read:
+                    break
+                position += read
+                self.filled.put((buf, read))
+        except Exception as e:
+            self.error = e
+        self.filled.put((None, 0))
+
+    def __iter__(self):
+        """Yield views of the data in order; each view is only valid until the next one"""
+        previous = None
+        try:
+            while True:
+                if previous is not None:
+                    self.free.put(previous)
+                    previous = None
+                buf, length = self.filled.get()
+                if buf is None:
+                    if self.error:
+                        raise self.error
+                    return
+                previous = buf
+                yield memoryview(buf)[:length]
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop reading ahead"""
+        self.stopped = True
+        self.free.put(None)
+
+class AdaptiveReader:
+    """Read a file range inline, switching to a PipelinedReader once reads stall the consumer"""
+
+    def __init__(self, f, offset=0, end=None, buffer_size=DEFAULT_BUFFER_SIZE, depth=DEFAULT_DEPTH):
+        self.f = f
+        self.position = offset
+        self.end = end
+        self.buffer_size = buffer_size
+        self.depth = depth
+        self.buffer = bytearray()
+        self.pipeline = None            # iterator over a PipelinedReader once reads stall
+        self.pending = memoryview(b'')  # rest of the pipeline's current buffer
+        self.reads = 0
+        self.read_time = 0.0
+        self.consume_time = 0.0
+        self.returned_at = None
+
+    @property
+    def pipelined(self):
+        return self.pipeline is not None
+
+    def read(self, size):
+        """Return a view of up to size bytes, empty at the end; it is only valid until the next read"""
+        if self.pipeline is None and self.returned_at is not None:
+            self.consume_time += time.perf_counter() - self.returned_at
+            if self.reads == STALL_WINDOW:
+                # Reading ahead only pays when the consumer sits waiting on the disk;
+                # from the page cache reads and sends both take about a memory copy
+                if self.read_time > self.consume_time * STALL_RATIO:
+                    self.pipeline = iter(PipelinedReader(
+                        self.f, self.position, self.end, self.buffer_size, self.depth
+                    ))
+                self.reads = 0
+                self.read_time = self.consume_time = 0.0
+        if self.pipeline is not None:
+            return self.read_pipelined(size)
+
+        if self.end is not None:
+            size = min(size, self.end - self.position)
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        view = memoryview(self.buffer)[:size]
+        read_start = time.perf_counter()
+        if hasattr(os, 'preadv'):
+            read = os.preadv(self.f.fileno(), [view], self.position) if size > 0 else 0
+        else:
+            self.f.seek(self.position)
+            read = self.f.readinto(view) if size > 0 else 0
+        self.read_time += time.perf_counter() - read_start
+        self.position += read
+        self.reads += 1
+        self.returned_at = time.perf_counter()
+        return view[:read]
+
+    def read_pipelined(self, size):
+        if not self.pending:
+            self.pending = next(self.pipeline, memoryview(b''))
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+    def close(self):
+        """Stop reading ahead, if we started"""
+        if self.pipeline is not None:
+            self.pipeline.close()
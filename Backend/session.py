@@ -0,0 +1,427 @@
+import collections
+import logging
+import socket
+import struct
+import threading
+import time
+
+from Backend import protocol
+from Backend.protocol import ConnectionClosed, ProtocolError
+
+logger = logging.getLogger(__name__)
+
+# Many requests at once over one connection between two peers. Each request
+# and its response travel on a stream of their own, cut into pieces that
+# are interleaved with other streams' pieces, so a chat message or an ack
+# goes out between the pieces of a large catalog instead of waiting for it,
+# and either peer can send requests on the connection no matter which one
+# opened it. Streams the opener starts have odd IDs and the other side's
+# even ones, so the two never collide.
+#
+# Short messages are sent ahead of bulky ones. Each stream may only have
+# INITIAL_WINDOW bytes in flight until the receiver gives it more room, and
+# a receiver stops handing out room while too many complete requests are
+# queued for its handlers, so a fast sender can't pile up work or memory on
+# a slow peer. File data keeps its own connections, where it can be sent
+# from the disk without copies.
+#
+# Session keeps the streams and decides what to send next; the code driving
+# a connection feeds it what arrives and writes out what it hands back.
+# ThreadedSession drives one with a reader and a writer thread; the event
+# loop server drives its own.
+
+MUX_VERSION = 1
+STREAM_HEADER = struct.Struct('>IBB')  # stream ID, flags, priority
+WINDOW_UPDATE = struct.Struct('>II')   # stream ID, bytes of extra room
+FLAG_END = 1                           # last piece of the stream's message
+FLAG_RESET = 2                         # the sender abandoned the stream
+PRIORITY_INTERACTIVE = 0               # chat, acks and other short messages
+PRIORITY_BULK = 1                      # anything longer than BULK_SIZE
+BULK_SIZE = 64 * 1024
+PIECE_SIZE = 16 * 1024                 # message bytes per stream frame
+INITIAL_WINDOW = 256 * 1024            # bytes a stream may send before the receiver makes room
+MAX_WAITING = 8 * 1024 * 1024          # bytes of complete requests queued for handlers before room is held back
+MAX_STREAMS = 256                      # concurrent streams a peer may open
+MAX_STREAM_ID = 2 ** 32 - 1
+WRITE_BATCH = 64 * 1024                # frames gathered into one write
+
+class Stream:
+    """One message and its reply on a session"""
+
+    def __init__(self, stream_id, priority):
+        self.stream_id = stream_id
+        self.priority = priority
+        self.outgoing = None       # our encoded message, while it is being sent
+        self.sent = 0
+        self.send_window = INITIAL_WINDOW
+        self.queued = False        # waiting in the session's send queue
+        self.incoming = bytearray()
+        self.unacknowledged = 0    # bytes received and not yet given back as room
+        self.size = 0              # size of the peer's message once complete
+        self.reply = None
+        self.error = None
+        self.finished = threading.Event()  # a stream we opened got its reply or failed
+
+class Session:
+    def __init__(self, opener, frame_type, handler, workers):
+        self.frame_type = frame_type  # how messages are encoded, settled by the hello
+        self.handler = handler        # turns the peer's request into its reply
+        self.workers = workers        # executor the handler runs on
+        self.lock = threading.Condition()
+        self.streams = {}
+        self.next_stream_id = 1 if opener else 2
+        self.refused = set()  # streams of the peer's we turned down while it was still sending them
+        self.decoder = protocol.FrameDecoder()
+        self.control = collections.deque()  # window updates and resets, sent ahead of message data
+        self.send_queues = (collections.deque(), collections.deque())  # by priority
+        self.waiting = 0    # bytes of complete messages not yet handled
+        self.held = set()   # streams whose room is held back until handlers catch up
+        self.closed = False
+        self.last_active = time.monotonic()
+
+    def ready(self):
+        """Called with frames waiting to be written; the driver's hook"""
+
+    def shutdown(self):
+        """Close the session and its connection"""
+        self.close()
+
+    def request(self, message, timeout, priority=None):
+        """Send a request on a new stream and wait for the reply"""
+        stream = self.open_stream(message, priority)
+        if not stream.finished.wait(timeout):
+            self.reset(stream)
+            raise socket.timeout("Timed out waiting for the reply")
+        if stream.error:
+            raise stream.error
+        self.handled(stream)
+        try:
+            return self.decode(stream.reply)
+        except (ProtocolError, ValueError) as e:
+            raise ConnectionError(f"Reply could not be decoded: {e}")
+
+    def open_stream(self, message, priority=None):
+        payload = self.encode(message)
+        with self.lock:
+            if self.closed or self.next_stream_id > MAX_STREAM_ID:
+                raise ConnectionClosed("Session is closed")
+            stream = Stream(self.next_stream_id, self.priority_for(payload, priority))
+            self.next_stream_id += 2
+            self.streams[stream.stream_id] = stream
+            self.last_active = time.monotonic()
+            self.send(stream, payload)
+        return stream
+
+    def respond(self, stream, message):
+        """Send the reply to a request the peer made"""
+        payload = self.encode(message)
+        with self.lock:
+            self.handled(stream)
+            if self.closed or self.streams.get(stream.stream_id) is not stream:
+                return  # the peer gave up on it
+            self.send(stream, payload)
+
+    def encode(self, message):
+        frame_type, payload = protocol.encode_payload(message, self.frame_type)
+        if len(payload) >= protocol.MAX_FRAME_SIZE:
+            raise ProtocolError(f"Message of {len(payload)} bytes is larger than {protocol.MAX_FRAME_SIZE}")
+        return bytes((frame_type,)) + payload
+
+    @staticmethod
+    def decode(data):
+        # Left to the thread that wants the message, so a long one doesn't hold up the connection
+        return protocol.decode_message(data[0], bytes(data[1:]))
+
+    @staticmethod
+    def priority_for(payload, priority):
+        if priority is not None:
+            return priority
+        return PRIORITY_BULK if len(payload) > BULK_SIZE else PRIORITY_INTERACTIVE
+
+    def send(self, stream, payload):
+        stream.outgoing = payload
+        stream.sent = 0
+        self.schedule(stream)
+
+    def schedule(self, stream):
+        """Queue a stream to send its next piece if it has one and room for it"""
+        if not stream.queued and stream.outgoing is not None and stream.send_window > 0:
+            stream.queued = True
+            self.send_queues[stream.priority].append(stream)
+            self.lock.notify_all()
+            self.ready()
+
+    def send_control(self, frame_type, payload):
+        self.control.append(protocol.encode_frame(frame_type, payload))
+        self.lock.notify_all()
+        self.ready()
+
+    def reset(self, stream):
+        """Abandon a stream and tell the peer"""
+        with self.lock:
+            if self.streams.pop(stream.stream_id, None) is stream and not self.closed:
+                self.send_control(protocol.FRAME_STREAM, STREAM_HEADER.pack(stream.stream_id, FLAG_RESET, 0))
+            stream.outgoing = None
+            self.handled(stream)  # its reply may have completed just as it was given up on
+
+    def refuse(self, stream_id):
+        """Turn down a stream the peer is still sending, and ignore the rest of it"""
+        self.refused.add(stream_id)
+        self.send_control(protocol.FRAME_STREAM, STREAM_HEADER.pack(stream_id, FLAG_RESET, 0))
+
+    def take_frames(self, limit=WRITE_BATCH, wait=False):
+        """Frames to write next, up to about limit bytes; with wait, blocks until there are some"""
+        with self.lock:
+            while True:
+                frames = []
+                size = 0
+                while size < limit:
+                    frame = self.next_frame()
+                    if frame is None:
+                        break
+                    frames.append(frame)
+                    size += len(frame)
+                # Queued streams may have been reset since, leaving nothing to send
+                if frames or not wait or self.closed:
+                    return frames
+                self.lock.wait()
+
+    def next_frame(self):
+        if self.control:
+            return self.control.popleft()
+        for queue in self.send_queues:
+            while queue:
+                stream = queue.popleft()
+                stream.queued = False
+                if stream.outgoing is None:
+                    continue  # reset while it waited
+                start = stream.sent
+                stream.sent = min(start + PIECE_SIZE, start + stream.send_window, len(stream.outgoing))
+                stream.send_window -= stream.sent - start
+                last = stream.sent == len(stream.outgoing)
+                frame = protocol.encode_frame(protocol.FRAME_STREAM, STREAM_HEADER.pack(
+                    stream.stream_id, FLAG_END if last else 0, stream.priority
+                ) + stream.outgoing[start:stream.sent])
+                if last:
+                    stream.outgoing = None
+                    if self.is_peer_stream(stream.stream_id):
+                        # Our reply was the stream's last message
+                        self.streams.pop(stream.stream_id, None)
+                else:
+                    # Round robin between the streams of one priority
+                    self.schedule(stream)
+                return frame
+        return None
+
+    def is_peer_stream(self, stream_id):
+        return stream_id % 2 != self.next_stream_id % 2
+
+    def receive(self, data):
+        """Take in bytes from the connection; returns the (stream, data) requests the peer completed"""
+        requests = []
+        with self.lock:
+            self.decoder.feed(data)
+            while True:
+                frame = self.decoder.next_frame()
+                if frame is None:
+                    break
+                frame_type, payload = frame
+                if frame_type == protocol.FRAME_STREAM:
+                    self.receive_piece(payload, requests)
+                elif frame_type == protocol.FRAME_WINDOW:
+                    stream_id, increment = WINDOW_UPDATE.unpack(payload)
+                    stream = self.streams.get(stream_id)
+                    if stream:
+                        stream.send_window += increment
+                        self.schedule(stream)
+                else:
+                    raise ProtocolError(f"Unexpected frame type {frame_type} in a session")
+            self.last_active = time.monotonic()
+        return requests
+
+    def receive_piece(self, payload, requests):
+        stream_id, flags, priority = STREAM_HEADER.unpack_from(payload)
+        stream = self.streams.get(stream_id)
+
+        if stream_id in self.refused:
+            if flags & (FLAG_END | FLAG_RESET):
+                self.refused.discard(stream_id)
+            return
+
+        if flags & FLAG_RESET:
+            if stream:
+                del self.streams[stream_id]
+                stream.outgoing = None
+                self.fail(stream, ConnectionError("The peer abandoned the request"))
+            return
+
+        if stream is None:
+            if not self.is_peer_stream(stream_id):
+                return  # late pieces of the reply to a request we gave up on
+            # Streams don't start in the order they were opened; a short message overtakes a long one
+            if sum(1 for i in self.streams if self.is_peer_stream(i)) >= MAX_STREAMS:
+                self.refuse(stream_id)
+                return
+            stream = Stream(stream_id, min(priority, PRIORITY_BULK))
+            self.streams[stream_id] = stream
+
+        if stream.incoming is None:
+            raise ProtocolError(f"Stream {stream_id} continued after its message ended")
+        piece = payload[STREAM_HEADER.size:]
+        stream.incoming += piece
+        if len(stream.incoming) > protocol.MAX_FRAME_SIZE:
+            logger.error(f"Message on stream {stream_id} is larger than {protocol.MAX_FRAME_SIZE} bytes")
+            if self.is_peer_stream(stream_id) and not flags & FLAG_END:
+                del self.streams[stream_id]
+                self.refuse(stream_id)
+            else:
+                self.reset(stream)
+            self.fail(stream, ConnectionError("Reply is too large"))
+            return
+
+        if not flags & FLAG_END:
+            stream.unacknowledged += len(piece)
+            if stream.unacknowledged >= INITIAL_WINDOW // 2:
+                if self.waiting <= MAX_WAITING:
+                    self.grant(stream)
+                else:
+                    self.held.add(stream)
+            return
+
+        if not stream.incoming:
+            raise ProtocolError(f"Stream {stream_id} ended without a message")
+        data = stream.incoming
+        stream.size = len(data)
+        stream.incoming = None
+        self.waiting += stream.size
+        if self.is_peer_stream(stream_id):
+            requests.append((stream, data))
+        else:
+            del self.streams[stream_id]
+            stream.reply = data
+            stream.finished.set()
+
+    def grant(self, stream):
+        """Give a stream back the room its received bytes took up"""
+        self.send_control(protocol.FRAME_WINDOW, WINDOW_UPDATE.pack(stream.stream_id, stream.unacknowledged))
+        stream.unacknowledged = 0
+
+    def handled(self, stream):
+        """A complete message has been dealt with; its memory no longer counts"""
+        with self.lock:
+            self.waiting -= stream.size
+            stream.size = 0
+            if self.waiting <= MAX_WAITING and self.held:
+                for held in self.held:
+                    if self.streams.get(held.stream_id) is held and held.unacknowledged:
+                        self.grant(held)
+                self.held = set()
+
+    def serve(self, requests):
+        """Run the handler for each request receive returned, off the caller's thread"""
+        for stream, data in requests:
+            try:
+                self.workers.submit(self.answer, stream, data)
+            except RuntimeError:
+                return  # the workers were shut down; so is the app
+
+    def answer(self, stream, data):
+        try:
+            message = self.decode(data)
+        except (ProtocolError, ValueError) as e:
+            logger.error(f"Undecodable message on stream {stream.stream_id}: {e}")
+            self.reset(stream)
+            return
+        try:
+            response = self.handler(message)
+        except Exception as e:
+            logger.error(f"Message processing error: {e}")
+            response = None
+        # Every request gets an answer, if only null, so the peer knows when it's done
+        try:
+            self.respond(stream, response)
+        except (ProtocolError, TypeError, ValueError) as e:
+            logger.error(f"Could not send the reply on stream {stream.stream_id}: {e}")
+            self.reset(stream)
+
+    @staticmethod
+    def fail(stream, error):
+        stream.error = error
+        stream.finished.set()
+
+    def is_idle(self, timeout):
+        with self.lock:
+            return not self.streams and time.monotonic() - self.last_active >= timeout
+
+    def close(self):
+        """Fail every stream still waiting for a reply"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for stream in self.streams.values():
+                if not self.is_peer_stream(stream.stream_id):
+                    if stream.sent == 0:
+                        # None of the request went out, so it can safely go again elsewhere
+                        self.fail(stream, ConnectionClosed("Session closed before the request was sent"))
+                    else:
+                        # The peer may already be acting on it; sending it again could repeat that
+                        self.fail(stream, ConnectionError("Session closed before the reply arrived"))
+            self.streams.clear()
+            self.held = set()
+            self.lock.notify_all()
+
+class ThreadedSession(Session):
+    """A session driven by a reader thread and a writer thread"""
+
+    def __init__(self, sock, opener, frame_type, handler, workers, timeout):
+        super().__init__(opener, frame_type, handler, workers)
+        self.sock = sock
+        self.sock.settimeout(timeout)
+
+    def start(self, read_in_thread=True):
+        """Start the writer, and the reader unless the caller's thread will run read_loop itself"""
+        threading.Thread(target=self.write_loop, daemon=True).start()
+        if read_in_thread:
+            threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def read_loop(self, data=b''):
+        try:
+            while True:
+                if data:
+                    self.serve(self.receive(data))
+                try:
+                    data = self.sock.recv(protocol.RECEIVE_SIZE)
+                except socket.timeout:
+                    continue  # quiet for a while; the pool decides when it has been idle too long
+                if not data:
+                    break
+        except (OSError, ProtocolError) as e:
+            if not self.closed:
+                logger.warning(f"Session error: {e}")
+        finally:
+            self.shutdown()
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def write_loop(self):
+        try:
+            while True:
+                frames = self.take_frames(wait=True)
+                if not frames:
+                    return
+                self.sock.sendall(b''.join(frames))
+        except OSError as e:
+            if not self.closed:
+                logger.warning(f"Session error: {e}")
+            self.shutdown()
+
+    def shutdown(self):
+        self.close()
+        try:
+            # Wakes the reader; the socket is closed once it has stopped
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
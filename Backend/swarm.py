@@ -0,0 +1,453 @@
+import heapq
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+from Backend import bandwidth
+from Backend import disk_io
+from Backend import integrity
+from Backend import protocol
+from Backend.frame_reader import FrameReader
+from Backend.utils import get_group_download_dir
+
+logger = logging.getLogger(__name__)
+
+# Swarm downloads of group files. Members advertise the Merkle root of each
+# file they hold for a group, so identical copies are recognised whoever
+# shared them. A downloader connects to every holder at once and pulls
+# disjoint runs of chunks, sizing each request to the holder's measured
+# throughput; every chunk is checked against the hash tree before it is
+# written, and a chunk that fails goes back to the pool for another holder.
+
+SWARM_REQUEST = struct.Struct('>BQQ')  # op, first chunk, chunk count
+SWARM_OP_END = 0
+SWARM_OP_LEAVES = 1
+SWARM_OP_CHUNKS = 2
+
+REQUEST_TIME = 1.0           # seconds of data to ask a holder for at once
+MAX_REQUEST_CHUNKS = 64
+MAX_HOLDER_FAILURES = 3
+RATE_SMOOTHING = 0.5         # weight of the newest throughput measurement
+MAX_ADVERTISEMENT_SIZE = protocol.MAX_FRAME_SIZE - 4096  # file list per message, leaving room for the rest
+PARTIAL_DIR_NAME = '.partial'
+
+class HolderConnection:
+    """One connection to a member serving a file's chunks"""
+
+    def __init__(self, peer, group_name, content_hash, requester, throttle=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(30)
+            self.sock.connect((peer.ip, peer.port))
+            self.sock.sendall(json.dumps({
+                'type': 'swarm_fetch',
+                'group_name': group_name,
+                'content_hash': content_hash,
+                'requester': requester,
+                'timestamp': datetime.now().isoformat()
+            }).encode())
+
+            # The holder sends nothing more until asked, so this reply is all we read
+            try:
+                response_data = protocol.read_json(self.sock)
+            except protocol.ConnectionClosed:
+                raise ConnectionError(f"{peer.username} closed the connection")
+            if response_data.get('status') != 'ready':
+                raise Exception(f"{peer.username} can't serve the file: {response_data.get('message', 'Unknown error')}")
+            self.file_size = response_data['file_size']
+        except Exception:
+            self.sock.close()
+            raise
+        self.reader = FrameReader(self.sock, integrity.MERKLE_CHUNK_SIZE, throttle)
+
+    def fetch_leaves(self, first, count):
+        """Get the chunk hashes of a run of chunks"""
+        self.sock.sendall(SWARM_REQUEST.pack(SWARM_OP_LEAVES, first, count))
+        data = self.reader.read_exact(count * integrity.DIGEST_SIZE)
+        return [data[i:i + integrity.DIGEST_SIZE] for i in range(0, len(data), integrity.DIGEST_SIZE)]
+
+    def fetch_chunks(self, first, count, buf):
+        """Yield (index, data) for a run of chunks; data is only valid until the next one"""
+        self.sock.sendall(SWARM_REQUEST.pack(SWARM_OP_CHUNKS, first, count))
+        for index in range(first, first + count):
+            _, length = integrity.chunk_range(index, self.file_size)
+            position = 0
+            for view in self.reader.read_chunks(length):
+                buf[position:position + len(view)] = view
+                position += len(view)
+            yield index, memoryview(buf)[:length]
+
+    def close(self):
+        try:
+            self.sock.sendall(SWARM_REQUEST.pack(SWARM_OP_END, 0, 0))
+        except OSError:
+            pass
+        self.sock.close()
+
+class SwarmManager:
+    def __init__(self, app_controller):
+        self.app_controller = app_controller
+        self.local_content = {}  # {content_hash: {'path', 'file_name', 'file_size', 'mtime', 'leaves', 'groups'}}
+        self.content_lock = threading.Lock()
+        self.holder_rates = {}   # {username: bytes per second} from earlier swarm downloads
+
+    def index_file(self, path, stat, group_name, content_hash, leaves):
+        """Remember a hashed file we can serve to a group"""
+        with self.content_lock:
+            entry = self.local_content.get(content_hash)
+            if entry is None or not os.path.exists(entry['path']):
+                entry = self.local_content[content_hash] = {
+                    'path': path,
+                    'file_name': os.path.basename(path),
+                    'file_size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'leaves': leaves,
+                    'groups': set()
+                }
+            entry['groups'].add(group_name)
+
+    def share_files(self, group_name, directory, members):
+        """Index every file in a shared directory and advertise them to the group"""
+        paths = [
+            os.path.join(dir_path, file_name)
+            for dir_path, _, file_names in os.walk(directory)
+            for file_name in file_names
+        ]
+        files = []
+        # Files hashed before come from the cache; only new and changed ones are read
+        for path, content_hash, leaves in self.app_controller.hash_cache.hash_files(paths):
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                logger.warning(f"Not offering {path} to the swarm: {e}")
+                continue
+            self.index_file(path, stat, group_name, content_hash, leaves)
+            files.append({
+                'content_hash': content_hash,
+                'file_name': os.path.basename(path),
+                'file_size': stat.st_size,
+                'path': path
+            })
+
+        self.record_holder(group_name, self.app_controller.current_user.username, files)
+        self.advertise(group_name, files, members)
+        logger.info(f"Offering {len(files)} files from {directory} to group {group_name}")
+
+    def advertise(self, group_name, files, members):
+        """Tell group members which files we hold, split into messages that each fit in one frame"""
+        batches = [[]]
+        batch_size = 0
+        for file_entry in files:
+            entry_size = len(json.dumps(file_entry)) + 2
+            if batches[-1] and batch_size + entry_size > MAX_ADVERTISEMENT_SIZE:
+                batches.append([])
+                batch_size = 0
+            batches[-1].append(file_entry)
+            batch_size += entry_size
+
+        for member in members:
+            if member == self.app_controller.current_user.username or member not in self.app_controller.users:
+                continue
+            peer = self.app_controller.users[member]
+            for batch in batches:
+                if not batch:
+                    continue
+                try:
+                    self.app_controller.network.send_message(peer, {
+                        'type': 'group_content',
+                        'group_name': group_name,
+                        'holder': self.app_controller.current_user.username,
+                        'files': batch,
+                        'timestamp': datetime.now().isoformat()
+                    })
+                except Exception as e:
+                    logger.error(f"Error advertising group files to {member}: {e}")
+                    break
+
+    def handle_content_advertisement(self, message):
+        """Record the files another member holds for a group"""
+        group_name = message.get('group_name')
+        if group_name not in self.app_controller.group_manager.groups:
+            return
+        self.record_holder(group_name, message.get('holder'), message.get('files', []))
+
+    def record_holder(self, group_name, holder, files):
+        group = self.app_controller.group_manager.groups.get(group_name)
+        if group is None:
+            return
+        content = group.setdefault('content', {})  # {content_hash: {'file_name', 'file_size', 'holders': {username: path}}}
+        for file_entry in files:
+            entry = content.setdefault(file_entry['content_hash'], {
+                'file_name': file_entry['file_name'],
+                'file_size': file_entry['file_size'],
+                'holders': {}
+            })
+            entry['holders'][holder] = file_entry.get('path')
+
+    def find_content(self, group_name, holder, path):
+        """Content hash of a file a member advertised under a path, if any"""
+        group = self.app_controller.group_manager.groups.get(group_name, {})
+        for content_hash, entry in group.get('content', {}).items():
+            if entry['holders'].get(holder) == path:
+                return content_hash
+        return None
+
+    def get_holders(self, group_name, content_hash):
+        """Members other than us that advertised a file"""
+        group = self.app_controller.group_manager.groups.get(group_name, {})
+        entry = group.get('content', {}).get(content_hash)
+        if not entry:
+            return []
+        me = self.app_controller.current_user.username
+        return [holder for holder in entry['holders'] if holder != me and holder in self.app_controller.users]
+
+    def serve_fetch(self, client_socket, message):
+        """Serve hashes and chunks of a file we hold to another group member"""
+        content_hash = message.get('content_hash')
+        group_name = message.get('group_name')
+        requester = message.get('requester')
+
+        with self.content_lock:
+            entry = self.local_content.get(content_hash)
+        members = self.app_controller.group_manager.get_group_members(group_name)
+        error = None
+        if entry is None or group_name not in entry['groups']:
+            error = 'File not held for this group'
+        elif requester not in members:
+            error = 'Not a group member'
+        else:
+            try:
+                stat = os.stat(entry['path'])
+                if stat.st_size != entry['file_size'] or stat.st_mtime != entry['mtime']:
+                    error = 'File changed since it was shared'
+            except OSError:
+                error = 'File no longer available'
+            if error:
+                # Stop offering a copy we can no longer vouch for
+                with self.content_lock:
+                    self.local_content.pop(content_hash, None)
+
+        if error:
+            client_socket.sendall(json.dumps({'status': 'error', 'message': error}).encode())
+            return False
+
+        client_socket.sendall(json.dumps({
+            'status': 'ready',
+            'file_size': entry['file_size'],
+            'leaf_count': len(entry['leaves'])
+        }).encode())
+
+        share = self.app_controller.network.bandwidth.open_share(requester, bandwidth.UPLOAD)
+        try:
+            with open(entry['path'], 'rb') as f:
+                reader = FrameReader(client_socket, SWARM_REQUEST.size * 64)
+                while True:
+                    op, first, count = reader.read_struct(SWARM_REQUEST)
+                    if op == SWARM_OP_END:
+                        return True
+                    if first + count > len(entry['leaves']):
+                        raise Exception(f"Request for chunks {first}-{first + count} is out of range")
+
+                    if op == SWARM_OP_LEAVES:
+                        client_socket.sendall(b''.join(entry['leaves'][first:first + count]))
+                    elif op == SWARM_OP_CHUNKS:
+                        offset = first * integrity.MERKLE_CHUNK_SIZE
+                        length = min(count * integrity.MERKLE_CHUNK_SIZE, entry['file_size'] - offset)
+                        share.acquire(length)
+                        if client_socket.sendfile(f, offset, length) != length:
+                            raise Exception("File was truncated while serving it")
+                    else:
+                        raise Exception(f"Unknown swarm request {op}")
+        except Exception as e:
+            logger.error(f"Error serving {entry['file_name']} to {requester}: {e}")
+            return False
+        finally:
+            share.close()
+
+    def download(self, group_name, content_hash):
+        """Download a group file from every member holding it and return the saved path"""
+        group = self.app_controller.group_manager.groups.get(group_name, {})
+        entry = group.get('content', {}).get(content_hash)
+        holders = self.get_holders(group_name, content_hash)
+        if not entry or not holders:
+            raise Exception("No group member is offering this file")
+
+        file_name = entry['file_name']
+        file_size = entry['file_size']
+        leaves = self.fetch_leaves(group_name, content_hash, holders, file_size)
+
+        downloads_dir = get_group_download_dir()
+        partial_dir = os.path.join(downloads_dir, PARTIAL_DIR_NAME)
+        os.makedirs(partial_dir, exist_ok=True)
+        part_path = os.path.join(partial_dir, f"{content_hash}.swarm")
+
+        state = {
+            'pending': list(range(len(leaves))),  # heap of chunk indices still to fetch
+            'in_flight': 0,                       # requests that may still hand chunks back
+            'condition': threading.Condition(),
+            'failures': {}
+        }
+        start_time = time.time()
+
+        with open(part_path, 'wb') as f:
+            if not disk_io.preallocate(f, file_size):
+                f.truncate(file_size)
+            workers = [
+                threading.Thread(
+                    target=self.holder_worker,
+                    args=(holder, group_name, content_hash, leaves, f, state),
+                    daemon=True
+                )
+                for holder in holders
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if not state['pending']:
+                disk_io.commit(f)
+                disk_io.release_cache(f)
+
+        if state['pending']:
+            os.remove(part_path)
+            raise Exception(f"Swarm download of {file_name} failed: {len(state['pending'])} chunks "
+                            f"could not be fetched from any holder")
+
+        save_path = self.add_download(group_name, content_hash, file_name, file_size, leaves, part_path)
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(f"Swarm downloaded {file_name} from {len(holders)} members "
+                    f"at {self.app_controller.file_manager.format_file_size(file_size / elapsed)}/s")
+        return save_path
+
+    def add_download(self, group_name, content_hash, file_name, file_size, leaves, part_path):
+        """Move a verified group file into the downloads and offer it to the group; returns its path"""
+        downloads_dir = get_group_download_dir()
+        save_path = self.app_controller.file_manager.claim_save_path(downloads_dir, file_name)
+        os.replace(part_path, save_path)
+        disk_io.sync_directory(downloads_dir)
+        self.app_controller.content_store.add(content_hash, save_path)
+
+        # We hold a verified copy now, so we can serve it to the rest of the group
+        with self.content_lock:
+            self.local_content[content_hash] = {
+                'path': save_path,
+                'file_name': file_name,
+                'file_size': file_size,
+                'mtime': os.stat(save_path).st_mtime,
+                'leaves': leaves,
+                'groups': {group_name}
+            }
+        files = [{'content_hash': content_hash, 'file_name': file_name, 'file_size': file_size, 'path': save_path}]
+        self.record_holder(group_name, self.app_controller.current_user.username, files)
+        self.advertise(group_name, files, self.app_controller.group_manager.get_group_members(group_name))
+        return save_path
+
+    def fetch_leaves(self, group_name, content_hash, holders, file_size):
+        """Get the file's chunk hashes from the first holder whose tree matches the content hash"""
+        leaf_count = integrity.chunk_count(file_size)
+        requester = self.app_controller.current_user.username
+        for holder in holders:
+            try:
+                conn = HolderConnection(self.app_controller.users[holder], group_name, content_hash, requester)
+                try:
+                    leaves = conn.fetch_leaves(0, leaf_count) if leaf_count else []
+                finally:
+                    conn.close()
+            except Exception as e:
+                logger.warning(f"Could not get chunk hashes from {holder}: {e}")
+                continue
+            if integrity.merkle_root(leaves).hex() == content_hash:
+                return leaves
+            logger.warning(f"Chunk hashes from {holder} don't match the advertised file")
+        raise Exception("No holder sent chunk hashes matching the file")
+
+    def next_request(self, holder, state):
+        """Take a run of consecutive chunks sized to the holder's throughput"""
+        rate = self.holder_rates.get(holder)
+        count = 1
+        if rate:
+            count = max(1, min(MAX_REQUEST_CHUNKS, int(rate * REQUEST_TIME / integrity.MERKLE_CHUNK_SIZE)))
+        with state['condition']:
+            # Chunks a failing holder hands back are picked up by whoever is left
+            while not state['pending']:
+                if not state['in_flight']:
+                    return None
+                state['condition'].wait()
+            state['in_flight'] += 1
+            first = heapq.heappop(state['pending'])
+            taken = 1
+            while taken < count and state['pending'] and state['pending'][0] == first + taken:
+                heapq.heappop(state['pending'])
+                taken += 1
+            return first, taken
+
+    @staticmethod
+    def finish_request(state, unfetched):
+        """Put chunks a request didn't deliver back in the pool"""
+        with state['condition']:
+            for index in unfetched:
+                heapq.heappush(state['pending'], index)
+            state['in_flight'] -= 1
+            state['condition'].notify_all()
+
+    def holder_worker(self, holder, group_name, content_hash, leaves, f, state):
+        """Fetch chunks from one holder until none are left or the holder keeps failing"""
+        file_manager = self.app_controller.file_manager
+        share = self.app_controller.network.bandwidth.open_share(holder, bandwidth.DOWNLOAD)
+        buf = bytearray(integrity.MERKLE_CHUNK_SIZE)
+        conn = None
+        try:
+            while state['failures'].get(holder, 0) < MAX_HOLDER_FAILURES:
+                request = self.next_request(holder, state)
+                if request is None:
+                    return
+                first, count = request
+                outstanding = set(range(first, first + count))
+                try:
+                    if conn is None:
+                        conn = HolderConnection(
+                            self.app_controller.users[holder], group_name, content_hash,
+                            self.app_controller.current_user.username, share.acquire
+                        )
+
+                    fetch_start = time.perf_counter()
+                    received = 0
+                    corrupt = []
+                    for index, data in conn.fetch_chunks(first, count, buf):
+                        received += len(data)
+                        if integrity.hash_leaf(data) != leaves[index]:
+                            corrupt.append(index)
+                            continue
+                        file_manager.write_at(f, data, index * integrity.MERKLE_CHUNK_SIZE)
+                        outstanding.discard(index)
+                    self.record_rate(holder, received, time.perf_counter() - fetch_start)
+
+                    if corrupt:
+                        raise Exception(f"{len(corrupt)} chunks failed verification")
+                except Exception as e:
+                    state['failures'][holder] = state['failures'].get(holder, 0) + 1
+                    logger.warning(f"Swarm fetch from {holder} failed ({e}), "
+                                   f"{state['failures'][holder]}/{MAX_HOLDER_FAILURES}")
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                finally:
+                    self.finish_request(state, outstanding)
+        finally:
+            if conn is not None:
+                conn.close()
+            share.close()
+
+    def record_rate(self, holder, received, elapsed):
+        """Smooth a holder's measured throughput"""
+        if elapsed <= 0:
+            return
+        rate = received / elapsed
+        previous = self.holder_rates.get(holder)
+        self.holder_rates[holder] = rate if previous is None else (
+            RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * previous
+        )
@@ -0,0 +1,149 @@
+import threading
+import time
+
+# Progress reporting and cancellation for transfers. Every loop that moves a
+# transfer's data already draws bandwidth once per frame, so the share it
+# draws from is wrapped: drawing checks the transfer's cancellation token,
+# and the loops report the file bytes they have moved. Listeners get events
+# a few times a second at most, plus one final event when the transfer ends,
+# and are called on the transfer's own thread.
+
+PROGRESS_INTERVAL = 0.25  # seconds between progress events
+RATE_SMOOTHING = 0.3      # weight of the newest interval in the current rate
+
+SEND = 'send'
+RECEIVE = 'receive'
+
+RUNNING = 'running'
+COMPLETE = 'complete'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+class TransferCancelled(Exception):
+    """Raised inside a transfer's loops once it has been cancelled"""
+
+class CancellationToken:
+    """Flag a transfer's loops check once per frame"""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        """Raise TransferCancelled if the transfer has been cancelled"""
+        if self.event.is_set():
+            raise TransferCancelled("Transfer cancelled")
+
+class TransferMonitor:
+    """Progress of one transfer, reported to listeners without polling"""
+
+    def __init__(self, request_id, file_name=None, total=0, direction=None, peer=None, interval=PROGRESS_INTERVAL):
+        self.request_id = request_id
+        self.file_name = file_name
+        self.total = total
+        self.direction = direction
+        self.peer = peer
+        self.interval = interval
+        self.token = CancellationToken()
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.start(0)
+
+    def subscribe(self, on_progress):
+        """Call on_progress(event) as the transfer moves; it gets the current state straight away"""
+        with self.lock:
+            self.listeners.append(on_progress)
+            event = self.snapshot()
+        on_progress(event)
+
+    def unsubscribe(self, on_progress):
+        with self.lock:
+            if on_progress in self.listeners:
+                self.listeners.remove(on_progress)
+
+    def start(self, bytes_done=0):
+        """Begin an attempt with bytes_done of the file already at the receiver"""
+        with self.lock:
+            self.state = RUNNING
+            self.error = None
+            self.bytes_done = bytes_done
+            self.started = self.reported = time.monotonic()
+            self.start_bytes = self.reported_bytes = bytes_done
+            self.rate = None
+
+    def advance(self, amount):
+        """Count file bytes moved, reporting progress if an interval has passed"""
+        with self.lock:
+            self.bytes_done += amount
+            now = time.monotonic()
+            if now - self.reported < self.interval:
+                return
+            interval_rate = (self.bytes_done - self.reported_bytes) / (now - self.reported)
+            if self.rate is None:
+                self.rate = interval_rate
+            else:
+                self.rate += RATE_SMOOTHING * (interval_rate - self.rate)
+            self.reported, self.reported_bytes = now, self.bytes_done
+            event = self.snapshot()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(event)
+
+    def finish(self, state, error=None):
+        """Report the final state of the transfer"""
+        with self.lock:
+            self.state = state
+            self.error = str(error) if error else None
+            if state == COMPLETE:
+                self.bytes_done = self.total
+            event = self.snapshot()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(event)
+
+    def snapshot(self):
+        """The transfer's progress as an event"""
+        elapsed = time.monotonic() - self.started
+        average_rate = (self.bytes_done - self.start_bytes) / elapsed if elapsed > 0 else 0.0
+        rate = self.rate if self.rate is not None else average_rate
+        remaining = max(self.total - self.bytes_done, 0)
+        return {
+            'request_id': self.request_id,
+            'file_name': self.file_name,
+            'direction': self.direction,
+            'peer': self.peer,
+            'state': self.state,
+            'bytes_done': min(self.bytes_done, self.total) if self.total else self.bytes_done,
+            'total': self.total,
+            'rate': rate,                  # bytes per second over the last few intervals
+            'average_rate': average_rate,  # bytes per second since this attempt started
+            'eta': remaining / rate if rate > 0 and self.state == RUNNING else None,
+            'error': self.error
+        }
+
+class MonitoredShare:
+    """Bandwidth share whose transfer stops within one frame of being cancelled"""
+
+    def __init__(self, share, monitor):
+        self.share = share
+        self.monitor = monitor
+
+    def acquire(self, amount):
+        self.monitor.token.check()
+        self.share.acquire(amount)
+
+    def check(self):
+        """Stop work that moves no data once the transfer has been cancelled"""
+        self.monitor.token.check()
+
+    def advance(self, amount):
+        self.monitor.advance(amount)
+
+    def close(self):
+        self.share.close()
@@ -0,0 +1,216 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Outgoing transfers run on a fixed pool of workers instead of a thread
+# each, so a burst of sends queues up rather than opening every socket at
+# once. Jobs are started in priority order, with a cap on how many run
+# against the same peer.
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BULK = 'bulk'
+PRIORITY_BACKGROUND = 'background'
+PRIORITY_RANKS = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 1, PRIORITY_BACKGROUND: 2}
+PRIORITY_WEIGHTS = {PRIORITY_INTERACTIVE: 4.0, PRIORITY_BULK: 1.0, PRIORITY_BACKGROUND: 0.25}
+
+INTERACTIVE_MAX_SIZE = 8 * 1024 * 1024  # small files are usually waited on
+
+DEFAULT_WORKERS = 4
+DEFAULT_PER_PEER_LIMIT = 2
+FINISHED_HISTORY = 500
+
+# Job states
+QUEUED = 'queued'
+PAUSED = 'paused'
+ACTIVE = 'active'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+def priority_for_size(file_size):
+    """Default priority class for a file transfer"""
+    return PRIORITY_INTERACTIVE if file_size <= INTERACTIVE_MAX_SIZE else PRIORITY_BULK
+
+class TransferQueue:
+    """Run transfer jobs on a bounded worker pool in priority order"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, per_peer_limit=DEFAULT_PER_PEER_LIMIT):
+        self.condition = threading.Condition()
+        self.per_peer_limit = per_peer_limit
+        self.jobs = {}                   # {job_id: job} for queued, paused and active jobs
+        self.finished = deque(maxlen=FINISHED_HISTORY)
+        self.active_per_peer = {}        # {peer: number of active jobs}
+        self.sequence = itertools.count(1)
+        self.paused = False
+        self.running = True
+        self.workers = [
+            threading.Thread(target=self.worker_loop, name=f"transfer-worker-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    @classmethod
+    def from_environment(cls):
+        """Create a queue sized by P2P_TRANSFER_WORKERS and P2P_TRANSFERS_PER_PEER"""
+        return cls(
+            workers=int(os.environ.get('P2P_TRANSFER_WORKERS', DEFAULT_WORKERS)),
+            per_peer_limit=int(os.environ.get('P2P_TRANSFERS_PER_PEER', DEFAULT_PER_PEER_LIMIT))
+        )
+
+    def submit(self, peer, run, name=None, priority=PRIORITY_BULK):
+        """Queue a job; run() is called on a worker and returns False on failure"""
+        if priority not in PRIORITY_RANKS:
+            raise ValueError(f"Unknown transfer priority: {priority}")
+        with self.condition:
+            job_id = next(self.sequence)
+            self.jobs[job_id] = {
+                'id': job_id,
+                'peer': peer,
+                'name': name or f"job {job_id}",
+                'priority': priority,
+                'state': QUEUED,
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'error': None,
+                'run': run
+            }
+            self.condition.notify_all()
+        return job_id
+
+    def pause(self, job_id=None):
+        """Hold a queued job back, or stop starting new jobs altogether; running jobs carry on"""
+        with self.condition:
+            if job_id is None:
+                self.paused = True
+                return True
+            job = self.jobs.get(job_id)
+            if not job or job['state'] != QUEUED:
+                return False
+            job['state'] = PAUSED
+            self.condition.notify_all()
+            return True
+
+    def resume(self, job_id=None):
+        """Release a paused job, or the whole queue"""
+        with self.condition:
+            if job_id is None:
+                self.paused = False
+            else:
+                job = self.jobs.get(job_id)
+                if not job or job['state'] != PAUSED:
+                    return False
+                job['state'] = QUEUED
+            self.condition.notify_all()
+            return True
+
+    def cancel(self, job_id):
+        """Drop a job that hasn't started yet"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if not job or job['state'] not in (QUEUED, PAUSED):
+                return False
+            del self.jobs[job_id]
+            job['state'] = CANCELLED
+            job['finished_at'] = time.time()
+            self.finished.append(job)
+            self.condition.notify_all()
+            return True
+
+    def set_priority(self, job_id, priority):
+        """Move a queued job to another priority class"""
+        if priority not in PRIORITY_RANKS:
+            raise ValueError(f"Unknown transfer priority: {priority}")
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if not job or job['state'] not in (QUEUED, PAUSED):
+                return False
+            job['priority'] = priority
+            self.condition.notify_all()
+            return True
+
+    def list_jobs(self, states=None):
+        """List queued, paused, active and finished jobs, oldest first"""
+        with self.condition:
+            jobs = list(self.finished) + sorted(self.jobs.values(), key=lambda job: job['id'])
+            return [
+                {key: value for key, value in job.items() if key != 'run'}
+                for job in jobs if states is None or job['state'] in states
+            ]
+
+    def get_job(self, job_id):
+        """Get one job by id"""
+        for job in self.list_jobs():
+            if job['id'] == job_id:
+                return job
+        return None
+
+    def wait(self, timeout=None):
+        """Block until nothing is queued or running (queued jobs don't count after shutdown)"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while any(
+                job['state'] == ACTIVE or (job['state'] == QUEUED and self.running)
+                for job in self.jobs.values()
+            ):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def shutdown(self):
+        """Stop the workers once their current jobs finish; queued jobs are not started"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def next_job(self):
+        """Pick the highest priority, oldest runnable job (call with the condition held)"""
+        if self.paused or not self.running:
+            return None
+        candidates = [
+            job for job in self.jobs.values()
+            if job['state'] == QUEUED and self.active_per_peer.get(job['peer'], 0) < self.per_peer_limit
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda job: (PRIORITY_RANKS[job['priority']], job['id']))
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None:
+                    if not self.running:
+                        return
+                    self.condition.wait()
+                    job = self.next_job()
+                job['state'] = ACTIVE
+                job['started_at'] = time.time()
+                self.active_per_peer[job['peer']] = self.active_per_peer.get(job['peer'], 0) + 1
+
+            state, error = FINISHED, None
+            try:
+                if job['run']() is False:
+                    state = FAILED
+            except Exception as e:
+                logger.error(f"Transfer job {job['name']} failed: {e}")
+                state, error = FAILED, str(e)
+
+            with self.condition:
+                job['state'] = state
+                job['error'] = error
+                job['finished_at'] = time.time()
+                self.active_per_peer[job['peer']] -= 1
+                if not self.active_per_peer[job['peer']]:
+                    del self.active_per_peer[job['peer']]
+                del self.jobs[job['id']]
+                self.finished.append(job)
+                self.condition.notify_all()
@@ -47,6 +47,10 @@ def get_group_download_dir():
     """Get default download directory for group files"""
     return os.path.join(os.path.expanduser("~"), "Downloads", "P2P_Group_Files")
 
+def get_data_dir():
+    """Get the directory the app keeps its own state in"""
+    return os.path.join(os.path.expanduser("~"), ".p2p_file_sharing")
+
 
 import socket
 
@@ -7,7 +7,13 @@ from tkinter import ttk, messagebox
 from Backend.user import User
 from Backend.network import NetworkManager
 from Backend.file_manager import FileManager
+from Backend.content_store import ContentStore
+from Backend.hash_cache import HashCache
+from Backend import transfer_events
+from Backend.transfer_queue import TransferQueue, PRIORITY_WEIGHTS, priority_for_size
 from Backend.group import GroupManager
+from Backend.swarm import SwarmManager
+from Backend.multicast import MulticastManager
 from Backend.supabase import SupabaseAuth
 from Backend.utils import setup_logger, get_app_version
 from tkinter import ttk, messagebox
@@ -24,7 +30,12 @@ class AppController:
         # Backend components
         self.network = NetworkManager(self)
         self.file_manager = FileManager(self)
+        self.content_store = ContentStore(self)
+        self.hash_cache = HashCache.from_environment()
+        self.transfer_queue = TransferQueue.from_environment()
         self.group_manager = GroupManager(self)
+        self.swarm = SwarmManager(self)
+        self.multicast = MulticastManager.from_environment(self)
         self.auth = SupabaseAuth()  # Initialize Supabase auth
         self.message_handler = MessageHandler(self)  # Add this line
         
@@ -205,6 +216,15 @@ class AppController:
             self.handle_directory_share(message)
             return {'type': 'directory_ack', 'status': 'received'}
 
+        elif msg_type == 'group_content':
+            # Another member holds files we can swarm download
+            self.swarm.handle_content_advertisement(message)
+            return {'type': 'group_ack', 'status': 'received'}
+        
+        elif msg_type == 'multicast_offer':
+            # A member is about to multicast a file to the group
+            return self.multicast.handle_offer(message)
+        
         elif msg_type == 'group_member_joined':
             # Handle new member notification
             self.handle_group_member_joined(message)
@@ -214,6 +234,10 @@ class AppController:
             # Handle file send response (accepted/rejected)
             self.handle_file_send_response(message)
             return {'type': 'ack', 'status': 'received'}
+        
+        elif msg_type == 'transfer_cancel':
+            # The other side of a transfer cancelled it
+            return self.file_manager.handle_transfer_cancel(message)
                 
         elif msg_type == 'chat_message':
             # Handle chat message
@@ -377,9 +401,12 @@ class AppController:
             'sender': sender,
             'file_name': file_name,
             'file_size': file_size,
+            'file_count': message.get('file_count', 1),
             'type': 'incoming_request'
         }
-        
+        if message.get('batch'):
+            file_name = f"{file_name} ({message['file_count']} files)"
+
         # Notify UI - access root through main_window
         if self.main_window and hasattr(self.main_window, 'root'):
             try:
@@ -397,10 +424,26 @@ class AppController:
         """Handle the start of a file transfer"""
         return self.file_manager.handle_file_transfer_start(message)
     
-    def receive_file_chunks(self, client_socket):
+    def receive_file_chunks(self, client_socket, request_id):
         """Receive file data in chunks"""
-        return self.file_manager.receive_file_chunks(client_socket)
+        return self.file_manager.receive_file_chunks(client_socket, request_id)
+    
+    def receive_file_stripe(self, client_socket, message):
+        """Receive one parallel stream of a striped file transfer"""
+        return self.file_manager.receive_file_stripe(client_socket, message)
+    
+    def receive_file_batch(self, client_socket, message):
+        """Receive many files sent together over one connection"""
+        return self.file_manager.receive_file_batch(client_socket, message)
     
+    def serve_directory_fetch(self, client_socket, message):
+        """Send part of a directory we shared with a group to a member"""
+        return self.file_manager.serve_directory_fetch(client_socket, message)
+    
+    def serve_swarm_fetch(self, client_socket, message):
+        """Serve chunks of a group file to a member swarm downloading it"""
+        return self.swarm.serve_fetch(client_socket, message)
+
     def handle_file_send_response(self, message):
         """Handle response to a file send request"""
         request_id = message['request_id']
@@ -409,15 +452,20 @@ class AppController:
         
         if request_id in self.file_manager.pending_file_requests:
             if accepted:
-                # Start file transfer
-                threading.Thread(
-                    target=self.file_manager.start_file_transfer,
-                    args=(request_id, sender),
-                    daemon=True
-                ).start()
+                # Queue the transfer; the worker pool starts it when a slot frees up
+                file_info = self.file_manager.pending_file_requests[request_id]
+                priority = file_info.get('priority') or priority_for_size(file_info['file_size'])
+                file_info['bandwidth_weight'] = PRIORITY_WEIGHTS[priority]
+                self.transfer_queue.submit(
+                    sender,
+                    lambda: self.file_manager.start_file_transfer(request_id, sender),
+                    name=file_info['file_name'],
+                    priority=priority
+                )
             else:
                 # Remove from pending requests
                 del self.file_manager.pending_file_requests[request_id]
+                self.file_manager.finish_monitor(request_id, transfer_events.FAILED, f"{sender} rejected the file transfer")
                 self.add_temp_message(f"{sender} rejected the file transfer")
     
     def handle_chat_message(self, message):
@@ -513,7 +561,7 @@ class AppController:
             logger.error(f"Error sending chat message: {e}")
             return False
     
-    def send_file(self, peer, file_path):
+    def send_file(self, peer, file_path, priority=None):
         """Send a file to a peer"""
         if not peer or not file_path:
             return False, "Invalid peer or file"
@@ -523,6 +571,8 @@ class AppController:
             
             # Create file request
             request = self.file_manager.create_file_request(file_path, peer_obj)
+            if priority:
+                self.file_manager.pending_file_requests[request['request_id']]['priority'] = priority
             
             # Send request
             response = self.network.send_message(peer_obj, request)
@@ -532,11 +582,36 @@ class AppController:
                 return True, request['request_id']
             
             return False, "Failed to send request"
-            
+        
         except Exception as e:
             logger.error(f"Error sending file: {e}")
             return False, str(e)
     
+    def send_directory(self, peer, directory, priority=None):
+        """Send every file in a directory to a peer as one batch"""
+        if not peer or not directory:
+            return False, "Invalid peer or directory"
+        
+        try:
+            peer_obj = self.users[peer]
+            
+            # One request and one connection cover all of the files
+            request = self.file_manager.create_directory_request(directory, peer_obj)
+            if priority:
+                self.file_manager.pending_file_requests[request['request_id']]['priority'] = priority
+            
+            response = self.network.send_message(peer_obj, request)
+            
+            if response and response.get('status') == 'notification_sent':
+                self.add_temp_message(f"Folder send request ({request['file_count']} files) sent to {peer}")
+                return True, request['request_id']
+            
+            return False, "Failed to send request"
+        
+        except Exception as e:
+            logger.error(f"Error sending directory: {e}")
+            return False, str(e)
+    
     def create_group(self, group_name, members):
         """Create a new group"""
         if not group_name:
@@ -665,6 +740,13 @@ class AppController:
         # Send notifications
         self.send_directory_share_notifications(group_name, directory, members)
         
+        # Hash the files in the background so members can swarm download them
+        threading.Thread(
+            target=self.swarm.share_files,
+            args=(group_name, directory, members),
+            daemon=True
+        ).start()
+        
         return True
     
     def send_directory_share_notifications(self, group_name, directory, members):
@@ -717,7 +799,9 @@ class AppController:
     def shutdown(self):
         """Shutdown the application"""
         logger.info("Shutting down application")
+        self.transfer_queue.shutdown()
         self.network.shutdown()
+        self.hash_cache.close()
         
     def send_message_to_peer(self, peer_username, message_data):
         """Send a message to a peer with proper error handling"""
@@ -8,18 +8,20 @@ logger = logging.getLogger(__name__)
 
 class FileProgressDialog:
     """Dialog showing file transfer progress"""
-    def __init__(self, parent, title, file_info):
+    def __init__(self, parent, title, file_info, cancel_callback=None):
         self.parent = parent
         self.file_info = file_info
+        self.cancel_callback = cancel_callback  # stops the transfer itself
+        self.finished = False
         
-        # Create dialog window
+        # Create dialog window. It isn't modal: transfers run in the background
+        # and several can be in progress at once.
         self.dialog = tk.Toplevel(parent)
         self.dialog.title(title)
         self.dialog.geometry("400x200")
         self.dialog.transient(parent)
-        self.dialog.grab_set()
         
-        # Prevent closing with the X button
+        # Closing the window cancels the transfer, like the Cancel button
         self.dialog.protocol("WM_DELETE_WINDOW", self.on_cancel)
         
         self.setup_ui()
@@ -78,21 +80,63 @@ class FileProgressDialog:
         )
         self.cancel_button.pack(side=tk.RIGHT)
     
-    def update_progress(self, bytes_transferred):
+    def update_progress(self, bytes_transferred, rate=None, eta=None):
         """Update the progress bar"""
-        progress = min(100, (bytes_transferred / self.file_info['file_size']) * 100)
+        file_size = self.file_info['file_size']
+        progress = min(100, (bytes_transferred / file_size) * 100) if file_size else 0
         self.progress_var.set(progress)
         
         transferred_str = FileManager.format_file_size(bytes_transferred)
-        total_str = FileManager.format_file_size(self.file_info['file_size'])
-        self.status_label.config(text=f"Transferred: {transferred_str} / {total_str} ({progress:.1f}%)")
+        total_str = FileManager.format_file_size(file_size)
+        text = f"Transferred: {transferred_str} / {total_str} ({progress:.1f}%)"
+        if rate:
+            text += f"\n{FileManager.format_file_size(rate)}/s"
+            if eta is not None:
+                text += f", {self.format_duration(eta)} left"
+        self.status_label.config(text=text)
+    
+    def handle_event(self, event):
+        """Show a transfer event; called from the transfer's thread"""
+        try:
+            self.dialog.after(0, lambda: self.show_event(event))
+        except (tk.TclError, RuntimeError):
+            pass  # the dialog has been closed
+    
+    def show_event(self, event):
+        if not self.dialog.winfo_exists() or self.finished:
+            return
+        if event['state'] == 'running':
+            self.update_progress(event['bytes_done'], event['rate'], event['eta'])
+        elif event['state'] == 'complete':
+            self.complete()
+        elif event['state'] == 'cancelled':
+            self.finish("Transfer cancelled")
+        elif event['direction'] == 'receive':
+            # The sender retries interrupted transfers, picking up where they stopped
+            self.status_label.config(text=f"Interrupted: {event['error']}\nWaiting for the sender to retry...")
+        else:
+            self.finish(f"Transfer failed: {event['error']}")
+    
+    @staticmethod
+    def format_duration(seconds):
+        """Format a number of seconds as h:mm:ss or m:ss"""
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
     
     def complete(self):
         """Mark the transfer as complete"""
         self.progress_var.set(100)
-        self.status_label.config(text="Transfer complete")
+        self.finish("Transfer complete")
+    
+    def finish(self, text):
+        """Show the final state of the transfer"""
+        self.finished = True
+        self.status_label.config(text=text)
         self.cancel_button.config(text="Close")
     
     def on_cancel(self):
         """Handle cancel button click"""
+        if not self.finished and self.cancel_callback:
+            self.cancel_callback()
         self.dialog.destroy()
\ No newline at end of file
@@ -350,6 +350,12 @@ class GroupMode:
             command=lambda: self.share_directory_to_group(group_name)
         ).pack(side=tk.RIGHT)
         
+        ttk.Button(
+            actions_frame, 
+            text="Multicast File",
+            command=lambda: self.multicast_file_to_group(group_name)
+        ).pack(side=tk.RIGHT, padx=(0, 5))
+        
         # Populate members for sharing
         self.update_share_members_list(group_name)
         
@@ -607,6 +613,28 @@ class GroupMode:
         
         threading.Thread(target=share_directory_thread, daemon=True).start()
     
+    def multicast_file_to_group(self, group_name):
+        """Send one file to the selected members, or the whole group, in a single multicast"""
+        file_path = filedialog.askopenfilename()
+        if not file_path:
+            return
+        
+        selected_members = [self.share_members_listbox.get(i) for i in self.share_members_listbox.curselection()]
+        file_name = os.path.basename(file_path)
+        
+        def multicast_thread():
+            try:
+                received = self.app_controller.multicast.distribute(group_name, file_path, selected_members or None)
+                message = f"{file_name} sent to {len(received)} members: {', '.join(received)}" if received else f"No member took {file_name}"
+                self.parent.winfo_toplevel().after(0, lambda: messagebox.showinfo("Multicast", message))
+            except Exception as e:
+                logger.error(f"Multicast of {file_name} failed: {e}")
+                error = str(e)
+                self.parent.winfo_toplevel().after(0, lambda: messagebox.showerror("Error", f"Failed to multicast file: {error}"))
+        
+        threading.Thread(target=multicast_thread, daemon=True).start()
+        self.app_controller.add_temp_message(f"Multicasting {file_name} to group {group_name}")
+    
     def handle_share_directory_result(self, success, group_name):
         """Handle directory share result"""
         if success:
@@ -726,6 +754,17 @@ class GroupMode:
                     for part in path_parts[1:]:
                         source_path = os.path.join(source_path, part)
                     
+                    # Files the group has hashes for come from every member holding a copy
+                    content_hash = self.app_controller.swarm.find_content(group_name, sharer, source_path)
+                    if 'file' in item_tags and content_hash and self.app_controller.swarm.get_holders(group_name, content_hash):
+                        self.swarm_download(group_name, content_hash, item_name)
+                        return
+                    
+                    # Other members' files live on their machines, so ask the sharer for them
+                    if sharer != self.app_controller.current_user.username:
+                        self.fetch_from_sharer(group_name, sharer, source_path, item_name)
+                        return
+
                     if 'file' in item_tags and os.path.isfile(source_path):
                         # Download a single file
                         self.copy_file_to_downloads(source_path, item_name)
@@ -737,6 +776,75 @@ class GroupMode:
         
         messagebox.showerror("Error", "Item not found or access denied")
     
+    def swarm_download(self, group_name, content_hash, file_name):
+        """Download a group file from all members holding it"""
+        def download_thread():
+            try:
+                save_path = self.app_controller.swarm.download(group_name, content_hash)
+                self.parent.winfo_toplevel().after(0, lambda: messagebox.showinfo("Success", f"File downloaded to: {save_path}"))
+            except Exception as e:
+                logger.error(f"Swarm download of {file_name} failed: {e}")
+                error = str(e)
+                self.parent.winfo_toplevel().after(0, lambda: messagebox.showerror("Error", f"Failed to download file: {error}"))
+        
+        threading.Thread(target=download_thread, daemon=True).start()
+        self.app_controller.add_temp_message(f"Downloading {file_name} from the group")
+    
+    def fetch_from_sharer(self, group_name, sharer, source_path, item_name):
+        """Download a shared file or directory over the network from the member who shared it"""
+        progress_window = tk.Toplevel(self.parent)
+        progress_window.title("Downloading")
+        progress_window.geometry("400x150")
+        progress_window.transient(self.parent)
+        
+        ttk.Label(progress_window, text=f"Downloading {item_name} from {sharer}...").pack(pady=10)
+        
+        progress_var = tk.DoubleVar()
+        progress_bar = ttk.Progressbar(progress_window, variable=progress_var, maximum=100)
+        progress_bar.pack(fill=tk.X, padx=20, pady=10)
+        
+        status_label = ttk.Label(progress_window, text="Connecting...")
+        status_label.pack(pady=5)
+        
+        def on_progress(files_done, file_count, received, total_size, rate):
+            self.parent.after_idle(
+                lambda: self._update_fetch_progress(progress_var, status_label, files_done, file_count, received, total_size, rate)
+            )
+        
+        def fetch_thread():
+            try:
+                save_path = self.app_controller.file_manager.fetch_directory(sharer, group_name, source_path, on_progress)
+                self.parent.after_idle(lambda: self._finish_fetch(progress_window, item_name, save_path))
+            except Exception as e:
+                logger.error(f"Download of {item_name} from {sharer} failed: {e}")
+                error = str(e)
+                self.parent.after_idle(lambda: self._fail_fetch(progress_window, error))
+        
+        threading.Thread(target=fetch_thread, daemon=True).start()
+    
+    def _update_fetch_progress(self, progress_var, status_label, files_done, file_count, received, total_size, rate):
+        """Show how far a download from a group member has got"""
+        if not status_label.winfo_exists():
+            return
+        format_size = self.app_controller.file_manager.format_file_size
+        progress_var.set(received / total_size * 100 if total_size else files_done / max(file_count, 1) * 100)
+        status_label.config(
+            text=f"{files_done}/{file_count} files, {format_size(received)} of {format_size(total_size)} "
+                 f"at {format_size(rate)}/s"
+        )
+    
+    def _finish_fetch(self, progress_window, item_name, save_path):
+        """Close the progress window of a finished download"""
+        if progress_window.winfo_exists():
+            progress_window.destroy()
+        messagebox.showinfo("Success", f"{item_name} downloaded to: {save_path}")
+    
+    def _fail_fetch(self, progress_window, error):
+        """Close the progress window of a failed download"""
+        if progress_window.winfo_exists():
+            progress_window.destroy()
+        messagebox.showerror("Error", f"Failed to download: {error}")
+    
     def copy_file_to_downloads(self, source_path, file_name):
         """Copy a file to the downloads directory"""
         try:
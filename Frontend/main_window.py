@@ -7,6 +7,7 @@ from Frontend.login_screen import LoginScreen
 from Frontend.home_screen import HomeScreen
 from Frontend.private_mode import PrivateMode
 from Frontend.group_mode import GroupMode
+from Frontend.dialog import FileProgressDialog
 
 logger = logging.getLogger(__name__)
 
@@ -169,6 +170,9 @@ class MainWindow:
                 return
             
             peer = self.app_controller.users[sender]
+            if accepted:
+                # Watch before answering, so even an instant transfer is seen finishing
+                self.show_transfer_progress(request_id, sender)
             response = {
                 'type': 'file_send_response',
                 'request_id': request_id,
@@ -188,6 +192,21 @@ class MainWindow:
             logger.error(f"Error sending file response: {e}")
             messagebox.showerror("Error", f"Failed to send response: {str(e)}")
     
+    def show_transfer_progress(self, request_id, sender):
+        """Show a progress dialog for a transfer we accepted"""
+        file_manager = self.app_controller.file_manager
+        file_info = file_manager.pending_file_requests.get(request_id)
+        if not file_info:
+            return
+        
+        dialog = FileProgressDialog(
+            self.root,
+            f"Receiving from {sender}",
+            file_info,
+            cancel_callback=lambda: file_manager.cancel_transfer(request_id)
+        )
+        file_manager.watch_transfer(request_id, dialog.handle_event)
+    
     def show_file_received_notification(self, file_info):
         """Show a notification when a file has been received"""
         messagebox.showinfo(
@@ -3,6 +3,7 @@ from tkinter import ttk, filedialog, messagebox, scrolledtext
 import os
 import threading
 import logging
+from Frontend.dialog import FileProgressDialog
 
 logger = logging.getLogger(__name__)
 
@@ -82,6 +83,12 @@ class PrivateMode:
             command=self.send_file
         ).pack(side=tk.LEFT, padx=5)
         
+        ttk.Button(
+            file_frame, 
+            text="Send Folder",
+            command=self.send_folder
+        ).pack(side=tk.LEFT, padx=5)
+        
         self.file_status_label = ttk.Label(file_frame, text="Select a peer to send files")
         self.file_status_label.pack(side=tk.LEFT, padx=10)
         
@@ -196,11 +203,38 @@ class PrivateMode:
         
         threading.Thread(target=send_file_thread, daemon=True).start()
     
+    def send_folder(self):
+        """Send a whole folder to the selected peer"""
+        if not self.app_controller.selected_peer:
+            messagebox.showwarning("Warning", "Please select a peer first")
+            return
+        
+        directory = filedialog.askdirectory(title="Select folder to send")
+        
+        if not directory:
+            return
+        
+        self.status_label.config(text="Sending folder request...")
+        
+        def send_folder_thread():
+            success, result = self.app_controller.send_directory(
+                self.app_controller.selected_peer, 
+                directory
+            )
+            
+            # Update UI from main thread
+            self.parent.after_idle(
+                lambda: self.handle_send_file_result(success, result)
+            )
+        
+        threading.Thread(target=send_folder_thread, daemon=True).start()
+    
     def handle_send_file_result(self, success, result):
         """Handle file send result"""
         if success:
             self.status_label.config(text="File request sent successfully")
             self.update_file_status()
+            self.show_transfer_progress(result)
             # If you want to add a message about the file transfer to the chat
             file_info = os.path.basename(result) if isinstance(result, str) else "file"
             self.update_chat_display(f"You: [Sent file request: {file_info}]")
@@ -208,6 +242,21 @@ class PrivateMode:
             self.status_label.config(text="Failed to send file request")
             messagebox.showerror("Error", f"Failed to send file: {result}")
     
+    def show_transfer_progress(self, request_id):
+        """Show a progress dialog for a transfer we're sending"""
+        file_manager = self.app_controller.file_manager
+        file_info = file_manager.pending_file_requests.get(request_id)
+        if not file_info:
+            return
+        
+        dialog = FileProgressDialog(
+            self.parent.winfo_toplevel(),
+            f"Sending to {file_info['peer']}",
+            file_info,
+            cancel_callback=lambda: file_manager.cancel_transfer(request_id)
+        )
+        file_manager.watch_transfer(request_id, dialog.handle_event)
+    
     def send_chat_message(self):
         """Send a chat message to the selected peer with timeout"""
         message = self.chat_entry.get().strip()
@@ -0,0 +1,117 @@
+import json
+import time
+import timeit
+
+from Backend import codec
+
+# Compares the binary codec with JSON for every message type
+# AppController.process_message handles and the responses it sends back:
+# encode and decode time per message and the size on the wire. The last
+# column is what a connection that agreed on the binary codec sends. Run from
+# the repository root with
+#
+#     python -m benchmarks.codec_benchmark
+
+TIMESTAMP = '2026-10-17T14:03:27.512694'
+CONTENT_HASH = '9f2c6e1d0b7a4c3e8d5f1a2b3c4d5e6f7a8b9c0d1e2f3a4b5c6d7e8f9a0b1c2d'
+MEMBERS = [f'member{i}' for i in range(12)]
+GROUP_FILES = [
+    {'content_hash': CONTENT_HASH, 'file_name': f'chapter_{i:02d}.pdf', 'file_size': 1843221 + i * 7919,
+     'path': f'/home/alice/shared/course/chapter_{i:02d}.pdf'}
+    for i in range(20)
+]
+
+MESSAGES = {
+    'discover': {'type': 'discover', 'username': 'alice', 'port': 12345, 'ip': '192.168.1.23'},
+    'file_send_request': {
+        'type': 'file_send_request', 'request_id': 'report.pdf_1792212207_4821', 'sender': 'alice',
+        'file_name': 'report.pdf', 'file_size': 48213377, 'content_hash': CONTENT_HASH, 'timestamp': TIMESTAMP
+    },
+    'directory_share': {
+        'type': 'directory_share', 'group_name': 'study', 'directory': '/home/alice/shared/course',
+        'sharer': 'alice', 'timestamp': TIMESTAMP
+    },
+    'group_content': {
+        'type': 'group_content', 'group_name': 'study', 'holder': 'alice', 'files': GROUP_FILES,
+        'timestamp': TIMESTAMP
+    },
+    'multicast_offer': {
+        'type': 'multicast_offer', 'group_name': 'study', 'sender': 'alice', 'session_id': 2840176231,
+        'receiver_id': 3, 'repair_port': 40213, 'group': '239.255.42.99', 'port': 45999, **GROUP_FILES[0],
+        'timestamp': TIMESTAMP
+    },
+    'group_member_joined': {
+        'type': 'group_member_joined', 'group_name': 'study', 'new_member': 'bob',
+        'updated_members': MEMBERS, 'timestamp': TIMESTAMP
+    },
+    'file_send_response': {
+        'type': 'file_send_response', 'request_id': 'report.pdf_1792212207_4821', 'sender': 'bob',
+        'accepted': True, 'timestamp': TIMESTAMP
+    },
+    'transfer_cancel': {
+        'type': 'transfer_cancel', 'request_id': 'report.pdf_1792212207_4821', 'sender': 'bob',
+        'timestamp': TIMESTAMP
+    },
+    'chat_message': {
+        'type': 'chat_message', 'sender': 'alice', 'message': 'Are you coming to the review session tonight?',
+        'timestamp': TIMESTAMP
+    },
+    'group_invite': {'type': 'group_invite', 'group_name': 'study', 'inviter': 'alice', 'members': MEMBERS},
+    'group_invitation': {'type': 'group_invitation', 'group': 'study', 'from': 'alice', 'timestamp': 1792212207.512694},
+    'group_invitation_response': {
+        'type': 'group_invitation_response', 'group': 'study', 'response': 'accept', 'from': 'bob'
+    },
+    'file_transfer_start': {
+        'type': 'file_transfer_start', 'request_id': 'report.pdf_1792212207_4821', 'sender': 'alice',
+        'file_name': 'report.pdf', 'file_size': 48213377, 'source_mtime': 1792210000.25,
+        'content_hash': CONTENT_HASH, 'transfer_modes': ['sendfile', 'framed'], 'resume_supported': True,
+        'restart': False, 'stripe_supported': True, 'delta_supported': True, 'compression': None
+    },
+    'discover_response': {'type': 'discover_response', 'username': 'bob', 'port': 12346},
+    'status_update': {'type': 'status_update', 'sender': 'alice', 'status': 'online'},
+    'ping': {'type': 'ping', 'timestamp': 1792212207.512694},
+    'error': {'type': 'error', 'sender': 'alice', 'message': 'Transfer failed: disk full'},
+    # Responses
+    'ack': {'type': 'ack', 'status': 'received'},
+    'chat_ack': {'type': 'chat_ack', 'status': 'received'},
+    'group_ack': {'type': 'group_ack', 'status': 'received'},
+    'multicast_ack': {'type': 'multicast_ack', 'status': 'joining', 'repair_port': 40213},
+    'pong': {'type': 'pong', 'status': 'alive'},
+    'unknown_type_error': {
+        'type': 'error', 'status': 'unknown_message_type', 'message': 'Unknown message type: file_stripe'
+    },
+}
+
+def json_encode(message):
+    return json.dumps(message).encode()
+
+def json_decode(data):
+    return json.loads(data.decode())
+
+def per_call_ns(fn, arg):
+    """Best of several runs, in nanoseconds per call"""
+    timer = timeit.Timer(lambda: fn(arg))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e9
+
+def main():
+    print(f"{'message':<27}{'json B':>8}{'bin B':>8}{'json enc':>10}{'bin enc':>10}{'json dec':>10}{'bin dec':>10}{'sent as':>9}")
+    print(f"{'':<43}{'(ns per message)':>40}")
+    totals = [0, 0]
+    for name, message in MESSAGES.items():
+        as_json = json_encode(message)
+        as_binary = codec.encode(message)
+        if codec.decode(as_binary) != json_decode(as_json):
+            raise Exception(f"{name} doesn't survive a round trip")
+        totals[0] += len(as_json)
+        totals[1] += len(as_binary)
+        print(f"{name:<27}{len(as_json):>8}{len(as_binary):>8}"
+              f"{per_call_ns(json_encode, message):>10.0f}{per_call_ns(codec.encode, message):>10.0f}"
+              f"{per_call_ns(json_decode, as_json):>10.0f}{per_call_ns(codec.decode, as_binary):>10.0f}"
+              f"{'binary' if codec.suits(message) else 'json':>9}")
+    print(f"{'total':<27}{totals[0]:>8}{totals[1]:>8}")
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    main()
+    print(f"took {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,78 @@
+import io
+import random
+import time
+
+from Backend import delta
+from Backend.file_manager import DELTA_OP, LARGE_FRAME_HEADER
+
+# Compares sending a whole file with sending a delta against the copy the
+# receiver already has, for the kinds of change a re-sent file usually has.
+# The delta counts everything the transfer puts on the wire: the receiver's
+# block signatures, every operation header and the literal data. Its time is
+# the CPU both sides spend (signatures on the receiver, the rolling search on
+# the sender) plus the wire bytes at LINK_RATE, next to the time the whole
+# file takes at that rate. Run from the repository root with
+#
+#     python -m benchmarks.delta_benchmark
+
+FILE_SIZE = 16 * 1024 * 1024
+LINK_RATE = 100e6 / 8  # bytes/s, a 100 Mbit/s network
+
+def edited_in_place(data, rng):
+    data = bytearray(data)
+    for _ in range(10):
+        position = rng.randrange(len(data) - 100)
+        data[position:position + 100] = rng.randbytes(100)
+    return bytes(data)
+
+CHANGES = {
+    'unchanged': lambda data, rng: data,
+    'appended 1 MB': lambda data, rng: data + rng.randbytes(1024 * 1024),
+    '10 small edits': edited_in_place,
+    '1 KB inserted at start': lambda data, rng: rng.randbytes(1024) + data,
+    'second half dropped': lambda data, rng: data[:len(data) // 2],
+    'rewritten': lambda data, rng: rng.randbytes(len(data)),
+}
+
+def apply_delta(basis, ops, block_size):
+    """Rebuild the new file from the basis the way the receiver does"""
+    out = bytearray()
+    for op in ops:
+        if op[0] == 'copy':
+            out += basis[op[1] * block_size:(op[1] + op[2]) * block_size]
+        else:
+            out += op[1]
+    return bytes(out)
+
+def run_delta(basis, new):
+    block_size = delta.choose_block_size(len(basis))
+    cpu_start = time.process_time()
+    signatures = delta.compute_signatures(io.BytesIO(basis), block_size)
+    table = delta.parse_signatures(signatures)
+    ops = list(delta.generate_delta(io.BytesIO(new), table, block_size))
+    cpu_time = time.process_time() - cpu_start
+
+    if apply_delta(basis, ops, block_size) != new:
+        raise Exception("Delta doesn't rebuild the new file")
+    wire = DELTA_OP.size + LARGE_FRAME_HEADER.size + len(signatures)  # request and signatures
+    wire += sum(DELTA_OP.size + (len(op[1]) if op[0] == 'literal' else 0) for op in ops)
+    wire += DELTA_OP.size  # end
+    return wire, cpu_time
+
+def main():
+    rng = random.Random(0)
+    basis = rng.randbytes(FILE_SIZE)
+    print(f"{'change':<25}{'full MB':>9}{'delta MB':>10}{'saved':>8}{'delta CPU':>11}{'full s':>8}{'delta s':>9}")
+    print(f"{'':<25}{f'(at {LINK_RATE * 8 / 1e6:.0f} Mbit/s)':>55}")
+    for name, change in CHANGES.items():
+        new = change(basis, rng)
+        wire, cpu_time = run_delta(basis, new)
+        full_time = len(new) / LINK_RATE
+        delta_time = cpu_time + wire / LINK_RATE
+        print(f"{name:<25}{len(new) / 2**20:>9.1f}{wire / 2**20:>10.2f}{1 - wire / len(new):>8.1%}"
+              f"{cpu_time:>10.2f}s{full_time:>8.2f}{delta_time:>9.2f}")
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    main()
+    print(f"took {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from Backend.network import ENGINE_ASYNCIO, ENGINE_THREADED, SERVER_BACKLOG, NetworkManager
+
+# Loads one peer's server with many other peers at once, for each server
+# engine: how long 1,000 peers take to connect and hold their connections
+# open, how long answering a chat message on every one of them takes, how
+# many connect/request/close cycles a second the server keeps up with, and
+# the server's memory and threads while all the connections are open. The
+# server runs in its own process so its memory is measured on its own. Run
+# from the repository root with
+#
+#     python -m benchmarks.load_benchmark
+
+PEERS = 1000
+CHURN_CONNECTIONS = 5000
+CHURN_CONCURRENCY = 100  # peers connecting at the same time during the churn
+MESSAGE = json.dumps({'type': 'chat_message', 'sender': 'peer', 'message': 'Are you there?'}).encode()
+
+class ServerApp:
+    """Just enough of AppController for NetworkManager to answer chat messages"""
+
+    def __init__(self):
+        self.users = {}
+        self.current_user = None
+        self.main_window = None
+        self.network = NetworkManager(self)
+
+    def process_message(self, message):
+        return {'type': 'ack', 'status': 'received'}
+
+def memory_usage():
+    """Resident memory of this process in MB and its thread count"""
+    rss = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+    except OSError:
+        import resource  # peak rather than current, where /proc isn't available
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'rss_mb': rss, 'threads': threading.active_count()}
+
+def raise_file_limit():
+    """Allow enough open sockets for every simulated peer"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = PEERS * 2 + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard), hard))
+
+def serve():
+    """Run the server side: print the port, then answer every line on stdin with memory usage"""
+    raise_file_limit()
+    app = ServerApp()
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(SERVER_BACKLOG)
+    app.network.server_socket = server_socket
+    app.network.is_server_running = True
+    app.network.start_server_engine()
+    print(server_socket.getsockname()[1], flush=True)
+    for _ in sys.stdin:
+        print(json.dumps(memory_usage()), flush=True)
+
+class Server:
+    """A server process running one engine"""
+
+    def __init__(self, engine):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.load_benchmark', '--serve'],
+            cwd=root, env=dict(os.environ, P2P_SERVER_ENGINE=engine),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        self.port = int(self.process.stdout.readline())
+
+    def memory(self):
+        self.process.stdin.write('\n')
+        self.process.stdin.flush()
+        return json.loads(self.process.stdout.readline())
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+
+async def request(reader, writer):
+    writer.write(MESSAGE)
+    await writer.drain()
+    reply = await reader.read(8192)
+    writer.close()
+    return bool(reply)
+
+async def hold_open(port, connected, go):
+    """Connect, wait until every peer is connected, then send one message"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    connected.release()
+    await go.wait()
+    return await request(reader, writer)
+
+async def churn(port, count):
+    """Connect, send one message and disconnect, count times over"""
+    answered = 0
+    for _ in range(count):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        answered += await request(reader, writer)
+    return answered
+
+async def load(server):
+    result = {'idle': server.memory()}
+
+    connected = asyncio.Semaphore(0)
+    go = asyncio.Event()
+    start = time.perf_counter()
+    peers = [asyncio.create_task(hold_open(server.port, connected, go)) for _ in range(PEERS)]
+    for _ in range(PEERS):
+        await connected.acquire()
+    result['connect_s'] = time.perf_counter() - start
+    await asyncio.sleep(1.0)  # let the server settle with every connection open
+    result['held'] = server.memory()
+
+    start = time.perf_counter()
+    go.set()
+    answered = await asyncio.gather(*peers)
+    result['answer_s'] = time.perf_counter() - start
+    if sum(answered) != PEERS:
+        raise Exception(f"Only {sum(answered)} of {PEERS} held connections were answered")
+
+    start = time.perf_counter()
+    per_peer = CHURN_CONNECTIONS // CHURN_CONCURRENCY
+    answered = await asyncio.gather(*[churn(server.port, per_peer) for _ in range(CHURN_CONCURRENCY)])
+    result['churn_per_s'] = sum(answered) / (time.perf_counter() - start)
+    if sum(answered) != per_peer * CHURN_CONCURRENCY:
+        raise Exception(f"Only {sum(answered)} of {per_peer * CHURN_CONCURRENCY} connections were answered")
+    return result
+
+def main():
+    raise_file_limit()
+    print(f"{'engine':<10}{'connect':>9}{'answer':>9}{'conn/s':>9}{'idle MB':>9}{'open MB':>9}{'threads':>9}")
+    print(f"{'':<10}{f'({PEERS} peers, s)':>18}")
+    for engine in (ENGINE_ASYNCIO, ENGINE_THREADED):
+        server = Server(engine)
+        try:
+            result = asyncio.run(load(server))
+        finally:
+            server.stop()
+        print(f"{engine:<10}{result['connect_s']:>9.2f}{result['answer_s']:>9.2f}{result['churn_per_s']:>9.0f}"
+              f"{result['idle']['rss_mb']:>9.1f}{result['held']['rss_mb']:>9.1f}{result['held']['threads']:>9}")
+
+if __name__ == '__main__':
+    if '--serve' in sys.argv:
+        serve()
+    else:
+        start = time.perf_counter()
+        main()
+        print(f"took {time.perf_counter() - start:.1f}s")
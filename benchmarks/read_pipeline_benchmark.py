@@ -0,0 +1,157 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from Backend import read_pipeline
+from Backend.chunk_sizer import ChunkSizer
+from Backend.file_manager import FRAMED_HEADER, FileManager
+from Backend.read_pipeline import PipelinedReader
+
+# Compares three ways for the framed sender to read: a chunk and then
+# sending it, as it used to; always reading ahead on its own thread through
+# PipelinedReader; and FileManager.send_file_framed, which reads inline
+# until reads are seen to hold up sending and only then reads ahead. The disk is simulated by adding a seek latency and
+# a transfer rate to every read of a real file; the network by a receiver
+# thread that drains a local socket pair, optionally at a limited rate. A
+# slow disk behind a fast network is where reading ahead matters most. Run
+# from the repository root with
+#
+#     python -m benchmarks.read_pipeline_benchmark
+
+FILE_SIZE = 64 * 1024 * 1024
+SEND_BUFFER = 256 * 1024
+
+# name, disk latency (s), disk rate (bytes/s), network rate (bytes/s); None is unlimited
+SCENARIOS = [
+    ('HDD, fast network', 0.008, 150e6, None),
+    ('HDD, 1 Gbit/s network', 0.008, 150e6, 110e6),
+    ('SATA SSD, 2 Gbit/s network', 0.0001, 500e6, 220e6),
+    ('page cache, fast network', 0, None, None),
+]
+
+class SlowDisk:
+    """Charges every read a seek latency plus its size at the disk's rate"""
+
+    def __init__(self, latency, rate):
+        self.latency = latency
+        self.rate = rate
+
+    def wait(self, size):
+        if self.rate:
+            time.sleep(self.latency + size / self.rate)
+
+class SlowFile:
+    """A file whose reads go through a SlowDisk"""
+
+    def __init__(self, f, disk):
+        self.f = f
+        self.disk = disk
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.disk.wait(len(data))
+        return data
+
+    def readinto(self, buffer):
+        read = self.f.readinto(buffer)
+        self.disk.wait(read)
+        return read
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+class SlowDiskOS:
+    """The os module as PipelinedReader sees it, with positional reads through a SlowDisk"""
+
+    def __init__(self, disk):
+        self.disk = disk
+
+    def preadv(self, fd, buffers, offset):
+        read = os.preadv(fd, buffers, offset)
+        self.disk.wait(read)
+        return read
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+def send_serial(sock, f):
+    """Read a chunk, send it, repeat"""
+    sizer = ChunkSizer()
+    while True:
+        chunk = f.read(sizer.size)
+        if not chunk:
+            break
+        send_start = time.perf_counter()
+        sock.sendall(FRAMED_HEADER.pack(len(chunk)))
+        sock.sendall(chunk)
+        sizer.record(len(chunk), time.perf_counter() - send_start)
+    sock.sendall(FRAMED_HEADER.pack(0))
+
+def send_pipelined(sock, f):
+    """Read ahead on another thread from the first byte"""
+    sizer = ChunkSizer()
+    for data in PipelinedReader(f, 0):
+        position = 0
+        while position < len(data):
+            chunk = data[position:position + sizer.size]
+            position += len(chunk)
+            send_start = time.perf_counter()
+            sock.sendall(FRAMED_HEADER.pack(len(chunk)))
+            sock.sendall(chunk)
+            sizer.record(len(chunk), time.perf_counter() - send_start)
+    sock.sendall(FRAMED_HEADER.pack(0))
+
+def send_adaptive(sock, f):
+    FileManager(None).send_file_framed(sock, f, ChunkSizer())
+
+def drain(sock, rate):
+    buffer = bytearray(1024 * 1024)
+    while True:
+        received = sock.recv_into(buffer)
+        if not received:
+            return
+        if rate:
+            time.sleep(received / rate)
+
+def run(path, send, latency, disk_rate, network_rate):
+    """Send the file once; returns MB/s"""
+    disk = SlowDisk(latency, disk_rate)
+    sender_sock, receiver_sock = socket.socketpair()
+    sender_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+    receiver = threading.Thread(target=drain, args=(receiver_sock, network_rate))
+    receiver.start()
+    real_os = read_pipeline.os
+    read_pipeline.os = SlowDiskOS(disk)
+    try:
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            send(sender_sock, SlowFile(f, disk))
+        sender_sock.shutdown(socket.SHUT_WR)
+        receiver.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        read_pipeline.os = real_os
+        sender_sock.close()
+        receiver_sock.close()
+    return FILE_SIZE / 2**20 / elapsed
+
+def main(path):
+    print(f"{'scenario':<30}{'serial MB/s':>13}{'pipelined MB/s':>16}{'adaptive MB/s':>15}")
+    for name, latency, disk_rate, network_rate in SCENARIOS:
+        serial = run(path, send_serial, latency, disk_rate, network_rate)
+        pipelined = run(path, send_pipelined, latency, disk_rate, network_rate)
+        adaptive = run(path, send_adaptive, latency, disk_rate, network_rate)
+        print(f"{name:<30}{serial:>13.0f}{pipelined:>16.0f}{adaptive:>15.0f}")
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(FILE_SIZE))
+        path = f.name
+    try:
+        main(path)
+    finally:
+        os.remove(path)
+    print(f"took {time.perf_counter() - start:.1f}s")
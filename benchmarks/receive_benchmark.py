@@ -0,0 +1,145 @@
+import socket
+import threading
+import time
+import tracemalloc
+
+from Backend.file_manager import FRAMED_HEADER, LARGE_FRAME_HEADER, RECEIVE_BUFFER_SIZE
+from Backend.frame_reader import FrameReader
+
+# Compares the receive side of both transfer modes read the way FileManager
+# used to (a recv per header and per piece of payload, each returning fresh
+# bytes) with reading through FrameReader (recv_into one reused buffer). The
+# data comes from a sender thread over a local socket pair and is thrown away
+# after reading, so only the reading itself is measured: throughput, how
+# many recv calls it takes, how many MB of new bytes objects those calls
+# allocate per GB received, and the peak memory tracemalloc sees. Run from
+# the repository root with
+#
+#     python -m benchmarks.receive_benchmark
+
+TOTAL_SIZE = 512 * 1024 * 1024
+FRAMED_CHUNK_SIZE = 8 * 1024
+LARGE_FRAME_SIZE = 8 * 1024 * 1024
+
+class CountingSocket:
+    """Counts the receive calls made on a socket and the new bytes they return"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+        self.allocated = 0
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        self.calls += 1
+        self.allocated += len(data)
+        return data
+
+    def recv_into(self, buffer):
+        self.calls += 1
+        return self.sock.recv_into(buffer)
+
+def build_stream(header, frame_size):
+    """One frame of the stream, its header included"""
+    return header.pack(frame_size) + bytes(range(256)) * (frame_size // 256)
+
+def send_stream(sock, header, frame_size):
+    frame = build_stream(header, frame_size)
+    for _ in range(TOTAL_SIZE // frame_size):
+        sock.sendall(frame)
+    sock.sendall(header.pack(0))
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        packet = sock.recv(size - len(data))
+        if not packet:
+            raise Exception("Connection lost during file transfer")
+        data += packet
+    return data
+
+def recv_framed(sock):
+    received = 0
+    while True:
+        chunk_size, = FRAMED_HEADER.unpack(recv_exact(sock, FRAMED_HEADER.size))
+        if chunk_size == 0:
+            return received
+        received += len(recv_exact(sock, chunk_size))
+
+def recv_large_frames(sock):
+    received = 0
+    while True:
+        frame_size, = LARGE_FRAME_HEADER.unpack(recv_exact(sock, LARGE_FRAME_HEADER.size))
+        if frame_size == 0:
+            return received
+        remaining = frame_size
+        while remaining:
+            data = sock.recv(min(remaining, RECEIVE_BUFFER_SIZE))
+            if not data:
+                raise Exception("Connection lost during file transfer")
+            remaining -= len(data)
+            received += len(data)
+
+def reader_framed(sock):
+    reader = FrameReader(sock)
+    received = 0
+    while True:
+        chunk_size, = reader.read_struct(FRAMED_HEADER)
+        if chunk_size == 0:
+            return received
+        for data in reader.read_chunks(chunk_size):
+            received += len(data)
+
+def reader_large_frames(sock):
+    reader = FrameReader(sock)
+    received = 0
+    while True:
+        frame_size, = reader.read_struct(LARGE_FRAME_HEADER)
+        if frame_size == 0:
+            return received
+        for data in reader.read_chunks(frame_size):
+            received += len(data)
+
+CASES = [
+    ('framed', 'recv', FRAMED_HEADER, FRAMED_CHUNK_SIZE, recv_framed),
+    ('framed', 'FrameReader', FRAMED_HEADER, FRAMED_CHUNK_SIZE, reader_framed),
+    ('sendfile', 'recv', LARGE_FRAME_HEADER, LARGE_FRAME_SIZE, recv_large_frames),
+    ('sendfile', 'FrameReader', LARGE_FRAME_HEADER, LARGE_FRAME_SIZE, reader_large_frames),
+]
+
+def run(header, frame_size, receive, wrap=None, trace=False):
+    """Receive one whole stream; returns (seconds, socket wrapper, peak traced bytes)"""
+    sender_sock, receiver_sock = socket.socketpair()
+    sender = threading.Thread(target=send_stream, args=(sender_sock, header, frame_size))
+    sock = wrap(receiver_sock) if wrap else receiver_sock
+    sender.start()
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    received = receive(sock)
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    sender.join()
+    sender_sock.close()
+    receiver_sock.close()
+    if received != TOTAL_SIZE // frame_size * frame_size:
+        raise Exception(f"Received {received} bytes")
+    return elapsed, sock, peak
+
+def main():
+    print(f"{'mode':<10}{'reader':<13}{'MB/s':>8}{'recv calls':>12}{'new MB/GB':>11}{'peak MB':>9}")
+    for mode, name, header, frame_size, receive in CASES:
+        best = min(run(header, frame_size, receive)[0] for _ in range(3))
+        _, counted, _ = run(header, frame_size, receive, wrap=CountingSocket)
+        _, _, peak = run(header, frame_size, receive, trace=True)
+        gigabytes = TOTAL_SIZE / 2**30
+        print(f"{mode:<10}{name:<13}{TOTAL_SIZE / 2**20 / best:>8.0f}{counted.calls:>12}"
+              f"{counted.allocated / 2**20 / gigabytes:>11.0f}{peak / 2**20:>9.1f}")
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    main()
+    print(f"took {time.perf_counter() - start:.1f}s")
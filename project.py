@@ -238,31 +238,47 @@ class P2PFileSharing:
         try:
             file_info = self.current_file_transfer
             
+            # Receive into one reusable buffer; a single recv_into usually holds
+            # many chunks, so their size headers are parsed without more calls
+            buffer = bytearray(1024 * 1024)
+            view = memoryview(buffer)
+            start = end = 0
+            
             with open(file_info['file_path'], 'wb') as f:
                 while True:
-                    # Read chunk size
-                    chunk_size_data = client_socket.recv(4)
-                    if not chunk_size_data:
-                        break
-                        
-                    chunk_size = int.from_bytes(chunk_size_data, byteorder='big')
+                    # Read chunk size, moving a split header to the front first
+                    if end - start < 4:
+                        view[:end - start] = view[start:end]
+                        end -= start
+                        start = 0
+                        while end < 4:
+                            received = client_socket.recv_into(view[end:])
+                            if not received:
+                                break
+                            end += received
+                        if end < 4:
+                            break
+                    
+                    chunk_size = int.from_bytes(view[start:start + 4], byteorder='big')
+                    start += 4
                     
                     # If chunk size is 0, we're done
                     if chunk_size == 0:
                         break
                     
-                    # Read chunk data
-                    chunk_data = b''
-                    while len(chunk_data) < chunk_size:
-                        remaining = chunk_size - len(chunk_data)
-                        data = client_socket.recv(remaining)
-                        if not data:
-                            raise Exception("Connection lost during file transfer")
-                        chunk_data += data
-                    
-                    # Write chunk to file
-                    f.write(chunk_data)
-                    file_info['bytes_received'] += len(chunk_data)
+                    # Write chunk data to file straight from the buffer
+                    remaining = chunk_size
+                    while remaining:
+                        if start == end:
+                            start = 0
+                            end = client_socket.recv_into(view)
+                            if not end:
+                                raise Exception("Connection lost during file transfer")
+                        count = min(remaining, end - start)
+                        f.write(view[start:start + count])
+                        start += count
+                        remaining -= count
+                    file_info['bytes_received'] += chunk_size
             
             # Send final confirmation
             response = {'status': 'received', 'message': 'File received successfully'}
@@ -0,0 +1,138 @@
+import hashlib
+import random
+import socket
+
+import pytest
+
+from Backend.bandwidth import parse_rate
+from Backend.content_store import ContentStore
+from Backend.file_manager import FileManager
+from Backend.group import GroupManager
+from Backend.hash_cache import HashCache
+from Backend.multicast import DEFAULT_RATE, MulticastManager
+from Backend.network import NetworkManager
+from Backend.swarm import SwarmManager
+from Backend.user import User
+
+# Peers for the loopback tests: each one serves on its own 127.0.0.1 port
+# with the real Backend managers, wired together the way AppController wires
+# them but without the GUI or Supabase. Files land under a temporary HOME.
+
+
+class LoopbackPeer:
+    """The parts of AppController the Backend managers call into"""
+
+    def __init__(self, name, data_dir, multicast_loss=0.0):
+        self.current_user = None
+        self.users = {}
+        self.main_window = None
+        self.received = []  # file_info of every completed incoming transfer
+        self.messages = []  # what would have been shown in the chat
+        self.network = NetworkManager(self)
+        self.file_manager = FileManager(self)
+        self.content_store = ContentStore(self)
+        self.hash_cache = HashCache(str(data_dir / f'{name}_hashes.db'))
+        self.group_manager = GroupManager(self)
+        self.swarm = SwarmManager(self)
+        self.multicast = MulticastManager(
+            self, interface='127.0.0.1', rate=parse_rate(DEFAULT_RATE), loss=multicast_loss
+        )
+
+    def start(self, name):
+        """Listen on a free loopback port and serve it with the configured engine"""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(('127.0.0.1', 0))
+        server_socket.listen(64)
+        self.network.server_socket = server_socket
+        self.network.is_server_running = True
+        self.network.start_server_engine()
+        self.current_user = User(name, '127.0.0.1', server_socket.getsockname()[1])
+        self.users[name] = self.current_user
+
+    def process_message(self, message):
+        msg_type = message.get('type')
+        if msg_type == 'group_content':
+            self.swarm.handle_content_advertisement(message)
+            return {'type': 'group_ack', 'status': 'received'}
+        if msg_type == 'multicast_offer':
+            return self.multicast.handle_offer(message)
+        if msg_type == 'transfer_cancel':
+            return self.file_manager.handle_transfer_cancel(message)
+        return {'type': 'ack', 'status': 'received'}
+
+    def handle_file_transfer_start(self, message):
+        return self.file_manager.handle_file_transfer_start(message)
+
+    def receive_file_chunks(self, client_socket, request_id):
+        return self.file_manager.receive_file_chunks(client_socket, request_id)
+
+    def receive_file_stripe(self, client_socket, message):
+        return self.file_manager.receive_file_stripe(client_socket, message)
+
+    def receive_file_batch(self, client_socket, message):
+        return self.file_manager.receive_file_batch(client_socket, message)
+
+    def serve_directory_fetch(self, client_socket, message):
+        return self.file_manager.serve_directory_fetch(client_socket, message)
+
+    def serve_swarm_fetch(self, client_socket, message):
+        return self.swarm.serve_fetch(client_socket, message)
+
+    def on_file_received(self, file_info):
+        self.received.append(dict(file_info))
+
+    def add_temp_message(self, message):
+        self.messages.append(message)
+
+
+@pytest.fixture
+def start_peers(tmp_path, monkeypatch):
+    """Start peers that all know each other; they are shut down after the test"""
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    started = []
+
+    def start(*names, multicast_loss=0.0):
+        peers = []
+        for name in names:
+            peer = LoopbackPeer(name, tmp_path, multicast_loss)
+            peer.start(name)
+            peers.append(peer)
+        started.extend(peers)
+        for peer in started:
+            for other in started:
+                peer.users[other.current_user.username] = other.current_user
+        return peers
+
+    yield start
+    for peer in started:
+        peer.network.shutdown()
+
+
+@pytest.fixture
+def make_file(tmp_path):
+    """Write reproducible random data to a file under the test's directory"""
+    def make(name, size, seed=0):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        rng = random.Random(seed)
+        with open(path, 'wb') as f:
+            left = size
+            while left:
+                n = min(left, 1024 * 1024)
+                f.write(rng.randbytes(n))
+                left -= n
+        return str(path)
+    return make
+
+
+@pytest.fixture
+def file_digest():
+    """SHA-256 of a file's contents"""
+    def digest(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        return sha.hexdigest()
+    return digest
@@ -0,0 +1,38 @@
+import threading
+import time
+
+# Each incoming transfer has its own entry in FileManager.transfer_sessions,
+# so many senders can push files to one receiver at once without their data,
+# checkpoints or completion callbacks getting mixed up.
+
+TRANSFERS = 12
+FILE_SIZE = 2 * 1024 * 1024
+
+
+def test_simultaneous_transfers_to_one_receiver(start_peers, make_file, file_digest):
+    alice, bob = start_peers('alice', 'bob')
+    # Same name, different contents: the receiver must keep every one apart
+    sources = [make_file(f'src{i}/same.bin', FILE_SIZE + i, seed=i) for i in range(TRANSFERS)]
+    request_ids = [
+        alice.file_manager.create_file_request(path, alice.users['bob'])['request_id'] for path in sources
+    ]
+
+    results = [None] * TRANSFERS
+    def send(i):
+        results[i] = alice.file_manager.start_file_transfer(request_ids[i], 'bob')
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(TRANSFERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=120)
+
+    assert results == [True] * TRANSFERS
+    # The receiver confirms a file before it reports it and drops its session
+    deadline = time.time() + 10
+    while (len(bob.received) < TRANSFERS or bob.file_manager.transfer_sessions) and time.time() < deadline:
+        time.sleep(0.05)
+    assert len(bob.received) == TRANSFERS
+    assert sorted(file_digest(info['file_path']) for info in bob.received) == \
+        sorted(file_digest(path) for path in sources)
+    assert len({info['file_path'] for info in bob.received}) == TRANSFERS
+    assert bob.file_manager.transfer_sessions == {}
@@ -0,0 +1,47 @@
+import glob
+import os
+import time
+
+from Backend import multicast
+
+# The sharer multicasts a file once, then repairs whatever the receivers
+# NACK. Receivers here drop a share of the datagrams on arrival, so the
+# distribution only completes if the repair rounds work.
+
+FILE_SIZE = 4 * 1024 * 1024
+LOSS = 0.1
+RECEIVERS = ['r0', 'r1', 'r2']
+
+
+def test_multicast_repairs_lost_datagrams(start_peers, make_file, file_digest, monkeypatch, tmp_path):
+    sharer, = start_peers('sharer')
+    receivers = start_peers(*RECEIVERS, multicast_loss=LOSS)
+    members = ['sharer'] + RECEIVERS
+    for peer in [sharer] + receivers:
+        peer.group_manager.groups['study'] = {'members': list(members), 'shared_dirs': {}}
+
+    sent = []
+    send_range = multicast.MulticastSender.send_range
+    def counting_send_range(self, f, share, first, count, address):
+        sent.append(count)
+        return send_range(self, f, share, first, count, address)
+    monkeypatch.setattr(multicast.MulticastSender, 'send_range', counting_send_range)
+
+    source = make_file('lecture.bin', FILE_SIZE, seed=7)
+    done = sharer.multicast.distribute('study', source)
+
+    assert sorted(done) == RECEIVERS
+    # The first pass covers the file once; everything after it is repairs
+    datagram_count = -(-FILE_SIZE // multicast.DATAGRAM_PAYLOAD)
+    assert sent[0] == datagram_count
+    assert sum(sent[1:]) > 0
+
+    deadline = time.time() + 10
+    while any(peer.multicast.sessions for peer in receivers) and time.time() < deadline:
+        time.sleep(0.05)
+    pattern = os.path.join(str(tmp_path / 'home'), 'Downloads', 'P2P_Group_Files', '**', 'lecture*.bin')
+    copies = [path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)]
+    assert len(copies) == len(RECEIVERS)
+    assert {file_digest(path) for path in copies} == {file_digest(source)}
+    for peer in receivers:
+        assert any('lecture.bin' in message for message in peer.messages)
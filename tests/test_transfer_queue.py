@@ -0,0 +1,55 @@
+import threading
+
+from Backend.transfer_queue import CANCELLED, QUEUED, TransferQueue
+
+
+def blocker():
+    """A job that runs until the test releases it"""
+    started, release = threading.Event(), threading.Event()
+
+    def run():
+        started.set()
+        release.wait(10)
+    return run, started, release
+
+
+def test_shutdown_leaves_queued_jobs_unstarted():
+    queue = TransferQueue(workers=1)
+    run, started, release = blocker()
+    queue.submit('bob', run)
+    assert started.wait(5)
+    ran = []
+    queued = queue.submit('carol', lambda: ran.append(True))
+    queue.shutdown()
+    release.set()
+    assert queue.wait(5)
+    for worker in queue.workers:
+        worker.join(5)
+        assert not worker.is_alive()
+    assert not ran
+    assert queue.get_job(queued)['state'] == QUEUED
+
+
+def test_cancel_and_pause_wake_waiters():
+    queue = TransferQueue(workers=1)
+    run, started, release = blocker()
+    queue.submit('bob', run)
+    assert started.wait(5)
+    cancelled = queue.submit('bob', lambda: None)
+    paused = queue.submit('bob', lambda: None)
+    queue.pause()
+    finished = threading.Event()
+
+    def release_and_wait():
+        release.set()
+        queue.wait(10)
+        finished.set()
+    # The blocker finishes first; wait() then has only queued jobs to wait on
+    threading.Thread(target=release_and_wait, daemon=True).start()
+    assert not finished.wait(0.5)
+    assert queue.cancel(cancelled)
+    assert not finished.wait(0.2)
+    assert queue.pause(paused)
+    assert finished.wait(1)
+    assert queue.get_job(cancelled)['state'] == CANCELLED
+    queue.shutdown()
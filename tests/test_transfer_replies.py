@@ -0,0 +1,26 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from Backend.file_manager import FileManager
+
+
+def test_reply_split_across_segments_is_read_whole():
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        def reply():
+            sender.sendall(b'{"status": "re')
+            time.sleep(0.05)
+            sender.sendall(b'ady", "transfer_mode": "sendfile"}')
+        threading.Thread(target=reply, daemon=True).start()
+        assert FileManager.read_reply(receiver, "closed") == {'status': 'ready', 'transfer_mode': 'sendfile'}
+
+
+def test_closed_connection_raises_the_callers_message():
+    sender, receiver = socket.socketpair()
+    with receiver:
+        sender.close()
+        with pytest.raises(ConnectionError, match="Receiver closed the connection"):
+            FileManager.read_reply(receiver, "Receiver closed the connection")